@@ -0,0 +1,92 @@
+"""
+Cost of looking up an AIP by UUID as the aips table grows.
+
+scan_aip looks up every AIP it scans by UUID. For each table size, fills
+a SQLite database in a temporary directory with that many AIPs and times
+random lookups through the ORM, as scan_aip makes them: first with the
+models' indexes, then with the index on aips.uuid dropped, as in
+databases created before it existed. Per-lookup times should stay flat
+with the index and grow linearly without it.
+
+Run from the repository root:
+
+    python benchmarks/aip_lookup.py [--sizes 10000,100000,1000000] [--lookups N]
+"""
+
+import random
+import statistics
+import sys
+import tempfile
+import uuid
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import insert
+from sqlalchemy import text
+
+from fixity import models
+from fixity.models import AIP
+
+INSERT_BATCH = 50000
+
+
+def fill(engine, size):
+    """
+    Insert size AIPs with random UUIDs and return their UUIDs.
+    """
+    uuids = [str(uuid.uuid4()) for _ in range(size)]
+    with engine.begin() as connection:
+        for start in range(0, size, INSERT_BATCH):
+            connection.execute(
+                insert(AIP),
+                [
+                    {"uuid": aip_uuid}
+                    for aip_uuid in uuids[start : start + INSERT_BATCH]
+                ],
+            )
+    return uuids
+
+
+def lookup_time(uuids, lookups):
+    """
+    Return the median time, in microseconds, of looking up random AIPs.
+    """
+    session = models.Session()
+    times = []
+    for aip_uuid in random.sample(uuids, lookups):
+        start = perf_counter()
+        session.query(AIP).filter_by(uuid=aip_uuid).one()
+        times.append((perf_counter() - start) * 1e6)
+        session.expunge_all()
+    session.close()
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Measure AIP lookups by table size.")
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10000, 100000, 1000000],
+        help="Comma-separated numbers of AIPs in the table.",
+    )
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    print(f"{'AIPs':>10} {'indexed':>12} {'no index':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            engine = models.configure(f"sqlite:///{Path(directory) / f'{size}.db'}")
+            uuids = fill(engine, size)
+            indexed = lookup_time(uuids, args.lookups)
+            with engine.begin() as connection:
+                connection.execute(text("DROP INDEX ix_aips_uuid"))
+            unindexed = lookup_time(uuids, args.lookups)
+            print(f"{size:>10} {indexed:>10.1f}us {unindexed:>10.1f}us")
+            engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Size and query speed of the reports table, before and after compaction.
+
+Fills a SQLite database in a temporary directory with reports stored as
+plain JSON, as earlier versions did, a share of them failures listing
+many changed files. Then measures the size of the database and the time
+of typical queries, moves the reports to the compact format with
+models.compact_reports(), and measures again.
+
+Run from the repository root:
+
+    python benchmarks/report_storage.py [--reports N] [--failed-share F]
+"""
+
+import json
+import random
+import sys
+import tempfile
+import uuid
+from argparse import ArgumentParser
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import text
+
+from fixity import models
+from fixity import scheduling
+from fixity.models import AIP
+from fixity.models import Report
+
+INSERT_BATCH = 10000
+
+
+def legacy_report(failed, changed_files):
+    report = {
+        "success": not failed,
+        "message": "invalid bag" if failed else "",
+        "started": 1400022946,
+        "finished": 1400022946,
+        "failures": {"files": {"changed": [], "missing": [], "untracked": []}},
+    }
+    if failed:
+        report["failures"]["files"]["changed"] = [
+            {"path": f"data/objects/{uuid.uuid4()}.tif"} for _ in range(changed_files)
+        ]
+    return json.dumps(report)
+
+
+def fill(engine, reports, failed_share, changed_files):
+    begun = datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(AIP), [{"uuid": str(uuid.uuid4())} for _ in range(reports)]
+        )
+        rows = []
+        for aip_id in range(1, reports + 1):
+            failed = random.random() < failed_share
+            rows.append(
+                {
+                    "aip_id": aip_id,
+                    "begun": begun,
+                    "ended": begun + timedelta(seconds=30),
+                    "success": not failed,
+                    "report": legacy_report(failed, changed_files),
+                }
+            )
+            if len(rows) == INSERT_BATCH:
+                connection.execute(insert(Report.__table__), rows)
+                rows = []
+        if rows:
+            connection.execute(insert(Report.__table__), rows)
+
+
+def database_size(engine):
+    # In WAL mode, VACUUM writes the compacted pages to the WAL, so measure
+    # the pages of the database rather than the size of its main file.
+    with engine.connect() as connection:
+        connection.execute(text("VACUUM"))
+        page_count = connection.scalar(text("PRAGMA page_count"))
+        page_size = connection.scalar(text("PRAGMA page_size"))
+    return page_count * page_size
+
+
+def timed(function):
+    start = perf_counter()
+    function()
+    return (perf_counter() - start) * 1000
+
+
+def changed_files(session, compact):
+    """
+    Return the number of files changed by AIP, for the AIPs with some:
+    from the summary column of compact reports, or by reading plain ones.
+    """
+    if compact:
+        query = select(Report.aip_id, Report.changed_count).where(
+            Report.changed_count > 0
+        )
+        return dict(session.execute(query).all())
+    query = select(Report.aip_id, Report.legacy_report).where(Report.success.is_(False))
+    return {
+        aip_id: len(json.loads(report)["failures"]["files"]["changed"])
+        for aip_id, report in session.execute(query)
+    }
+
+
+def measure(engine, compact):
+    session = models.Session(bind=engine)
+    results = {
+        "size (MB)": database_size(engine) / 1e6,
+        "last scanned (ms)": timed(lambda: scheduling.last_scanned(session)),
+        "scan durations (ms)": timed(lambda: scheduling.scan_durations(session)),
+        "count failures (ms)": timed(
+            lambda: session.scalar(
+                select(func.count(Report.id)).where(Report.success.is_(False))
+            )
+        ),
+        "changed files (ms)": timed(lambda: changed_files(session, compact)),
+        "load reports (ms)": timed(
+            lambda: [report.report for report in session.scalars(select(Report))]
+        ),
+    }
+    session.close()
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Measure compact report storage.")
+    parser.add_argument("--reports", type=int, default=50000)
+    parser.add_argument("--failed-share", type=float, default=0.05)
+    parser.add_argument("--changed-files", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "fixity.db"
+        engine = models.configure(f"sqlite:///{path}")
+        fill(engine, args.reports, args.failed_share, args.changed_files)
+
+        before = measure(engine, compact=False)
+        start = perf_counter()
+        models.compact_reports(engine)
+        compaction = perf_counter() - start
+        after = measure(engine, compact=True)
+        engine.dispose()
+
+    print(f"{'':<22} {'plain JSON':>12} {'compact':>12}")
+    for name in before:
+        print(f"{name:<22} {before[name]:>12.1f} {after[name]:>12.1f}")
+    print(f"Compacted {args.reports} reports in {compaction:.1f} s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
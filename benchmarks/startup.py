@@ -0,0 +1,104 @@
+"""
+Cold-start latency of the fixity command line.
+
+Runs the CLI entry point in fresh interpreters and reports, over the
+runs, the median and fastest:
+
+- import time of fixity.cli, as measured by `python -X importtime`;
+- import time of fixity.fixity, the scanning code loaded once the
+  arguments are valid, for comparison;
+- wall-clock time of `fixity --help`, interpreter startup included.
+
+Run from the repository root:
+
+    python benchmarks/startup.py [--runs N] [--max-cli-import MS]
+
+With --max-cli-import, exits with status 1 if the median import time of
+fixity.cli is higher, so the benchmark can guard against a heavy import
+creeping back into the CLI.
+"""
+
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def _run(args):
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_time(module):
+    """
+    Return the cumulative import time of module, in milliseconds, in a
+    fresh interpreter.
+    """
+    result = _run(["-X", "importtime", "-c", f"import {module}"])
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        _, _, fields = line.partition(":")
+        parts = [part.strip() for part in fields.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def help_time():
+    """
+    Return the wall-clock time of `fixity --help`, in milliseconds.
+    """
+    start = perf_counter()
+    _run(["-m", "fixity.cli", "--help"])
+    return (perf_counter() - start) * 1000
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Measure the startup time of fixity.")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--max-cli-import",
+        type=float,
+        metavar="MS",
+        help="Fail if the median import time of fixity.cli exceeds MS.",
+    )
+    args = parser.parse_args(argv)
+
+    # Warm the filesystem cache and compile the bytecode once.
+    _run(["-c", "import fixity.fixity"])
+
+    measurements = {
+        "import fixity.cli": [import_time("fixity.cli") for _ in range(args.runs)],
+        "import fixity.fixity": [
+            import_time("fixity.fixity") for _ in range(args.runs)
+        ],
+        "fixity --help": [help_time() for _ in range(args.runs)],
+    }
+    for name, times in measurements.items():
+        print(
+            f"{name:<22} median {statistics.median(times):8.1f} ms"
+            f"   min {min(times):8.1f} ms"
+        )
+
+    cli_import = statistics.median(measurements["import fixity.cli"])
+    if args.max_cli_import is not None and cli_import > args.max_cli_import:
+        print(
+            f"fixity.cli imports in {cli_import:.1f} ms, more than "
+            f"{args.max_cli_import:.1f} ms",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
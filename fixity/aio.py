@@ -0,0 +1,579 @@
+"""
+asyncio scan engine.
+
+This mirrors the synchronous functions in storage_service, reporting and
+fixity, but performs all HTTP requests with aiohttp so that many
+check_fixity requests can be in flight from a single thread. Database
+access still goes through the (synchronous) SQLAlchemy session; since
+every coroutine runs on the event loop thread, writes to it are
+serialized.
+
+aiohttp is an optional dependency; install fixity with the "async" extra
+to use this module.
+"""
+
+import asyncio
+from contextlib import nullcontext
+from time import monotonic
+from uuid import uuid4
+
+import aiohttp
+
+from . import checkpoints
+from . import reporting
+from . import scheduling
+from . import sharding
+from . import storage_service
+from . import utils
+from .cli import ArgumentError
+from .fixity import ERROR_LOG_LEVEL
+from .fixity import SUCCESS_LOG_LEVEL
+from .fixity import _concurrency
+from .fixity import _delay
+from .fixity import _scanall_summary
+from .fixity import _start_session
+from .fixity import exception_report
+from .fixity import scan_message
+from .outbox import queue_report
+from .storage_service import UNABLE_TO_CONNECT_ERROR
+from .storage_service import StorageServiceError
+
+# check_fixity requests can legitimately take hours for large AIPs, so
+# disable aiohttp's default five minute timeout, as requests has none.
+TIMEOUT = aiohttp.ClientTimeout(total=None)
+
+
+def _query_params(params):
+    # aiohttp only accepts str, int and float query values.
+    return {
+        key: str(value) if isinstance(value, bool) else value
+        for key, value in params.items()
+    }
+
+
+async def _get_aips(http, ss_url, ss_user, ss_key, uri=None):
+    if uri:
+        url, params = ss_url + uri, None
+    else:
+        url = ss_url + "api/v2/file/"
+        params = {"username": ss_user, "api_key": ss_key}
+    try:
+        async with http.get(url, params=params) as response:
+            storage_service._check_aips_status(response.status, ss_url)
+            results = await response.json()
+    except aiohttp.ClientConnectionError:
+        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
+
+    return storage_service._filter_aips(results)
+
+
+async def iter_aips(http, ss_url, ss_user, ss_key):
+    """
+    Async version of storage_service.iter_aips.
+
+    Fetches the first page, then returns an async iterator over all AIPs
+    which requests each following page while the current one is being
+    consumed.
+    """
+    results = await _get_aips(http, ss_url, ss_user, ss_key)
+    return _iter_pages(http, results, ss_url, ss_user, ss_key)
+
+
+async def _iter_pages(http, results, ss_url, ss_user, ss_key):
+    while True:
+        next_page = None
+        if results["meta"]["next"] is not None:
+            next_page = asyncio.create_task(
+                _get_aips(
+                    http, ss_url, ss_user, ss_key, uri=results["meta"]["next"][1:]
+                )
+            )
+        try:
+            for aip in results["objects"]:
+                yield aip
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+        if next_page is None:
+            return
+        results = await next_page
+
+
+async def _batches(aips, max_size, size=1):
+    # See fixity._batches.
+    batch = []
+    async for aip in aips:
+        batch.append(aip)
+        if len(batch) == size:
+            yield batch
+            batch = []
+            size = min(size * 2, max_size)
+    if batch:
+        yield batch
+
+
+async def _reordered(aips, sort):
+    # See scheduling.reordered.
+    listed = []
+    error = None
+    try:
+        async for aip in aips:
+            listed.append(aip)
+    except Exception as e:
+        error = e
+    sort(listed)
+    for aip in listed:
+        yield aip
+    if error is not None:
+        raise error
+
+
+async def get_single_aip(http, uuid, ss_url, ss_user, ss_key):
+    """
+    Async version of storage_service.get_single_aip.
+    """
+    utils.check_valid_uuid(uuid)
+
+    params = {"username": ss_user, "api_key": ss_key}
+    try:
+        async with http.get(
+            ss_url + "api/v2/file/" + uuid + "/", params=params
+        ) as response:
+            storage_service._check_single_aip_status(response.status, uuid, ss_url)
+            return await response.json()
+    except aiohttp.ClientConnectionError:
+        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
+
+
+async def scan_aip(
+    http,
+    aip_uuid,
+    ss_url,
+    ss_user,
+    ss_key,
+    session,
+    start_time=None,
+    force_local=False,
+):
+    """
+    Async version of storage_service.scan_aip.
+
+    Returns a tuple of (success, report), or raises a StorageServiceError
+    carrying a report, exactly like the synchronous version.
+    """
+    session_lock = nullcontext()
+    aip = storage_service._get_aip_model(aip_uuid, session, session_lock)
+
+    if not start_time:
+        begun = utils.utcnow()
+    else:
+        begun = start_time
+
+    params = storage_service._check_fixity_params(ss_user, ss_key, force_local)
+    try:
+        async with http.get(
+            ss_url + "api/v2/file/" + aip.uuid + "/check_fixity/",
+            params=_query_params(params),
+        ) as response:
+            ended = utils.utcnow()
+            storage_service._check_scan_status(
+                response.status, aip, ss_url, begun, ended, session_lock
+            )
+            report = await response.json()
+    except aiohttp.ClientConnectionError:
+        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
+
+    return storage_service._create_scan_report(report, aip, begun, ended, session_lock)
+
+
+def _post_kwargs(body, report_auth):
+    kwargs = {"data": body, "headers": {"Content-Type": "application/json"}}
+    if report_auth:
+        kwargs["auth"] = aiohttp.BasicAuth(*report_auth)
+    return kwargs
+
+
+async def post_pre_scan_report(
+    http, aip, start_time, report_url, report_auth=(), session_id=None
+):
+    """
+    Async version of reporting.post_pre_scan_report.
+    """
+    utils.check_valid_uuid(aip)
+
+    body = reporting._pre_scan_body(start_time, session_id)
+    url = report_url + f"api/fixity/{aip}"
+
+    try:
+        async with http.post(url, **_post_kwargs(body, report_auth)) as response:
+            status_code = response.status
+    except aiohttp.ClientConnectionError:
+        raise reporting.ReportServiceException(
+            f"Unable to connect to report service at URL {report_url}"
+        )
+
+    reporting._check_pre_scan_status(status_code)
+    return True
+
+
+async def post_success_report(
+    http, aip, report, report_url, report_auth=(), session_id=None
+):
+    """
+    Async version of reporting.post_success_report.
+    """
+    if report and report.success is None:
+        return None
+    utils.check_valid_uuid(aip)
+
+    body = reporting._success_body(report, session_id)
+    url = report_url + f"api/fixity/{aip}"
+
+    try:
+        async with http.post(url, **_post_kwargs(body, report_auth)) as response:
+            status_code = response.status
+    except aiohttp.ClientConnectionError:
+        report.posted = False
+        raise reporting.ReportServiceException(
+            f"Unable to connect to report service at URL {report_url}"
+        )
+
+    return reporting._check_success_status(status_code, aip, report)
+
+
+async def scan(
+    http,
+    aip,
+    ss_url,
+    ss_user,
+    ss_key,
+    session,
+    logger,
+    report_url=None,
+    report_auth=(),
+    session_id=None,
+    force_local=False,
+    listed_at=None,
+    max_listing_age=None,
+    aip_model=None,
+):
+    """
+    Async version of fixity.scan.
+    """
+    if listed_at is None or (
+        max_listing_age is not None and monotonic() - listed_at >= max_listing_age
+    ):
+        await get_single_aip(http, aip, ss_url, ss_user, ss_key)
+    if aip_model is None:
+        aip_model = storage_service._get_aip_model(aip, session, nullcontext())
+
+    start_time = utils.utcnow()
+
+    try:
+        if report_url:
+            await post_pre_scan_report(
+                http,
+                aip,
+                start_time,
+                report_url=report_url,
+                report_auth=report_auth,
+                session_id=session_id,
+            )
+    except reporting.ReportServiceException:
+        logger.log(ERROR_LOG_LEVEL, f"Unable to POST pre-scan report to {report_url}")
+    try:
+        status, report = await scan_aip(
+            http,
+            aip_model,
+            ss_url,
+            ss_user,
+            ss_key,
+            session,
+            start_time=start_time,
+            force_local=force_local,
+        )
+        logger.log(
+            SUCCESS_LOG_LEVEL if status else ERROR_LOG_LEVEL,
+            scan_message(aip, status, report.result.message),
+        )
+    except Exception as e:
+        logger.log(ERROR_LOG_LEVEL, str(e))
+
+        status = None
+        if hasattr(e, "report") and e.report:
+            report = e.report
+        else:
+            report = exception_report(aip_model, e, start_time)
+
+    if report_url:
+        try:
+            await post_success_report(
+                http,
+                aip,
+                report,
+                report_url,
+                report_auth=report_auth,
+                session_id=session_id,
+            )
+        except reporting.ReportServiceException:
+            logger.log(
+                ERROR_LOG_LEVEL,
+                f"Unable to POST report for AIP {aip} to remote service",
+            )
+            queue_report(report, aip, session_id=session_id)
+    if report:
+        session.add(report)
+
+    return status
+
+
+async def _scan_safely(aip_uuid, logger, **kwargs):
+    # See fixity._scan_safely.
+    try:
+        status = await scan(aip=aip_uuid, logger=logger, **kwargs)
+    except Exception as e:
+        logger.log(
+            ERROR_LOG_LEVEL,
+            f"Internal error encountered while scanning AIP {aip_uuid} ({type(e).__name__})",
+        )
+        return True, False
+    return bool(status), status is not None
+
+
+def _throttle_trace_config(adaptive_throttle):
+    """
+    Return an aiohttp TraceConfig feeding the response time and status of
+    every check_fixity request to adaptive_throttle, and the requests that
+    fail without a response, like its response_hook and error_hook do for
+    requests.
+    """
+
+    async def on_request_start(session, context, params):
+        context.started = monotonic()
+
+    async def on_request_end(session, context, params):
+        if "/check_fixity/" in params.url.path:
+            adaptive_throttle.observe(
+                monotonic() - context.started, params.response.status
+            )
+
+    async def on_request_exception(session, context, params):
+        if "/check_fixity/" in params.url.path:
+            adaptive_throttle.observe_error()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+async def scanall(
+    ss_url,
+    ss_user,
+    ss_key,
+    session,
+    logger,
+    report_url=None,
+    report_auth=(),
+    throttle_time=0,
+    force_local=False,
+    workers=1,
+    pool_size=None,
+    max_listing_age=None,
+    location_limit=None,
+    location_limits=None,
+    adaptive_throttle=None,
+    resume=None,
+    order="listing",
+    budget=None,
+    shard=None,
+):
+    """
+    Async version of fixity.scanall.
+
+    Up to `workers` AIPs are scanned at the same time, each as a task on
+    the running event loop. At most `pool_size` connections (by default,
+    one per worker) are opened to each of the Storage Service and the
+    report service. Scans are interleaved across storage locations, with
+    at most location_limit (or the location's entry in location_limits)
+    in flight per location. With an adaptive throttle, every check_fixity
+    response is fed to it, and its concurrency and delay are followed
+    instead of `workers` and throttle_time.
+    """
+    success = True
+    started = monotonic()
+    try:
+        scan_session, shard = _start_session(session, resume, shard)
+    except ArgumentError as e:
+        return e
+    session_id = scan_session.uuid
+    already_scanned = checkpoints.scanned_aips(session, scan_session)
+    checkpointer = checkpoints.Checkpointer(session, scan_session)
+
+    trace_configs = []
+    if adaptive_throttle is not None:
+        trace_configs.append(_throttle_trace_config(adaptive_throttle))
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=pool_size or workers)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=TIMEOUT, trace_configs=trace_configs
+    ) as http:
+        try:
+            listing = await iter_aips(http, ss_url, ss_user, ss_key)
+        except StorageServiceError as e:
+            return e
+        if shard is not None:
+            listing = (
+                aip async for aip in listing if sharding.in_shard(aip["uuid"], shard)
+            )
+        sort = scheduling.listing_order(order, session)
+        if sort is not None:
+            listing = _reordered(listing, sort)
+        scanned = 0
+        skipped = 0
+        scanned_bytes = 0
+        listing_error = None
+        batches = _batches(listing, storage_service.PRELOAD_BATCH)
+        # AIPs of the batch being scanned that weren't handed out yet.
+        unhanded = 0
+
+        async def listed_aips():
+            nonlocal skipped, listing_error, unhanded
+            try:
+                async for batch in batches:
+                    unscanned = [
+                        aip for aip in batch if aip["uuid"] not in already_scanned
+                    ]
+                    skipped += len(batch) - len(unscanned)
+                    # See fixity.scanall.
+                    aip_models = storage_service.load_aips(
+                        session, [aip["uuid"] for aip in unscanned]
+                    )
+                    listed_at = monotonic()
+                    unhanded = len(unscanned)
+                    for aip in unscanned:
+                        unhanded -= 1
+                        yield aip, aip_models.get(aip["uuid"]), listed_at
+            except StorageServiceError as e:
+                listing_error = e
+
+        aips = listed_aips()
+        scan_kwargs = {
+            "http": http,
+            "ss_url": ss_url,
+            "ss_user": ss_user,
+            "ss_key": ss_key,
+            "session": session,
+            "report_url": report_url,
+            "report_auth": report_auth,
+            "session_id": session_id,
+            "force_local": force_local,
+            "max_listing_age": max_listing_age,
+        }
+        scheduler = scheduling.LocationScheduler(
+            location_limit, location_limits, keep_order=order != "listing"
+        )
+        pending = {}
+        exhausted = False
+        while True:
+            # See fixity._scan_concurrently.
+            while len(pending) < _concurrency(workers, adaptive_throttle):
+                if budget is not None and budget.exhausted():
+                    break
+                next_scan = scheduler.pop()
+                if next_scan is None:
+                    if exhausted or scheduler.full():
+                        break
+                    try:
+                        listed = await anext(aips)
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    scheduler.push(listed, scheduling.location_of(listed[0]))
+                    continue
+                (aip, aip_model, listed_at), location = next_scan
+                task = asyncio.create_task(
+                    _scan_safely(
+                        aip["uuid"],
+                        logger,
+                        listed_at=listed_at,
+                        aip_model=aip_model,
+                        **scan_kwargs,
+                    )
+                )
+                pending[task] = location, aip, monotonic()
+                delay = _delay(throttle_time, adaptive_throttle)
+                if delay:
+                    await asyncio.sleep(delay)
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                location, aip, scan_started = pending.pop(task)
+                scheduler.done(location)
+                checkpointer.done(aip["uuid"])
+                result, completed = task.result()
+                scanned += 1
+                if completed:
+                    scanned_bytes += aip.get("size") or 0
+                if budget is not None:
+                    budget.record(monotonic() - scan_started)
+                if not result:
+                    success = False
+            checkpointer.commit()
+
+        left = 0
+        if budget is not None and budget.ran_out:
+            # Count the rest of the listing without looking up its AIPs.
+            left = len(scheduler) + unhanded
+            try:
+                async for batch in batches:
+                    left += sum(
+                        1 for aip in batch if aip["uuid"] not in already_scanned
+                    )
+            except StorageServiceError as e:
+                listing_error = e
+
+    if listing_error is None and not left:
+        checkpointer.finish()
+    return _scanall_summary(
+        logger,
+        scanned=scanned,
+        scanned_bytes=scanned_bytes,
+        elapsed=monotonic() - started,
+        skipped=skipped,
+        left=left,
+        session_id=session_id,
+        listing_error=listing_error,
+        success=success,
+    )
+
+
+async def scan_single(
+    aip,
+    ss_url,
+    ss_user,
+    ss_key,
+    session,
+    logger,
+    report_url=None,
+    report_auth=(),
+    force_local=False,
+):
+    """
+    Scan a single AIP with the async engine; see fixity.scan.
+    """
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as http:
+        return await scan(
+            http,
+            aip,
+            ss_url,
+            ss_user,
+            ss_key,
+            session,
+            logger,
+            report_url=report_url,
+            report_auth=report_auth,
+            session_id=str(uuid4()),
+            force_local=force_local,
+        )
@@ -0,0 +1,124 @@
+from time import monotonic
+from uuid import uuid4
+
+from sqlalchemy import exists
+from sqlalchemy import select
+
+from . import utils
+from .models import QueuedAIP
+from .models import ScannedAIP
+from .models import ScanSession
+
+# Resume the most recent unfinished run.
+LATEST = "latest"
+
+# When scans complete faster than they can be committed one by one, their
+# checkpoints, and the reports scanned along with them, are committed
+# after this many scans or this many seconds, whichever comes first.
+COMMIT_EVERY = 100
+COMMIT_INTERVAL = 60.0
+
+
+def start_session(session, resume=None, shard=None, queued=False):
+    """
+    Return the ScanSession of a scanall run.
+
+    Without resume, a new session is created, recording shard (an
+    (index, count) pair) if the run is sharded. Otherwise resume is the
+    UUID of the session to continue, or LATEST for the most recent one
+    that did not finish; with queued, only sessions with a work queue
+    are considered. Returns None if there is no such unfinished session.
+    """
+    if resume is None:
+        scan_session = ScanSession(uuid=str(uuid4()), started=utils.utcnow())
+        if shard is not None:
+            scan_session.shard_index, scan_session.shard_count = shard
+        session.add(scan_session)
+        session.commit()
+        return scan_session
+
+    query = select(ScanSession).where(ScanSession.ended.is_(None))
+    if queued:
+        query = query.where(exists().where(QueuedAIP.session_id == ScanSession.id))
+    if resume == LATEST:
+        query = query.order_by(ScanSession.id.desc()).limit(1)
+    else:
+        query = query.where(ScanSession.uuid == resume)
+    return session.scalars(query).first()
+
+
+def session_shard(scan_session):
+    """
+    Return the shard recorded for scan_session, or None if it isn't sharded.
+    """
+    if scan_session.shard_count is None:
+        return None
+    return scan_session.shard_index, scan_session.shard_count
+
+
+def scanned_aips(session, scan_session):
+    """
+    Return the set of UUIDs of the AIPs already scanned in scan_session.
+    """
+    return set(
+        session.scalars(
+            select(ScannedAIP.aip_uuid).where(ScannedAIP.session_id == scan_session.id)
+        )
+    )
+
+
+class Checkpointer:
+    """
+    Records the progress of a scanall run in the database.
+
+    done() is called as each AIP's scan completes, and commit() once the
+    scans that completed together are recorded, so a run that is killed
+    only loses the scans in flight. The session is also committed every
+    COMMIT_EVERY scans or COMMIT_INTERVAL seconds in between. As
+    checkpoints are committed together with the reports of the same
+    scans, every AIP recorded as scanned also has its report saved.
+    finish() marks the run as complete.
+
+    Used by the asyncio engine, whose scans share one session in one
+    thread; threaded runs save their checkpoints through a
+    writer.ReportWriter instead.
+    """
+
+    def __init__(
+        self,
+        session,
+        scan_session,
+        every=COMMIT_EVERY,
+        interval=COMMIT_INTERVAL,
+    ):
+        self.session = session
+        self.scan_session = scan_session
+        self.every = every
+        self.interval = interval
+        self._uncommitted = 0
+        self._last_commit = monotonic()
+
+    def done(self, aip_uuid):
+        self.session.add(ScannedAIP(session_id=self.scan_session.id, aip_uuid=aip_uuid))
+        self._uncommitted += 1
+        if (
+            self._uncommitted >= self.every
+            or monotonic() - self._last_commit >= self.interval
+        ):
+            self._commit()
+
+    def commit(self):
+        """
+        Commit the checkpoints recorded since the last commit, if any.
+        """
+        if self._uncommitted:
+            self._commit()
+
+    def finish(self):
+        self.scan_session.ended = utils.utcnow()
+        self._commit()
+
+    def _commit(self):
+        self.session.commit()
+        self._uncommitted = 0
+        self._last_commit = monotonic()
@@ -1,95 +1,50 @@
 import io
-import json
+import itertools
 import logging
-import os
 import sys
+import threading
 import traceback
-from argparse import ArgumentParser
+from argparse import Namespace
+from collections.abc import Iterable
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import nullcontext
 from datetime import datetime
 from datetime import timezone
+from time import monotonic
 from time import sleep
 from typing import TextIO
+from typing import TypeVar
 from uuid import uuid4
 
+from . import checkpoints
 from . import reporting
+from . import scheduling
+from . import sharding
 from . import storage_service
 from . import utils
-from .models import Report
+from . import work_queue
+from .cli import ArgumentError as ArgumentError
+from .cli import main as main
+from .http_client import HTTPClient
+from .models import ScanResult
 from .models import Session
+from .outbox import BULK_INTERVAL
+from .outbox import ReportOutbox
+from .outbox import queue_report
+from .throttle import AdaptiveThrottle
+from .writer import ReportWriter
 
 ERROR_LOG_LEVEL = 100
 SUCCESS_LOG_LEVEL = 200
 
+T = TypeVar("T")
 
-class ArgumentError(Exception):
-    pass
-
-
-def validate_arguments(args):
-    if args.command == "scan" and not args.aip:
-        raise ArgumentError("An AIP UUID must be specified when scanning a single AIP")
-
-
-def parse_arguments(argv):
-    parser = ArgumentParser()
-    parser.add_argument("command", choices=["scan", "scanall"], help="Command to run.")
-    parser.add_argument("aip", nargs="?", help="If 'scan', UUID of the AIP to scan")
-    parser.add_argument(
-        "-d", "--debug", action="store_true", help="Print extra debugging output."
-    )
-    parser.add_argument(
-        "--throttle",
-        type=int,
-        default=0,
-        help="Time in seconds to wait between scanning multiple AIPs.",
-    )
-    parser.add_argument(
-        "--force-local",
-        action="store_true",
-        help="Force a local fixity check on the Storage Service.",
-    )
-    parser.add_argument(
-        "--timestamps",
-        action="store_true",
-        help="Add a timestamp to the beginning of each line of output.",
-    )
-    parser.add_argument(
-        "--sort",
-        action="store_true",
-        help="Sort the AIPs based on result of fixity check success or failure.",
-    )
-    args = parser.parse_args(argv)
-
-    validate_arguments(args)
-    return args
-
-
-def _get_environment_variable(var):
-    try:
-        return os.environ[var]
-    except KeyError as e:
-        raise ArgumentError(f"Missing environment variable: {e.args[0]}")
-
-
-def fetch_environment_variables(namespace):
-    namespace.ss_url = _get_environment_variable("STORAGE_SERVICE_URL")
-    if not namespace.ss_url.endswith("/"):
-        namespace.ss_url = namespace.ss_url + "/"
-    namespace.ss_user = _get_environment_variable("STORAGE_SERVICE_USER")
-    namespace.ss_key = _get_environment_variable("STORAGE_SERVICE_KEY")
-
-    if "REPORT_URL" in os.environ:
-        namespace.report_url = _get_environment_variable("REPORT_URL")
-        if not namespace.report_url.endswith("/"):
-            namespace.report_url = namespace.report_url + "/"
-
-    # These two parameters are optional; not all reporting services
-    # require any authentication.
-    try:
-        namespace.report_user = os.environ["REPORT_USERNAME"]
-        namespace.report_pass = os.environ["REPORT_PASSWORD"]
-    except KeyError:
-        namespace.report_user = namespace.report_pass = None
+# Exit status of a scanall run stopped by its time budget without
+# failures (EX_TEMPFAIL: the remaining AIPs can be scanned later).
+BUDGET_EXHAUSTED = 75
 
 
 def scan_message(aip_uuid: str, status: bool, message: str) -> str:
@@ -107,6 +62,27 @@ def scan_message(aip_uuid: str, status: bool, message: str) -> str:
     return output
 
 
+def exception_report(aip, e, start_time):
+    """
+    Build a report for a scan that raised an exception without a report.
+
+    aip is the AIP model the report is linked to. Must be called while the
+    exception is being handled, since the report includes its traceback.
+    """
+    report_dict = {
+        "success": "None",
+        "message": f"Exception encountered while scanning AIP {aip.uuid}: {type(e).__name__} ({str(e)})",
+        "traceback": traceback.format_exc(),
+        "errors": None,
+    }
+
+    report = storage_service.create_report(
+        aip, None, start_time, start_time, ScanResult(report_dict)
+    )
+    report.posted = False
+    return report
+
+
 def scan(
     aip,
     ss_url,
@@ -118,13 +94,21 @@ def scan(
     report_auth=(),
     session_id=None,
     force_local=False,
+    session_lock=None,
+    client=None,
+    listed_at=None,
+    max_listing_age=None,
+    aip_model=None,
+    writer=None,
+    outbox=None,
 ):
     """
     Instruct the storage service to scan a single AIP.
 
     This first attempts to query the storage service about the AIP,
     to ensure the storage service still has a record of it, then
-    runs a fixity scan.
+    runs a fixity scan. The query is skipped if the AIP was found in a
+    listing of the storage service recently enough (see listed_at).
 
     :param str aip: AIP UUID string.
     :param str ss_url: The base URL to a storage service installation.
@@ -135,41 +119,59 @@ def scan(
     :param report_auth: Authentication for the report_url. Tupel of (user, password) for HTTP auth.
     :param session_id: Identifier for this session, allowing every scan from one run to be identified.
     :param bool force_local: If True, will request the Storage Service to perform a local fixity check, instead of using the Space's fixity (if available).
+    :param session_lock: Lock guarding the session, required when several threads share it.
+    :param HTTPClient client: Shared HTTP connections to reuse for every request.
+    :param float listed_at: time.monotonic() value at which the AIP was seen in the storage service's AIP listing, if it was.
+    :param float max_listing_age: Maximum age in seconds of a listing to trust. If None, a listing of any age is trusted.
+    :param AIP aip_model: The AIP's model, if it was already loaded from the database (see storage_service.load_aips); otherwise it is looked up by UUID.
+    :param ReportWriter writer: If set, the report is handed to this writer to be saved, rather than added to session.
+    :param ReportOutbox outbox: If set, reports are posted to report_url in the background by this outbox, rather than before returning. Otherwise reports that can't be posted are queued to be posted later (see outbox.queue_report).
     """
+    if session_lock is None:
+        session_lock = nullcontext()
 
     # Ensure the storage service knows about this AIP first;
     # get_single_aip() will raise an exception if the storage service
     # does not have an AIP with that UUID, or otherwise errors out
     # while attempting to respond to the request.
-    storage_service.get_single_aip(aip, ss_url, ss_user, ss_key)
+    if listed_at is None or (
+        max_listing_age is not None and monotonic() - listed_at >= max_listing_age
+    ):
+        storage_service.get_single_aip(aip, ss_url, ss_user, ss_key, client=client)
+    if aip_model is None:
+        aip_model = storage_service._get_aip_model(aip, session, session_lock)
 
     start_time = utils.utcnow()
 
     try:
-        if report_url:
+        if report_url and outbox is not None:
+            outbox.pre_scan(aip, start_time, session_id=session_id)
+        elif report_url:
             reporting.post_pre_scan_report(
                 aip,
                 start_time,
                 report_url=report_url,
                 report_auth=report_auth,
                 session_id=session_id,
+                client=client,
             )
     except reporting.ReportServiceException:
         logger.log(ERROR_LOG_LEVEL, f"Unable to POST pre-scan report to {report_url}")
     try:
         status, report = storage_service.scan_aip(
-            aip,
+            aip_model,
             ss_url,
             ss_user,
             ss_key,
             session,
             start_time=start_time,
             force_local=force_local,
+            session_lock=session_lock,
+            client=client,
         )
-        report_data = json.loads(report.report)
         logger.log(
             SUCCESS_LOG_LEVEL if status else ERROR_LOG_LEVEL,
-            scan_message(aip, status, report_data["message"]),
+            scan_message(aip, status, report.result.message),
         )
     except Exception as e:
         logger.log(ERROR_LOG_LEVEL, str(e))
@@ -180,38 +182,138 @@ def scan(
         # Certain classes of exceptions will not return reports because no
         # scan was even attempted; report the exception in that case.
         else:
-            report_dict = {
-                "success": "None",
-                "message": f"Exception encountered while scanning AIP {aip}: {type(e).__name__} ({str(e)})",
-                "traceback": traceback.format_exc(),
-                "errors": None,
-            }
-
-            report = Report(
-                aip_id=aip,
-                report=json.dumps(report_dict),
-                success=None,
-                begun=start_time,
-                ended=start_time,
-                posted=False,
-            )
+            report = exception_report(aip_model, e, start_time)
 
-    if report_url:
+    if report_url and outbox is not None:
+        queue_report(report, aip, session_id=session_id)
+    elif report_url:
         try:
             reporting.post_success_report(
-                aip, report, report_url, report_auth=report_auth, session_id=session_id
+                aip,
+                report,
+                report_url,
+                report_auth=report_auth,
+                session_id=session_id,
+                client=client,
             )
         except reporting.ReportServiceException:
             logger.log(
                 ERROR_LOG_LEVEL,
                 f"Unable to POST report for AIP {aip} to remote service",
             )
-    if report:
-        session.add(report)
+            queue_report(report, aip, session_id=session_id)
+    if report and writer is not None:
+        writer.add(report)
+    elif report:
+        with session_lock:
+            session.add(report)
 
     return status
 
 
+def _scan_safely(aip_uuid, logger, **kwargs):
+    """
+    Run scan() on a single AIP as part of a scanall run.
+
+    Unexpected errors are logged rather than raised. Like scan failures
+    they are reported to the user, but they don't change the aggregate
+    status of the run, so the first value returned is False only if the
+    scan itself reported a failure. The second is whether the scan
+    completed, passing or failing, rather than erroring out.
+    """
+    try:
+        status = scan(aip_uuid, logger=logger, **kwargs)
+    except Exception as e:
+        logger.log(
+            ERROR_LOG_LEVEL,
+            f"Internal error encountered while scanning AIP {aip_uuid} ({type(e).__name__})",
+        )
+        return True, False
+    return bool(status), status is not None
+
+
+def _batches(iterable: Iterable[T], max_size: int, size: int = 1) -> Iterator[list[T]]:
+    """
+    Split an iterable into lists, starting with size items and doubling up
+    to max_size, so the first items of a slow stream aren't held back
+    waiting for a full batch.
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+        size = min(size * 2, max_size)
+
+
+def _concurrency(workers, adaptive_throttle):
+    if adaptive_throttle is None:
+        return workers
+    return min(workers, adaptive_throttle.concurrency)
+
+
+def _delay(throttle_time, adaptive_throttle):
+    if adaptive_throttle is None:
+        return throttle_time
+    return adaptive_throttle.delay
+
+
+def _scan_concurrently(
+    aips,
+    workers,
+    throttle_time,
+    scan_one,
+    scheduler,
+    adaptive_throttle=None,
+    budget=None,
+):
+    """
+    Call scan_one for every item of aips using a pool of worker threads.
+
+    Items are (aip, listed_at) pairs. At most `workers` scans are in
+    flight at any time, and the scheduler decides which item to start
+    next, subject to its per-location limits. The listing is only read
+    further when nothing already read can be started, and never more
+    than the scheduler's lookahead ahead of the scans. With an adaptive
+    throttle, its current concurrency and delay replace `workers` and
+    throttle_time as they change. Once the time budget is exhausted, no
+    more scans are started and the scans in flight are left to finish;
+    the items not scanned are left in the scheduler and aips. Returns
+    False if any of the scans reported a failure.
+    """
+    success = True
+    aips = iter(aips)
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while True:
+            while len(pending) < _concurrency(workers, adaptive_throttle):
+                if budget is not None and budget.exhausted():
+                    break
+                next_scan = scheduler.pop()
+                if next_scan is None:
+                    if exhausted or scheduler.full():
+                        break
+                    try:
+                        listed = next(aips)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    scheduler.push(listed, scheduling.location_of(listed[0]))
+                    continue
+                listed, location = next_scan
+                pending[executor.submit(scan_one, listed)] = location
+                delay = _delay(throttle_time, adaptive_throttle)
+                if delay:
+                    sleep(delay)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                scheduler.done(pending.pop(future))
+                if not future.result():
+                    success = False
+    return success
+
+
 def scanall(
     ss_url,
     ss_user,
@@ -222,6 +324,20 @@ def scanall(
     report_auth=(),
     throttle_time=0,
     force_local=False,
+    workers=1,
+    client=None,
+    max_listing_age=None,
+    location_limit=None,
+    location_limits=None,
+    adaptive_throttle=None,
+    resume=None,
+    order="listing",
+    budget=None,
+    shard=None,
+    queue=False,
+    lease_duration=work_queue.LEASE_DURATION,
+    report_batch_size=None,
+    report_batch_interval=BULK_INTERVAL,
 ):
     """
     Run a fixity scan on every AIP in a storage service instance.
@@ -230,48 +346,300 @@ def scanall(
     :param str ss_user: Storage service user to authenticate as
     :param str ss_key: API key of the storage service user
     :param Logger logger: Logger to print output.
-    :param str report_url: The base URL to a server to which the report will be POSTed after the scan completes. If absent, the report will not be transmitted.
+    :param str report_url: The base URL to a server to which the reports will be POSTed. They are queued in the database and posted in the background (see outbox.ReportOutbox), with the reports earlier runs couldn't post. If absent, the reports will not be transmitted.
     :param report_auth: Authentication for the report_url. Tupel of (user, password) for HTTP auth.
     :param int throttle_time: Time to wait between scans.
     :param bool force_local: If True, will request the Storage Service to perform a local fixity check, instead of using the Space's fixity (if available).
+    :param int workers: Number of AIPs to scan concurrently. With more than one worker, scans run in a thread pool and share the session through a lock.
+    :param HTTPClient client: Shared HTTP connections to reuse for every request.
+    :param float max_listing_age: AIPs are normally scanned without asking the storage service about them again, since they were just listed. If set, AIPs whose listing is at least this many seconds old are checked again first.
+    :param int location_limit: With several workers, the maximum number of scans in flight in any one storage location. If None, only the number of workers limits them.
+    :param dict location_limits: Maximum number of scans in flight for specific locations, by location UUID, overriding location_limit.
+    :param AdaptiveThrottle adaptive_throttle: If set, the time to wait between scans and the number of scans in flight (up to workers) follow this throttle instead of throttle_time. It must be fed the Storage Service's responses, e.g. as a response hook of client.
+    :param str resume: UUID of an unfinished session to continue, or checkpoints.LATEST for the most recent one. AIPs already scanned in that session are skipped. By default a new session is started. Progress is committed to the database as the scans complete.
+    :param str order: "listing" to scan AIPs in the order the storage service lists them, as the listing streams in. Otherwise the whole listing is read first, then with "stalest" the AIPs without reports are scanned first, followed by the AIPs whose latest report ended the longest ago, and with "largest" the AIPs expected to take longest to scan (by their last scan's duration or their size) are scanned first.
+    :param TimeBudget budget: If set, no new scans are started once the budget is exhausted. The scans in flight still finish, the AIPs left are counted, and BUDGET_EXHAUSTED is returned unless a scan failed; the session can be resumed later.
+    :param tuple shard: If set, an (index, count) pair: only the AIPs in this shard of count (see sharding.in_shard) are scanned, so that count hosts can share the work. The listing is filtered as it streams in. The shard is recorded in the session, and a resumed session keeps its shard.
+    :param bool queue: If True, the listed AIPs are first put in a work queue in the database, then claimed from it in batches, leased for lease_duration seconds. With resume, no listing is done: this process joins the workers of a queued session. Each AIP is scanned by only one worker and work is rebalanced as workers come and go.
+    :param float lease_duration: Seconds a claimed AIP stays leased to this worker without the lease being renewed.
+    :param int report_batch_size: If set, reports are sent to the bulk endpoint of the report service, up to this many per request, rather than one request per report.
+    :param float report_batch_interval: With report_batch_size, seconds reports wait for a full batch before being sent in a smaller one.
     """
     success = True
+    started = monotonic()
 
     # The same session ID will be used for every scan,
     # allowing every scan from one run to be identified.
-    session_id = str(uuid4())
-
     try:
-        aips = storage_service.get_all_aips(ss_url, ss_user, ss_key)
-    except storage_service.StorageServiceError as e:
+        scan_session, shard = _start_session(session, resume, shard, queue)
+    except ArgumentError as e:
         return e
-    count = len(aips)
-    for aip in aips:
+    session_id = scan_session.uuid
+    already_scanned = checkpoints.scanned_aips(session, scan_session)
+
+    # The listing is consumed as it streams in; remember if fetching a
+    # later page fails.
+    skipped = 0
+    listing_error = None
+
+    # Workers joining a queued session only work through its queue.
+    if not (queue and resume is not None):
         try:
-            scan_success = scan(
-                aip["uuid"],
-                ss_url,
-                ss_user,
-                ss_key,
-                session,
-                logger,
-                report_url=report_url,
-                report_auth=report_auth,
-                session_id=session_id,
-                force_local=force_local,
+            pages = storage_service.iter_aip_pages(
+                ss_url, ss_user, ss_key, client=client
             )
-            if not scan_success:
-                success = False
-        except Exception as e:
-            logger.log(
-                ERROR_LOG_LEVEL,
-                f"Internal error encountered while scanning AIP {aip['uuid']} ({type(e).__name__})",
+        except storage_service.StorageServiceError as e:
+            return e
+        if shard is not None:
+            pages = (
+                [aip for aip in page if sharding.in_shard(aip["uuid"], shard)]
+                for page in pages
             )
-        if throttle_time:
-            sleep(throttle_time)
+        listing = itertools.chain.from_iterable(pages)
+        sort = scheduling.listing_order(order, session)
+        if sort is not None:
+            listing = scheduling.reordered(listing, sort)
+            pages = _batches(
+                listing, work_queue.ENQUEUE_BATCH, work_queue.ENQUEUE_BATCH
+            )
+    lease_queue = None
+    enqueuer = None
+    if queue:
+        if resume is None:
+            # Queue the listing page by page while this worker scans.
+            enqueuer = work_queue.Enqueuer(session.get_bind(), scan_session, pages)
+        lease_queue = work_queue.LeaseQueue(
+            session, scan_session, lease_duration=lease_duration
+        )
+        batches = lease_queue.batches()
+    else:
+        batches = _batches(listing, storage_service.PRELOAD_BATCH)
+
+    session_lock = threading.Lock() if workers > 1 else nullcontext()
+    # AIPs of the batch being scanned that weren't handed out yet.
+    unhanded = 0
+
+    def listed_aips():
+        nonlocal skipped, listing_error, unhanded
+        try:
+            for batch in batches:
+                unscanned = [aip for aip in batch if aip["uuid"] not in already_scanned]
+                skipped += len(batch) - len(unscanned)
+                # Look up or add the AIPs of the batch all at once, rather
+                # than as each one is scanned.
+                with session_lock:
+                    aip_models = storage_service.load_aips(
+                        session, [aip["uuid"] for aip in unscanned]
+                    )
+                    # Don't stay idle in a transaction while the batch is
+                    # scanned.
+                    session.commit()
+                listed_at = monotonic()
+                unhanded = len(unscanned)
+                for aip in unscanned:
+                    unhanded -= 1
+                    yield aip, aip_models.get(aip["uuid"]), listed_at
+        except storage_service.StorageServiceError as e:
+            listing_error = e
+
+    aips = listed_aips()
+    scan_kwargs = {
+        "ss_url": ss_url,
+        "ss_user": ss_user,
+        "ss_key": ss_key,
+        "session": session,
+        "report_url": report_url,
+        "report_auth": report_auth,
+        "session_id": session_id,
+        "force_local": force_local,
+        "client": client,
+        "max_listing_age": max_listing_age,
+    }
+    if workers > 1:
+        scan_kwargs["session_lock"] = session_lock
+    writer = ReportWriter(
+        session.get_bind(),
+        scan_session,
+        # Other workers wait for the database while this one holds a
+        # transaction open, so commit after every scan.
+        every=1 if queue else checkpoints.COMMIT_EVERY,
+        queue=lease_queue,
+    )
+    scan_kwargs["writer"] = writer
+    # Scans don't wait for the report service: reports are queued with
+    # their checkpoints and posted in the background, along with those
+    # earlier runs couldn't post.
+    outbox = None
+    if report_url:
+        outbox = ReportOutbox(
+            session.get_bind(),
+            report_url,
+            report_auth=report_auth,
+            client=client,
+            logger=logger,
+            log_level=ERROR_LOG_LEVEL,
+            workers=workers,
+            bulk_size=report_batch_size,
+            bulk_interval=report_batch_interval,
+        )
+        scan_kwargs["outbox"] = outbox
+
+    # Sizes of the AIPs scanned, for the throughput: 0 for the scans that
+    # didn't complete, as no bytes were checked.
+    scanned_sizes = []
+
+    def scan_one(listed):
+        aip, aip_model, listed_at = listed
+        scan_started = monotonic()
+        result, completed = _scan_safely(
+            aip["uuid"],
+            logger,
+            listed_at=listed_at,
+            aip_model=aip_model,
+            **scan_kwargs,
+        )
+        writer.done(aip["uuid"])
+        scanned_sizes.append((aip.get("size") or 0) if completed else 0)
+        if budget is not None:
+            budget.record(monotonic() - scan_started)
+        return result
+
+    # AIPs listed but not scanned because the time budget ran out.
+    left = 0
+    with (
+        outbox or nullcontext(),
+        lease_queue or nullcontext(),
+        enqueuer or nullcontext(),
+        writer,
+    ):
+        if workers > 1:
+            scheduler = scheduling.LocationScheduler(
+                location_limit,
+                location_limits,
+                # Don't hold leases on AIPs other workers could be scanning.
+                lookahead=workers if queue else scheduling.LOOKAHEAD,
+                keep_order=order != "listing",
+            )
+            success = _scan_concurrently(
+                aips,
+                workers,
+                throttle_time,
+                scan_one,
+                scheduler,
+                adaptive_throttle,
+                budget,
+            )
+            if budget is not None and budget.ran_out:
+                left = len(scheduler)
+        else:
+            for listed in aips:
+                if budget is not None and budget.exhausted():
+                    left = 1
+                    break
+                if not scan_one(listed):
+                    success = False
+                delay = _delay(throttle_time, adaptive_throttle)
+                if delay:
+                    sleep(delay)
+    if enqueuer is not None and enqueuer.error is not None:
+        if not isinstance(enqueuer.error, storage_service.StorageServiceError):
+            raise enqueuer.error
+        listing_error = enqueuer.error
+    if budget is not None and budget.ran_out:
+        if lease_queue is not None:
+            # Leave the rest of the queue to the other workers, and count
+            # it rather than claiming it.
+            lease_queue.release(session)
+            session.commit()
+            left = lease_queue.remaining(session)
+        else:
+            # Count the rest of the listing without looking up its AIPs.
+            left += unhanded
+            try:
+                for batch in batches:
+                    left += sum(
+                        1 for aip in batch if aip["uuid"] not in already_scanned
+                    )
+            except storage_service.StorageServiceError as e:
+                listing_error = e
+
+    if listing_error is None and not left:
+        scan_session.ended = utils.utcnow()
+        session.commit()
+    return _scanall_summary(
+        logger,
+        scanned=len(scanned_sizes),
+        scanned_bytes=sum(scanned_sizes),
+        elapsed=monotonic() - started,
+        skipped=skipped,
+        left=left,
+        session_id=session_id,
+        listing_error=listing_error,
+        success=success,
+    )
 
-    if count > 0:
-        logger.log(SUCCESS_LOG_LEVEL, f"Successfully scanned {count} AIPs")
+
+def _start_session(session, resume, shard, queued=False):
+    """
+    Return the ScanSession of a scanall run and the shard it scans.
+
+    A resumed session keeps the shard it was started with; asking for a
+    different one, or for a session that can't be resumed, raises an
+    ArgumentError. With queued, only a session with a work queue can be
+    resumed.
+    """
+    scan_session = checkpoints.start_session(session, resume, shard, queued)
+    if scan_session is None:
+        raise ArgumentError(f"No unfinished scanall session to resume ({resume})")
+    if resume is None:
+        return scan_session, shard
+    session_shard = checkpoints.session_shard(scan_session)
+    if shard is not None and shard != session_shard:
+        raise ArgumentError(
+            f"Session {scan_session.uuid} can't be resumed with a different shard"
+        )
+    return scan_session, session_shard
+
+
+def _scanall_summary(
+    logger,
+    scanned,
+    scanned_bytes,
+    elapsed,
+    skipped,
+    left,
+    session_id,
+    listing_error,
+    success,
+):
+    """
+    Log the outcome of a scanall run and return its status.
+
+    Throughput is given in AIPs per second over the whole run, and in bytes
+    (as listed by the storage service) of the scans that completed per
+    second, so AIPs that couldn't be scanned don't inflate it.
+    """
+    if scanned > 0:
+        logger.log(SUCCESS_LOG_LEVEL, f"Successfully scanned {scanned} AIPs")
+        elapsed = max(elapsed, 1e-6)
+        logger.log(
+            SUCCESS_LOG_LEVEL,
+            f"Throughput: {scanned / elapsed:.2f} AIPs/s, {scanned_bytes / elapsed:.0f} bytes/s",
+        )
+    if skipped > 0:
+        logger.log(
+            SUCCESS_LOG_LEVEL,
+            f"Skipped {skipped} AIPs already scanned in session {session_id}",
+        )
+    if left > 0:
+        logger.log(
+            SUCCESS_LOG_LEVEL,
+            f"Time budget exhausted with {left} AIPs left to scan; continue with --resume {session_id}",
+        )
+    if listing_error is not None:
+        return listing_error
+    if left > 0 and success:
+        return BUDGET_EXHAUSTED
     return success
 
 
@@ -306,11 +674,77 @@ def get_handler(stream, timestamps, log_level=None):
     return handler
 
 
-def main(
-    argv: list[str] | None = None,
+def _time_budget(args):
+    """
+    Return the TimeBudget set by --max-duration and --deadline, the
+    earliest one winning, or None if neither was given.
+    """
+    time_left = []
+    if args.max_duration is not None:
+        time_left.append(args.max_duration)
+    if args.deadline is not None:
+        deadline = args.deadline.astimezone(timezone.utc)
+        time_left.append((deadline - utils.utcnow()).total_seconds())
+    if not time_left:
+        return None
+    return scheduling.TimeBudget(monotonic() + min(time_left))
+
+
+def _run_async(
+    args, session, logger, report_url, auth, throttle_time=0, adaptive_throttle=None
+):
+    """
+    Run the scan or scanall command with the asyncio engine.
+    """
+    import asyncio
+
+    from . import aio
+
+    if args.command == "scanall":
+        coroutine = aio.scanall(
+            args.ss_url,
+            args.ss_user,
+            args.ss_key,
+            session,
+            logger,
+            report_url=report_url,
+            report_auth=auth,
+            throttle_time=throttle_time,
+            force_local=args.force_local,
+            workers=args.workers,
+            pool_size=args.pool_size,
+            max_listing_age=args.recheck_after,
+            location_limit=args.location_limit,
+            location_limits=args.location_limits,
+            adaptive_throttle=adaptive_throttle,
+            resume=args.resume,
+            order=args.order,
+            budget=_time_budget(args),
+            shard=args.shard,
+        )
+    else:
+        coroutine = aio.scan_single(
+            args.aip,
+            args.ss_url,
+            args.ss_user,
+            args.ss_key,
+            session,
+            logger,
+            report_url=report_url,
+            report_auth=auth,
+            force_local=args.force_local,
+        )
+    return asyncio.run(coroutine)
+
+
+def run(
+    args: Namespace,
     logger: logging.Logger | None = None,
     stream: TextIO | None = None,
 ) -> int | bool | type[Exception] | None:
+    """
+    Run the command of parsed and validated arguments; see cli.main.
+    """
     if logger is None:
         logger = get_logger()
     if stream is None:
@@ -318,16 +752,6 @@ def main(
 
     success = 0
 
-    try:
-        args = parse_arguments(argv)
-    except ArgumentError as e:
-        return e
-
-    try:
-        fetch_environment_variables(args)
-    except ArgumentError as e:
-        return e
-
     success_stream = io.StringIO()
     error_stream = io.StringIO()
     all_stream = io.StringIO()
@@ -336,6 +760,24 @@ def main(
     logger.addHandler(get_handler(all_stream, args.timestamps))
 
     session = Session()
+    client = HTTPClient(
+        args.ss_url,
+        report_url=args.report_url if ("report_url" in args) else None,
+        ss_pool_size=args.pool_size,
+        report_pool_size=args.pool_size,
+    )
+
+    adaptive_throttle = None
+    throttle_time = args.throttle
+    if args.throttle == "auto":
+        adaptive_throttle = AdaptiveThrottle(
+            min_delay=args.throttle_min,
+            max_delay=args.throttle_max,
+            max_concurrency=args.workers,
+        )
+        client.add_response_hook(adaptive_throttle.response_hook)
+        client.add_error_hook(adaptive_throttle.error_hook)
+        throttle_time = 0
 
     status = False
 
@@ -347,7 +789,22 @@ def main(
     try:
         report_url = args.report_url if ("report_url" in args) else None
 
-        if args.command == "scanall":
+        if args.engine == "async":
+            status = _run_async(
+                args,
+                session,
+                logger,
+                report_url,
+                auth,
+                throttle_time=throttle_time,
+                adaptive_throttle=adaptive_throttle,
+            )
+        elif args.command in ("scanall", "work"):
+            # Workers join a queued scanall session.
+            if args.command == "work":
+                queue, resume = True, args.aip or checkpoints.LATEST
+            else:
+                queue, resume = args.queue, args.resume
             status = scanall(
                 args.ss_url,
                 args.ss_user,
@@ -356,8 +813,22 @@ def main(
                 logger,
                 report_url=report_url,
                 report_auth=auth,
-                throttle_time=args.throttle,
+                throttle_time=throttle_time,
                 force_local=args.force_local,
+                workers=args.workers,
+                client=client,
+                max_listing_age=args.recheck_after,
+                location_limit=args.location_limit,
+                location_limits=args.location_limits,
+                adaptive_throttle=adaptive_throttle,
+                resume=resume,
+                order=args.order,
+                budget=_time_budget(args),
+                shard=args.shard,
+                queue=queue,
+                lease_duration=args.lease_duration,
+                report_batch_size=args.report_batch_size,
+                report_batch_interval=args.report_batch_interval,
             )
         elif args.command == "scan":
             session_id = str(uuid4())
@@ -372,6 +843,7 @@ def main(
                 report_auth=auth,
                 session_id=session_id,
                 force_local=args.force_local,
+                client=client,
             )
         else:
             return Exception(f'Error: "{args.command}" is not a valid command.')
@@ -384,6 +856,7 @@ def main(
         return e
     finally:
         session.close()
+        client.close()
 
     if status is True:
         success = 0
@@ -0,0 +1,90 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+
+
+class HTTPClient:
+    """
+    Keep-alive HTTP connections shared by every request in a run.
+
+    Owns a requests.Session with one connection pool for the Storage
+    Service and one for the report service, so TCP and TLS handshakes are
+    paid once per connection rather than once per request. Pools block
+    when all of their connections are in use, which bounds the number of
+    connections opened to each host.
+
+    ss_url may be None for commands that only use the report service.
+
+    Instances can be passed as the client argument of the functions in
+    storage_service and reporting; when no client is passed those
+    functions fall back to one-off requests.
+    """
+
+    def __init__(
+        self,
+        ss_url,
+        report_url=None,
+        ss_pool_size=DEFAULT_POOL_SIZE,
+        report_pool_size=DEFAULT_POOL_SIZE,
+    ):
+        self.session = requests.Session()
+        self._error_hooks = []
+        # Requests mounts adapters by URL prefix, picking the longest match,
+        # so each service gets its own pool; anything else (e.g. redirects
+        # to another host) goes through the session's default adapters.
+        if ss_url:
+            self.session.mount(ss_url, self._adapter(ss_pool_size))
+        if report_url:
+            self.session.mount(report_url, self._adapter(report_pool_size))
+
+    @staticmethod
+    def _adapter(pool_size):
+        return HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+    def add_response_hook(self, hook):
+        """
+        Call hook(response) after every response, as a requests hook.
+        """
+        self.session.hooks["response"].append(hook)
+
+    def add_error_hook(self, hook):
+        """
+        Call hook(url, error) for every request that fails without a
+        response, e.g. on a connection error or a timeout, before the
+        requests.RequestException is raised.
+        """
+        self._error_hooks.append(hook)
+
+    def get(self, url, **kwargs):
+        return self._request(self.session.get, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request(self.session.post, url, **kwargs)
+
+    def _request(self, send, url, **kwargs):
+        try:
+            return send(url, **kwargs)
+        except requests.RequestException as e:
+            for hook in self._error_hooks:
+                hook(url, e)
+            raise
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def http_for(client):
+    """
+    Return the object to send requests through: the shared HTTPClient if
+    one was passed, or the requests module for one-off connections.
+    """
+    if client is None:
+        return requests
+    return client
@@ -1,21 +1,86 @@
+import json
 import os
+import zlib
 
 from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import Date
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import String
+from sqlalchemy import Text
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import bindparam
+from sqlalchemy import case
 from sqlalchemy import create_engine
+from sqlalchemy import delete
+from sqlalchemy import event
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import inspect
+from sqlalchemy import literal
+from sqlalchemy import make_url
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import union_all
+from sqlalchemy import update
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import backref
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
 
+from . import utils
+
 db_path = os.path.join(os.path.dirname(__file__), "fixity.db")
-engine = create_engine(f"sqlite:///{db_path}", echo=False)
+DEFAULT_DATABASE_URL = f"sqlite:///{db_path}"
+
+# Environment variables configuring the database, overridden by the
+# arguments of configure().
+DATABASE_URL_VARIABLE = "FIXITY_DATABASE_URL"
+POOL_SIZE_VARIABLE = "FIXITY_DATABASE_POOL_SIZE"
+MAX_OVERFLOW_VARIABLE = "FIXITY_DATABASE_MAX_OVERFLOW"
+
+# Kinds of file failures listed in reports.
+FAILURE_KINDS = ("changed", "missing", "untracked")
+
+# zlib compression level of reports.
+ZLIB_LEVEL = 6
+
+# Number of reports converted per transaction by compact_reports().
+COMPACT_BATCH = 1000
+
+# Seconds a SQLite connection waits for another process's write to end.
+SQLITE_TIMEOUT = 30
+
+# Pragmas set on every SQLite connection.
+SQLITE_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL")
 
-Session = sessionmaker(bind=engine)
+
+class _Sessionmaker(sessionmaker):
+    """
+    A sessionmaker connecting to the database set by the environment the
+    first time a session is made, unless configure() was called first, so
+    importing the models doesn't touch the database.
+    """
+
+    def __call__(self, **local_kw):
+        if engine is None:
+            configure()
+        return super().__call__(**local_kw)
+
+
+# Objects are not expired on commit: scanall commits periodically while
+# other scans are still using the AIPs they loaded. Nor are they flushed
+# before every query, so the reports of the scans between two commits are
+# flushed together, in one batched INSERT (sent as multi-row INSERTs on
+# PostgreSQL).
+Session = _Sessionmaker(expire_on_commit=False, autoflush=False)
+engine = None
 
 
 class Base(DeclarativeBase):
@@ -25,20 +90,767 @@ class Base(DeclarativeBase):
 class AIP(Base):
     __tablename__ = "aips"
     id = Column(Integer, primary_key=True)
-    uuid = Column(String(36), nullable=False)
+    uuid = Column(String(36), nullable=False, unique=True, index=True)
 
 
 class Report(Base):
+    """
+    The result of scanning an AIP.
+
+    The JSON report is stored compressed, and read and written as a string
+    through the report attribute. Setting it also fills in the columns
+    summarizing it (message, started, finished and the number of files
+    changed, missing and untracked), which can be queried without reading
+    the report. Reports saved by earlier versions, as plain JSON in the
+    legacy column, are moved to compressed_report by compact_reports().
+
+    The files listed as failures in a new report are saved to the
+    file_failures table along with it (see FileFailure).
+    """
+
     __tablename__ = "reports"
+    # Finds an AIP's reports, and its latest ones, without a table scan.
+    __table_args__ = (Index("ix_reports_aip_id_ended", "aip_id", "ended"),)
     id = Column(Integer, primary_key=True)
     aip_id = Column(Integer, ForeignKey("aips.id"))
     begun = Column(DateTime)
     ended = Column(DateTime)
     success = Column(Boolean)
     posted = Column(Boolean)
-    report = Column(String(1000))
+    legacy_report = Column("report", Text)
+    compressed_report = Column(LargeBinary)
+    message = Column(Text)
+    started = Column(Integer)
+    finished = Column(Integer)
+    changed_count = Column(Integer)
+    missing_count = Column(Integer)
+    untracked_count = Column(Integer)
 
     aip = relationship("AIP", backref=backref("reports", order_by=id))
 
+    # (kind, path) pairs of the files failing in a report that isn't saved
+    # yet.
+    pending_failures = None
+
+    # The ScanResult the report was set from, or parsed from when read.
+    _result = None
+
+    @property
+    def report(self):
+        if self._result is not None:
+            return self._result.text
+        if self.compressed_report is not None:
+            return zlib.decompress(self.compressed_report).decode("utf-8")
+        return self.legacy_report
+
+    @report.setter
+    def report(self, value):
+        """
+        Set the report from a JSON string, or from a ScanResult, whose
+        parsed report is then used as it is, and kept as result.
+        """
+        if isinstance(value, ScanResult):
+            result = value
+            value = result.text
+        else:
+            result = None
+        data = parse_report(value) if result is None else result.data
+        for key, column_value in compact_report(value, data).items():
+            setattr(self, key, column_value)
+        self.pending_failures = file_failures(data)
+        self._result = result
+
+    @property
+    def result(self):
+        """
+        The report as a ScanResult, parsed from the JSON string at most
+        once.
+        """
+        if self._result is None:
+            self._result = ScanResult.parse(self.report)
+        return self._result
+
+
+class ScanResult:
+    """
+    The JSON report of a scan, parsed (data, a dict, or None if the report
+    isn't a JSON object) and as a string (text), so that neither is made
+    from the other more than once as the report is logged, saved and
+    posted. The string is only made when first asked for.
+    """
+
+    __slots__ = ("data", "_text")
+
+    def __init__(self, data, text=None):
+        self.data = data
+        self._text = text
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Return the ScanResult of a JSON report string.
+        """
+        return cls(parse_report(text), text)
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = json.dumps(self.data)
+        return self._text
+
+    @property
+    def message(self):
+        return self.data["message"]
+
+    def text_with(self, **fields):
+        """
+        Return the report as a JSON string, with fields added to it.
+
+        The fields are appended to the text of the report when it is a
+        JSON object without them, rather than serializing it again. A
+        report that isn't a JSON object is returned as it is.
+        """
+        if not fields or self.data is None:
+            return self.text
+        text = self.text.rstrip()
+        if (
+            not self.data
+            or not text.endswith("}")
+            or any(key in self.data for key in fields)
+        ):
+            return json.dumps({**self.data, **fields})
+        added = ", ".join(
+            f"{json.dumps(key)}: {json.dumps(value)}" for key, value in fields.items()
+        )
+        return f"{text[:-1]}, {added}}}"
+
+
+class FileFailure(Base):
+    """
+    A file listed as changed, missing or untracked (its kind) in a report.
+
+    Indexed by path, so the AIPs with failures in a given directory can
+    be found without reading reports.
+    """
+
+    __tablename__ = "file_failures"
+    __table_args__ = (
+        Index("ix_file_failures_path_kind", "path", "kind"),
+        Index("ix_file_failures_kind_path", "kind", "path"),
+    )
+    id = Column(Integer, primary_key=True)
+    report_id = Column(Integer, ForeignKey("reports.id"), nullable=False, index=True)
+    aip_id = Column(Integer, ForeignKey("aips.id"), index=True)
+    kind = Column(String(16), nullable=False)
+    path = Column(Text, nullable=False)
+
+
+class ReportRollup(Base):
+    """
+    The successful scans of an AIP in a month, whose reports were removed
+    by `fixity compact` (see retention): how many there were, and when the
+    first and last of them ended. month is the first day of the month.
+    """
+
+    __tablename__ = "report_rollups"
+    __table_args__ = (UniqueConstraint("aip_id", "month"),)
+    id = Column(Integer, primary_key=True)
+    aip_id = Column(Integer, ForeignKey("aips.id"), nullable=False)
+    month = Column(Date, nullable=False)
+    success_count = Column(Integer, nullable=False, default=0)
+    first_ended = Column(DateTime)
+    last_ended = Column(DateTime)
+
+
+class ReportPost(Base):
+    """
+    A report waiting to be posted to the report service (see outbox), for
+    the scanall session session_uuid if it belongs to one.
+
+    next_attempt is when to post it; while a process posts it, it holds
+    a claim on it (claimed_by) until next_attempt.
+    """
+
+    __tablename__ = "report_posts"
+    id = Column(Integer, primary_key=True)
+    report_id = Column(Integer, ForeignKey("reports.id"), nullable=False, unique=True)
+    aip_uuid = Column(String(36), nullable=False)
+    session_uuid = Column(String(36))
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=False, index=True)
+    claimed_by = Column(String(255))
+    last_error = Column(Text)
+
+    report = relationship("Report", backref=backref("post", uselist=False))
+
+
+class LatestStatus(Base):
+    """
+    The outcome of the latest scan of an AIP, updated as its reports are
+    saved, so the AIPs failing or not verified lately can be found without
+    reading reports.
+
+    last_result is the success of the latest report, None if the scan
+    couldn't be made. last_success is when the latest successful scan
+    ended, and consecutive_failures the number of failed scans since
+    then; scans that couldn't be made don't count. Databases created by
+    earlier versions are filled in by rebuild_latest_status().
+    """
+
+    __tablename__ = "latest_status"
+    __table_args__ = (
+        Index(
+            "ix_latest_status_last_result_last_scanned", "last_result", "last_scanned"
+        ),
+    )
+    aip_id = Column(Integer, ForeignKey("aips.id"), primary_key=True)
+    last_scanned = Column(DateTime)
+    last_result = Column(Boolean)
+    last_success = Column(DateTime, index=True)
+    consecutive_failures = Column(Integer, nullable=False, default=0)
+
+    aip = relationship("AIP", backref=backref("latest_status", uselist=False))
+
+
+def parse_report(report):
+    """
+    Return a JSON report string as a dict, or None if it isn't a JSON
+    object.
+    """
+    if report is None:
+        return None
+    try:
+        data = json.loads(report)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def file_failures(data):
+    """
+    Return the files failing in a report parsed by parse_report(), as a
+    list of (kind, path) pairs.
+    """
+    failures = data.get("failures") if data else None
+    if not isinstance(failures, dict) or not isinstance(failures.get("files"), dict):
+        return []
+    return [
+        (kind, entry["path"])
+        for kind in FAILURE_KINDS
+        for entry in failures["files"].get(kind) or []
+        if isinstance(entry, dict) and entry.get("path")
+    ]
+
+
+def compact_report(report, data):
+    """
+    Return the values of the columns storing a JSON report string, parsed
+    as data by parse_report(), in the compact format, as a dict mapping
+    Report attribute names to values.
+    """
+    values = {
+        "legacy_report": None,
+        "compressed_report": None,
+        "message": None,
+        "started": None,
+        "finished": None,
+        "changed_count": None,
+        "missing_count": None,
+        "untracked_count": None,
+    }
+    if report is None:
+        return values
+    values["compressed_report"] = zlib.compress(report.encode("utf-8"), ZLIB_LEVEL)
+    if data is None:
+        return values
+    values["message"] = data.get("message")
+    values["started"] = data.get("started")
+    values["finished"] = data.get("finished")
+    failures = data.get("failures")
+    if isinstance(failures, dict) and isinstance(failures.get("files"), dict):
+        for kind in FAILURE_KINDS:
+            values[f"{kind}_count"] = len(failures["files"].get(kind) or [])
+    return values
+
+
+class ScanSession(Base):
+    """
+    A scanall run, identified by the session UUID sent with its reports.
+
+    ended stays empty until every listed AIP was scanned, so an
+    interrupted run can be resumed. For a run with a work queue, enqueued
+    is when putting the listed AIPs in the queue stopped: until then,
+    workers finding the queue empty wait for more AIPs rather than end
+    the run.
+    """
+
+    __tablename__ = "scan_sessions"
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String(36), nullable=False, unique=True)
+    started = Column(DateTime)
+    ended = Column(DateTime)
+    # The shard of the AIPs scanned by the run, if it was sharded.
+    shard_index = Column(Integer)
+    shard_count = Column(Integer)
+    enqueued = Column(DateTime)
+
+
+class ScannedAIP(Base):
+    """
+    Checkpoint recording that an AIP was scanned in a scanall run.
+    """
+
+    __tablename__ = "scanned_aips"
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey("scan_sessions.id"), index=True)
+    aip_uuid = Column(String(36), nullable=False)
+
+    scan_session = relationship("ScanSession", backref="scanned_aips")
+
+
+class QueuedAIP(Base):
+    """
+    An AIP waiting to be scanned in a scanall run shared by several
+    workers through the work queue.
+
+    A worker claiming the AIP sets lease_owner and lease_expires; the AIP
+    goes back to the pool if the lease expires before it is done.
+    """
+
+    __tablename__ = "queued_aips"
+    __table_args__ = (UniqueConstraint("session_id", "aip_uuid"),)
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey("scan_sessions.id"), nullable=False)
+    aip_uuid = Column(String(36), nullable=False)
+    current_location = Column(String(255))
+    lease_owner = Column(String(255))
+    lease_expires = Column(DateTime)
+    done = Column(Boolean, nullable=False, default=False)
+
+
+def add_missing_columns(engine):
+    """
+    Add columns declared on the models but missing from existing tables.
+
+    create_all() only creates missing tables, so this brings databases
+    created by earlier versions up to date. New columns must be nullable.
+    Returns the names of the columns added, as "table.column" strings.
+    """
+    added = set()
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+                added.add(f"{table.name}.{column.name}")
+    return added
+
+
+def compact_reports(engine, batch_size=COMPACT_BATCH):
+    """
+    Move the reports saved by earlier versions as plain JSON to the
+    compact format (see Report), batch_size reports per transaction.
+    Returns the number of reports moved.
+
+    The space freed is reused for new rows; SQLite databases only shrink
+    once vacuumed.
+    """
+    moved = 0
+    session = Session(bind=engine)
+    try:
+        while True:
+            rows = session.execute(
+                select(Report.id, Report.legacy_report)
+                .where(Report.legacy_report.is_not(None))
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                return moved
+            session.execute(
+                update(Report),
+                [
+                    {"id": id, **compact_report(report, parse_report(report))}
+                    for id, report in rows
+                ],
+            )
+            session.commit()
+            moved += len(rows)
+    finally:
+        session.close()
+
+
+@event.listens_for(Session, "after_flush")
+def _save_file_failures(session, flush_context):
+    # Reports have their IDs, and those of their AIPs, once flushed: add
+    # their file failures with one multi-row INSERT per flush.
+    rows = []
+    for report in session.new:
+        if isinstance(report, Report) and report.pending_failures:
+            rows.extend(
+                {
+                    "report_id": report.id,
+                    "aip_id": report.aip_id,
+                    "kind": kind,
+                    "path": path,
+                }
+                for kind, path in report.pending_failures
+            )
+            report.pending_failures = None
+    if rows:
+        session.connection().execute(insert(FileFailure.__table__), rows)
+
+
+# Statements updating the latest status of the AIPs of new reports, run
+# with one set of parameters per report, in the order the scans ended. An
+# AIP's status is created empty if it has none, then updated unless it is
+# already from a later scan. Reports that aren't linked to a known AIP,
+# such as those of scans failing before their AIP was looked up, are left
+# out.
+_create_latest_status = insert(LatestStatus.__table__).from_select(
+    ["aip_id", "consecutive_failures"],
+    select(AIP.id, literal(0)).where(
+        AIP.id == bindparam("status_aip_id", type_=Integer),
+        ~exists().where(LatestStatus.aip_id == AIP.id),
+    ),
+)
+_update_latest_status = (
+    update(LatestStatus.__table__)
+    .where(
+        LatestStatus.aip_id == bindparam("status_aip_id"),
+        or_(
+            LatestStatus.last_scanned.is_(None),
+            LatestStatus.last_scanned <= bindparam("ended"),
+        ),
+    )
+    .values(
+        last_scanned=bindparam("ended"),
+        last_result=bindparam("success"),
+        last_success=func.coalesce(
+            bindparam("success_ended", type_=DateTime), LatestStatus.last_success
+        ),
+        consecutive_failures=case(
+            (bindparam("succeeded", type_=Boolean), 0),
+            else_=LatestStatus.consecutive_failures
+            + bindparam("failed", type_=Integer),
+        ),
+    )
+)
+
+
+@event.listens_for(Session, "after_flush")
+def _save_latest_status(session, flush_context):
+    reports = sorted(
+        (
+            report
+            for report in session.new
+            if isinstance(report, Report)
+            and report.aip_id is not None
+            and report.ended is not None
+        ),
+        key=lambda report: (report.ended, report.id),
+    )
+    if not reports:
+        return
+    rows = [
+        {
+            "status_aip_id": report.aip_id,
+            "ended": report.ended,
+            "success": report.success,
+            "success_ended": report.ended if report.success else None,
+            "succeeded": bool(report.success),
+            "failed": int(report.success is False),
+        }
+        for report in reports
+    ]
+    connection = session.connection()
+    connection.execute(_create_latest_status, rows)
+    connection.execute(_update_latest_status, rows)
+
+
+def rebuild_latest_status(engine, batch_size=COMPACT_BATCH):
+    """
+    Compute the latest status of every AIP from its reports, replacing
+    the one recorded, batch_size AIPs per transaction. The rollups of
+    reports removed by `fixity compact` count as successful scans.
+    Returns the number of AIPs with a status.
+    """
+    rebuilt = 0
+    last_aip_id = 0
+    session = Session(bind=engine)
+    try:
+        while True:
+            aip_ids = session.scalars(
+                select(AIP.id)
+                .where(AIP.id > last_aip_id)
+                .order_by(AIP.id)
+                .limit(batch_size)
+            ).all()
+            if not aip_ids:
+                return rebuilt
+            rows = _latest_status_rows(session, aip_ids)
+            session.execute(
+                delete(LatestStatus).where(LatestStatus.aip_id.in_(aip_ids))
+            )
+            if rows:
+                session.execute(insert(LatestStatus.__table__), rows)
+            session.commit()
+            rebuilt += len(rows)
+            last_aip_id = aip_ids[-1]
+    finally:
+        session.close()
+
+
+def _latest_status_rows(session, aip_ids):
+    scanned = Report.ended.is_not(None)
+    rank = (
+        func.row_number()
+        .over(
+            partition_by=Report.aip_id, order_by=(Report.ended.desc(), Report.id.desc())
+        )
+        .label("rank")
+    )
+    ranked = (
+        select(Report.aip_id, Report.ended, Report.success, rank)
+        .where(Report.aip_id.in_(aip_ids), scanned)
+        .subquery()
+    )
+    latest = session.execute(
+        select(ranked.c.aip_id, ranked.c.ended, ranked.c.success).where(
+            ranked.c.rank == 1
+        )
+    ).all()
+    # When each AIP last scanned successfully, by its reports or rollups.
+    successes = union_all(
+        select(Report.aip_id.label("aip_id"), Report.ended.label("ended")).where(
+            Report.aip_id.in_(aip_ids), scanned, Report.success.is_(True)
+        ),
+        select(ReportRollup.aip_id, ReportRollup.last_ended).where(
+            ReportRollup.aip_id.in_(aip_ids)
+        ),
+    ).subquery()
+    last_successes = (
+        select(successes.c.aip_id, func.max(successes.c.ended).label("ended"))
+        .group_by(successes.c.aip_id)
+        .subquery()
+    )
+    last_success = dict(
+        session.execute(select(last_successes.c.aip_id, last_successes.c.ended)).all()
+    )
+    consecutive_failures = dict(
+        session.execute(
+            select(Report.aip_id, func.count(Report.id))
+            .outerjoin(last_successes, last_successes.c.aip_id == Report.aip_id)
+            .where(
+                Report.aip_id.in_(aip_ids),
+                scanned,
+                Report.success.is_(False),
+                or_(
+                    last_successes.c.ended.is_(None),
+                    Report.ended > last_successes.c.ended,
+                ),
+            )
+            .group_by(Report.aip_id)
+        ).all()
+    )
+    return [
+        {
+            "aip_id": aip_id,
+            "last_scanned": ended,
+            "last_result": success,
+            "last_success": last_success.get(aip_id),
+            "consecutive_failures": consecutive_failures.get(aip_id, 0),
+        }
+        for aip_id, ended, success in latest
+    ]
+
+
+def queue_unposted_reports(engine):
+    """
+    Queue the reports that earlier versions failed to post to the report
+    service (see ReportPost). Returns the number of reports queued.
+    """
+    with engine.begin() as connection:
+        result = connection.execute(
+            insert(ReportPost.__table__).from_select(
+                ["report_id", "aip_uuid", "attempts", "next_attempt"],
+                select(Report.id, AIP.uuid, literal(0), literal(utils.utcnow()))
+                .join(AIP, Report.aip_id == AIP.id)
+                .where(Report.posted.is_(False), Report.success.is_not(None)),
+            )
+        )
+    return result.rowcount
+
+
+def index_file_failures(engine, batch_size=COMPACT_BATCH):
+    """
+    Save the file failures of reports saved before the file_failures table
+    existed, batch_size reports per transaction. Returns the number of
+    failures saved.
+    """
+    saved = 0
+    last_id = 0
+    failing = or_(
+        Report.changed_count > 0, Report.missing_count > 0, Report.untracked_count > 0
+    )
+    session = Session(bind=engine)
+    try:
+        while True:
+            reports = session.scalars(
+                select(Report)
+                .where(Report.id > last_id, failing)
+                .order_by(Report.id)
+                .limit(batch_size)
+            ).all()
+            if not reports:
+                return saved
+            rows = [
+                {
+                    "report_id": report.id,
+                    "aip_id": report.aip_id,
+                    "kind": kind,
+                    "path": path,
+                }
+                for report in reports
+                for kind, path in file_failures(parse_report(report.report))
+            ]
+            if rows:
+                session.execute(insert(FileFailure.__table__), rows)
+            session.commit()
+            session.expunge_all()
+            saved += len(rows)
+            last_id = reports[-1].id
+    finally:
+        session.close()
+
+
+def add_missing_indexes(engine):
+    """
+    Create indexes declared on the models but missing from existing tables.
+
+    Like add_missing_columns(), this brings databases created by earlier
+    versions up to date. Those could record an AIP more than once, so
+    duplicate AIPs are merged before the unique index on their UUID is
+    created.
+    """
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if table is AIP.__table__ and index.unique:
+                    merge_duplicate_aips(connection)
+                index.create(connection)
+
+
+def merge_duplicate_aips(connection):
+    """
+    Merge the AIPs recorded more than once into the first of their rows,
+    which gets the reports of the others.
+    """
+    duplicates = connection.execute(
+        select(AIP.uuid, func.min(AIP.id))
+        .group_by(AIP.uuid)
+        .having(func.count(AIP.id) > 1)
+    ).all()
+    for uuid, first_id in duplicates:
+        others = select(AIP.id).where(AIP.uuid == uuid, AIP.id != first_id)
+        connection.execute(
+            update(Report)
+            .where(Report.aip_id.in_(others.scalar_subquery()))
+            .values(aip_id=first_id)
+        )
+        connection.execute(delete(AIP).where(AIP.uuid == uuid, AIP.id != first_id))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # In WAL mode readers don't block the writer (e.g. the report writer
+    # while workers claim AIPs) nor the other way round, and with
+    # synchronous=NORMAL commits don't wait for the disk, at the risk of
+    # losing the last transactions (but not corrupting the database) on a
+    # power loss.
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+def configure(url=None, pool_size=None, max_overflow=None):
+    """
+    Connect Session to a database, creating or upgrading its tables.
+
+    url is an SQLAlchemy database URL, e.g. "postgresql+psycopg://user:
+    password@host/fixity". Arguments that are None are read from the
+    environment variables above, and the URL defaults to a SQLite file in
+    the package directory. pool_size and max_overflow set the size of the
+    connection pool of client-server databases such as PostgreSQL, whose
+    connections are checked before use so ones dropped by the server are
+    replaced. Returns the new engine.
+    """
+    global engine
+
+    url = make_url(url or os.environ.get(DATABASE_URL_VARIABLE) or DEFAULT_DATABASE_URL)
+    if pool_size is None and POOL_SIZE_VARIABLE in os.environ:
+        pool_size = int(os.environ[POOL_SIZE_VARIABLE])
+    if max_overflow is None and MAX_OVERFLOW_VARIABLE in os.environ:
+        max_overflow = int(os.environ[MAX_OVERFLOW_VARIABLE])
+
+    kwargs = {}
+    if url.get_backend_name() == "sqlite":
+        kwargs["connect_args"] = {"timeout": SQLITE_TIMEOUT}
+    else:
+        kwargs["pool_pre_ping"] = True
+        if pool_size is not None:
+            kwargs["pool_size"] = pool_size
+        if max_overflow is not None:
+            kwargs["max_overflow"] = max_overflow
+    new_engine = create_engine(url, **kwargs)
+    if url.get_backend_name() == "sqlite":
+        event.listen(new_engine, "connect", _set_sqlite_pragmas)
 
-Base.metadata.create_all(engine)
+    inspector = inspect(new_engine)
+    upgrading = inspector.has_table("reports")
+    new_tables = {
+        table.name
+        for table in Base.metadata.sorted_tables
+        if not inspector.has_table(table.name)
+    }
+    Base.metadata.create_all(new_engine)
+    added = add_missing_columns(new_engine)
+    add_missing_indexes(new_engine)
+    if "reports.compressed_report" in added:
+        compact_reports(new_engine)
+    if upgrading and "file_failures" in new_tables:
+        index_file_failures(new_engine)
+    if upgrading and "latest_status" in new_tables:
+        rebuild_latest_status(new_engine)
+    if upgrading and "report_posts" in new_tables:
+        queue_unposted_reports(new_engine)
+    if "scan_sessions.enqueued" in added:
+        # Earlier versions queued every AIP before workers started.
+        with new_engine.begin() as connection:
+            connection.execute(
+                update(ScanSession).values(
+                    enqueued=func.coalesce(ScanSession.started, utils.utcnow())
+                )
+            )
+    if engine is not None:
+        engine.dispose()
+    engine = new_engine
+    Session.configure(bind=engine)
+    return engine
@@ -0,0 +1,470 @@
+"""
+Delivery of reports to the report service through an outbox.
+
+Reports to post are queued in the fixity database, in the same
+transaction as the reports themselves (see queue_report()), so none is
+lost if the report service is down or fixity stops before posting it. A
+ReportOutbox posts them from background threads, so scans don't wait for
+the report service, and retries the posts that fail. `fixity
+flush-reports` posts every queued report, including those of earlier
+runs.
+
+Reports are posted one request per report, or, in bulk mode, many per
+request to the bulk endpoint of the report service (see
+reporting.post_reports), falling back to one per report if the service
+has none.
+"""
+
+import logging
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import timedelta
+from itertools import count
+from time import monotonic
+from uuid import uuid4
+
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload
+
+from . import reporting
+from . import utils
+from .http_client import HTTPClient
+from .models import ReportPost
+from .models import Session
+
+# Seconds before a failed post is retried, doubling with every failure up
+# to MAX_RETRY_DELAY.
+RETRY_DELAY = 60.0
+MAX_RETRY_DELAY = 3600.0
+
+# Seconds a process holds the posts it claims; posts claimed by a process
+# that died are retried after that.
+CLAIM_DURATION = 300.0
+
+# Seconds between checks for reports to post, and number of posts claimed
+# at once.
+POLL_INTERVAL = 1.0
+FLUSH_BATCH = 100
+
+# In bulk mode, seconds a report waits for a full request before being
+# sent in a smaller one.
+BULK_INTERVAL = 5.0
+
+
+def queue_report(report, aip_uuid, session_id=None):
+    """
+    Queue a report to be posted for an AIP, saving the post along with the
+    report. Like reporting.post_success_report(), reports of scans that
+    couldn't be made aren't posted.
+    """
+    if report is None or report.success is None:
+        return
+    report.posted = False
+    report.post = ReportPost(
+        aip_uuid=aip_uuid, session_uuid=session_id, next_attempt=utils.utcnow()
+    )
+
+
+def retry_delay(attempts):
+    """
+    Return the number of seconds to wait before posting a report again
+    after attempts failed posts.
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class ReportOutbox:
+    """
+    Posts pre-scan reports and queued reports from background threads, up
+    to `workers` at a time.
+
+    Pre-scan reports are posted as soon as pre_scan() is called, once:
+    as when they are posted by scan(), failures are only logged. Queued
+    reports are posted once committed: a thread checks for reports due
+    every poll_interval seconds. A report is only posted after the
+    pre-scan report of its AIP. Failed posts are retried after
+    retry_delay() seconds, by this outbox if it is still running, or by a
+    later run or `fixity flush-reports`.
+
+    Posts are claimed with single UPDATE statements re-checking that they
+    are still free, as in the work queue, so processes sharing a database
+    don't post the same report twice.
+
+    With bulk_size, pre-scan reports and queued reports are sent in bulk,
+    up to bulk_size per request. The thread sends them once bulk_size are
+    waiting, or once the oldest has waited bulk_interval seconds; the
+    pre-scan reports waiting are always sent first. If the report
+    service has no bulk endpoint, reports are posted one at a time from
+    then on.
+
+    close() stops the thread after a last pass over the reports due.
+    """
+
+    def __init__(
+        self,
+        engine,
+        report_url,
+        report_auth=(),
+        client=None,
+        logger=None,
+        log_level=logging.ERROR,
+        workers=1,
+        poll_interval=POLL_INTERVAL,
+        batch_size=FLUSH_BATCH,
+        claim_duration=CLAIM_DURATION,
+        bulk_size=None,
+        bulk_interval=BULK_INTERVAL,
+    ):
+        self.engine = engine
+        self.report_url = report_url
+        self.report_auth = report_auth
+        self.client = client
+        self.logger = logger or logging.getLogger(__name__)
+        self.log_level = log_level
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.claim_duration = claim_duration
+        self.bulk_size = bulk_size
+        self.bulk_interval = bulk_interval
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.session = Session(bind=engine)
+        self._claims = count()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="fixity-outbox")
+        # Pre-scan posts in progress, by AIP UUID.
+        self._pre_scans = {}
+        # In bulk mode, pre-scan reports waiting to be sent, as (AIP UUID,
+        # start time, session ID) tuples, and when the oldest was added.
+        self._bulk_pre_scans = []
+        self._bulk_since = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pre_scan(self, aip_uuid, start_time, session_id=None):
+        """
+        Post the pre-scan report of an AIP in the background.
+        """
+        if self.bulk_size:
+            with self._lock:
+                self._bulk_pre_scans.append((aip_uuid, start_time, session_id))
+                if self._bulk_since is None:
+                    self._bulk_since = monotonic()
+            return
+        future = self._executor.submit(
+            self._post_pre_scan, aip_uuid, start_time, session_id
+        )
+        with self._lock:
+            self._pre_scans[aip_uuid] = future
+        future.add_done_callback(lambda _: self._forget_pre_scan(aip_uuid, future))
+
+    def flush(self, due_only=True):
+        """
+        Post the queued reports, or only those due if due_only, except those
+        claimed by other processes. Returns the numbers of reports posted and
+        of posts that failed.
+        """
+        posted = failed = 0
+        after = 0
+        while True:
+            # Reports committed while earlier batches were sent may have
+            # pre-scan reports waiting: send those before claiming them.
+            self._send_pre_scans()
+            posts = self._claim(after, due_only)
+            if not posts:
+                break
+            if self.bulk_size:
+                chunks = [
+                    posts[start : start + self.bulk_size]
+                    for start in range(0, len(posts), self.bulk_size)
+                ]
+                errors = [
+                    error
+                    for chunk_errors in self._executor.map(self._post_bulk, chunks)
+                    for error in chunk_errors
+                ]
+            else:
+                errors = list(self._executor.map(self._post, posts))
+            self._record(posts, errors)
+            posted += errors.count(None)
+            failed += len(errors) - errors.count(None)
+            after = posts[-1].id
+        return posted, failed
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+            self.session.close()
+
+    def _post_pre_scan(self, aip_uuid, start_time, session_id):
+        try:
+            reporting.post_pre_scan_report(
+                aip_uuid,
+                start_time,
+                self.report_url,
+                report_auth=self.report_auth,
+                session_id=session_id,
+                client=self.client,
+            )
+        except Exception:
+            self._pre_scan_failed()
+
+    def _pre_scan_failed(self):
+        self.logger.log(
+            self.log_level, f"Unable to POST pre-scan report to {self.report_url}"
+        )
+
+    def _send_pre_scans(self):
+        """
+        Send the pre-scan reports waiting in bulk mode.
+        """
+        with self._lock:
+            pre_scans, self._bulk_pre_scans = self._bulk_pre_scans, []
+            self._bulk_since = None
+        size = self.bulk_size or 1
+        for start in range(0, len(pre_scans), size):
+            chunk = pre_scans[start : start + size]
+            if self.bulk_size and self._post_pre_scans_in_bulk(chunk):
+                continue
+            for pre_scan in chunk:
+                self._post_pre_scan(*pre_scan)
+
+    def _post_pre_scans_in_bulk(self, pre_scans):
+        """
+        Post (AIP UUID, start time, session ID) pre-scan reports in one
+        request. Returns False if the report service has no bulk endpoint.
+        """
+        try:
+            errors = reporting.post_reports(
+                [reporting.pre_scan_item(*pre_scan) for pre_scan in pre_scans],
+                self.report_url,
+                report_auth=self.report_auth,
+                client=self.client,
+            )
+        except reporting.BulkUnavailable:
+            self._bulk_unavailable()
+            return False
+        except Exception as e:
+            errors = [e] * len(pre_scans)
+        for error in errors:
+            if error is not None:
+                self._pre_scan_failed()
+        return True
+
+    def _bulk_unavailable(self):
+        if self.bulk_size:
+            self.bulk_size = None
+            self.logger.log(
+                self.log_level,
+                f"Report service at {self.report_url} has no bulk endpoint; "
+                "posting reports one at a time",
+            )
+
+    def _forget_pre_scan(self, aip_uuid, future):
+        with self._lock:
+            if self._pre_scans.get(aip_uuid) is future:
+                del self._pre_scans[aip_uuid]
+
+    def _claim(self, after, due_only):
+        """
+        Claim up to batch_size free posts with IDs above after, and return
+        them with their reports.
+        """
+        now = utils.utcnow()
+        token = f"{self.owner}:{next(self._claims)}"
+        free = (ReportPost.id > after, *self._free(now, due_only))
+        claimable = select(ReportPost.id).where(*free).order_by(ReportPost.id)
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(ReportPost)
+                .where(
+                    ReportPost.id.in_(
+                        claimable.limit(
+                            max(self.batch_size, (self.bulk_size or 0) * self.workers)
+                        ).scalar_subquery()
+                    ),
+                    *free,
+                )
+                .values(
+                    claimed_by=token,
+                    next_attempt=now + timedelta(seconds=self.claim_duration),
+                )
+            )
+        return self.session.scalars(
+            select(ReportPost)
+            .options(joinedload(ReportPost.report))
+            .where(ReportPost.claimed_by == token)
+            .order_by(ReportPost.id)
+        ).all()
+
+    def _free(self, now, due_only):
+        if due_only:
+            return (ReportPost.next_attempt <= now,)
+        return (or_(ReportPost.claimed_by.is_(None), ReportPost.next_attempt <= now),)
+
+    def _post(self, post):
+        """
+        Post a claimed report, and return the error raised if it failed.
+        """
+        with self._lock:
+            pre_scan = self._pre_scans.get(post.aip_uuid)
+        if pre_scan is not None:
+            wait([pre_scan])
+        try:
+            reporting.post_success_report(
+                post.aip_uuid,
+                post.report,
+                self.report_url,
+                report_auth=self.report_auth,
+                session_id=post.session_uuid,
+                client=self.client,
+            )
+        except Exception as e:
+            self.logger.log(
+                self.log_level,
+                f"Unable to POST report for AIP {post.aip_uuid} to remote service",
+            )
+            return e
+        return None
+
+    def _post_bulk(self, posts):
+        """
+        Post claimed reports in one request, and return the error of each
+        one that failed.
+        """
+        try:
+            errors = reporting.post_reports(
+                [
+                    reporting.report_item(post.aip_uuid, post.report, post.session_uuid)
+                    for post in posts
+                ],
+                self.report_url,
+                report_auth=self.report_auth,
+                client=self.client,
+            )
+        except reporting.BulkUnavailable:
+            self._bulk_unavailable()
+            return [self._post(post) for post in posts]
+        except Exception as e:
+            errors = [e] * len(posts)
+        for post, error in zip(posts, errors, strict=True):
+            if error is not None:
+                self.logger.log(
+                    self.log_level,
+                    f"Unable to POST report for AIP {post.aip_uuid} to remote service",
+                )
+        return errors
+
+    def _ready(self):
+        """
+        Return whether a flush has anything to send: in bulk mode, a full
+        request or reports that have waited bulk_interval seconds.
+        """
+        if not self.bulk_size:
+            return True
+        with self._lock:
+            pre_scans, since = len(self._bulk_pre_scans), self._bulk_since
+        if pre_scans >= self.bulk_size or (
+            since is not None and monotonic() - since >= self.bulk_interval
+        ):
+            return True
+        now = utils.utcnow()
+        with self.engine.connect() as connection:
+            due = connection.scalar(
+                select(func.count(ReportPost.id)).where(ReportPost.next_attempt <= now)
+            )
+            overdue = connection.scalar(
+                select(ReportPost.id)
+                .where(
+                    ReportPost.next_attempt
+                    <= now - timedelta(seconds=self.bulk_interval)
+                )
+                .limit(1)
+            )
+        return due >= self.bulk_size or overdue is not None
+
+    def _record(self, posts, errors):
+        now = utils.utcnow()
+        for post, error in zip(posts, errors, strict=True):
+            if error is None:
+                post.report.posted = True
+                self.session.delete(post)
+                continue
+            post.report.posted = False
+            post.attempts += 1
+            post.claimed_by = None
+            post.next_attempt = now + timedelta(seconds=retry_delay(post.attempts))
+            post.last_error = str(error) or type(error).__name__
+        self.session.commit()
+        self.session.expunge_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._ready():
+                    self.flush()
+            except SQLAlchemyError as e:
+                self.session.rollback()
+                self.logger.log(self.log_level, f"Unable to post queued reports: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._run, name="fixity-outbox-flusher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run(args, logger=None, stream=None):
+    """
+    Run `fixity flush-reports` with parsed arguments: post every queued
+    report, printing a summary to stream (by default standard output).
+    Returns the exit status, 1 if some reports couldn't be posted.
+    """
+    if stream is None:
+        stream = sys.stdout
+    if args.report_user and args.report_pass:
+        auth = (args.report_user, args.report_pass)
+    else:
+        auth = ()
+    session = Session()
+    engine = session.get_bind()
+    session.close()
+    with HTTPClient(
+        None, report_url=args.report_url, report_pool_size=args.pool_size
+    ) as client:
+        outbox = ReportOutbox(
+            engine,
+            args.report_url,
+            report_auth=auth,
+            client=client,
+            logger=logger,
+            workers=args.workers,
+            bulk_size=args.report_batch_size,
+        )
+        try:
+            posted, failed = outbox.flush(due_only=False)
+        finally:
+            outbox.close()
+    print(f"Posted {posted} queued reports", file=stream)
+    if failed:
+        print(f"{failed} reports could not be posted and remain queued", file=stream)
+        return 1
+    return 0
@@ -0,0 +1,128 @@
+"""
+Commands answering questions from the fixity database alone, through its
+indexes, without contacting the Storage Service, and rebuilding the
+tables they query.
+"""
+
+import sys
+
+from sqlalchemy import or_
+from sqlalchemy import select
+
+from . import models
+from .models import AIP
+from .models import FileFailure
+from .models import LatestStatus
+from .models import Report
+from .models import Session
+
+
+def find_file_failures(session, path=None, kind=None, aip_uuid=None):
+    """
+    Return the file failures recorded in reports, as (AIP UUID, kind,
+    path, report end time) tuples ordered by path, AIP and time.
+
+    path restricts them to the paths starting with it, e.g.
+    "data/objects/" for the files in the objects directory; kind to the
+    failures of one kind (see models.FAILURE_KINDS); aip_uuid to the
+    failures of one AIP. Path prefixes are matched as a range of the
+    path index, which unlike LIKE can use it on every database.
+    """
+    query = (
+        select(AIP.uuid, FileFailure.kind, FileFailure.path, Report.ended)
+        .join(AIP, FileFailure.aip_id == AIP.id)
+        .join(Report, FileFailure.report_id == Report.id)
+        .order_by(FileFailure.path, AIP.uuid, Report.ended)
+    )
+    if path:
+        query = query.where(
+            FileFailure.path >= path, FileFailure.path < _prefix_end(path)
+        )
+    if kind:
+        query = query.where(FileFailure.kind == kind)
+    if aip_uuid:
+        query = query.where(AIP.uuid == aip_uuid)
+    return session.execute(query).all()
+
+
+def _prefix_end(prefix):
+    # The first string after every string starting with prefix.
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def print_file_failures(session, args, stream):
+    for aip_uuid, kind, path, ended in find_file_failures(
+        session, path=args.path, kind=args.kind, aip_uuid=args.aip
+    ):
+        ended = ended.isoformat(sep=" ") if ended else "-"
+        print(f"{aip_uuid}\t{kind}\t{path}\t{ended}", file=stream)
+    return 0
+
+
+def find_status(session, aip_uuid=None):
+    """
+    Return the latest status (see models.LatestStatus) of an AIP, or,
+    without aip_uuid, of the AIPs whose latest scan failed or couldn't be
+    made, longest failing first. Statuses are (AIP UUID, last result, last
+    scan time, last successful scan time, consecutive failures) tuples.
+    """
+    query = select(
+        AIP.uuid,
+        LatestStatus.last_result,
+        LatestStatus.last_scanned,
+        LatestStatus.last_success,
+        LatestStatus.consecutive_failures,
+    ).join(AIP, LatestStatus.aip_id == AIP.id)
+    if aip_uuid:
+        return session.execute(query.where(AIP.uuid == aip_uuid)).all()
+    return session.execute(
+        query.where(
+            or_(LatestStatus.last_result.is_(False), LatestStatus.last_result.is_(None))
+        ).order_by(
+            LatestStatus.last_success.asc().nulls_first(), LatestStatus.last_scanned
+        )
+    ).all()
+
+
+RESULTS = {True: "success", False: "failed", None: "error"}
+
+
+def print_status(session, args, stream):
+    statuses = find_status(session, aip_uuid=args.aip)
+    if args.aip and not statuses:
+        return f"No scan of AIP {args.aip} is recorded"
+    for aip_uuid, result, scanned, success, failures in statuses:
+        scanned = scanned.isoformat(sep=" ") if scanned else "-"
+        success = success.isoformat(sep=" ") if success else "-"
+        print(
+            f"{aip_uuid}\t{RESULTS[result]}\t{scanned}\t{success}\t{failures}",
+            file=stream,
+        )
+    return 0
+
+
+def rebuild_status(session, args, stream):
+    rebuilt = models.rebuild_latest_status(session.get_bind())
+    print(f"Rebuilt the latest status of {rebuilt} AIPs", file=stream)
+    return 0
+
+
+COMMANDS = {
+    "failures": print_file_failures,
+    "status": print_status,
+    "rebuild-status": rebuild_status,
+}
+
+
+def run(args, stream=None):
+    """
+    Run the query command of parsed arguments, printing its results to
+    stream (by default standard output). Returns the exit status.
+    """
+    if stream is None:
+        stream = sys.stdout
+    session = Session()
+    try:
+        return COMMANDS[args.command](session, args, stream)
+    finally:
+        session.close()
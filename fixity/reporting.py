@@ -3,6 +3,7 @@ import json
 
 import requests
 
+from .http_client import http_for
 from .utils import check_valid_uuid
 
 
@@ -10,7 +11,9 @@ class ReportServiceException(Exception):
     pass
 
 
-def post_pre_scan_report(aip, start_time, report_url, report_auth=(), session_id=None):
+def post_pre_scan_report(
+    aip, start_time, report_url, report_auth=(), session_id=None, client=None
+):
     """
     Post a pre-scan report to a remote system.
 
@@ -23,14 +26,13 @@ def post_pre_scan_report(aip, start_time, report_url, report_auth=(), session_id
     For information on other parameters, see post_success_report.
 
     report_auth is a tuple of (username, pass)
+
+    client, if passed, is an HTTPClient whose connections are reused.
     """
 
     check_valid_uuid(aip)
 
-    report = {"started": int(calendar.timegm(start_time.utctimetuple()))}
-    if session_id:
-        report["session_uuid"] = session_id
-    body = json.dumps(report)
+    body = _pre_scan_body(start_time, session_id)
 
     kwargs = {"data": body, "headers": {"Content-Type": "application/json"}}
     if report_auth:
@@ -39,19 +41,31 @@ def post_pre_scan_report(aip, start_time, report_url, report_auth=(), session_id
     url = report_url + f"api/fixity/{aip}"
 
     try:
-        response = requests.post(url, **kwargs)
+        response = http_for(client).post(url, **kwargs)
     except requests.ConnectionError:
         raise ReportServiceException(
             f"Unable to connect to report service at URL {report_url}"
         )
 
-    if not response.status_code == 201:
-        raise ReportServiceException(f"Report service returned {response.status_code}")
-
+    _check_pre_scan_status(response.status_code)
     return True
 
 
-def post_success_report(aip, report, report_url, report_auth=(), session_id=None):
+def _pre_scan_body(start_time, session_id):
+    report = {"started": int(calendar.timegm(start_time.utctimetuple()))}
+    if session_id:
+        report["session_uuid"] = session_id
+    return json.dumps(report)
+
+
+def _check_pre_scan_status(status_code):
+    if not status_code == 201:
+        raise ReportServiceException(f"Report service returned {status_code}")
+
+
+def post_success_report(
+    aip, report, report_url, report_auth=(), session_id=None, client=None
+):
     """
     POST a JSON fixity scan report to a remote system.
 
@@ -67,17 +81,14 @@ def post_success_report(aip, report, report_url, report_auth=(), session_id=None
 
     This is an optional parameter, but some reporting services will require it.
     (For instance, the DRMC requires this to be POSTed with every report.)
+
+    client, if passed, is an HTTPClient whose connections are reused.
     """
     if report and report.success is None:
         return None
     check_valid_uuid(aip)
 
-    body = report.report
-
-    if session_id:
-        parsed_report = json.loads(body)
-        parsed_report["session_uuid"] = session_id
-        body = json.dumps(parsed_report)
+    body = _success_body(report, session_id)
 
     kwargs = {"data": body, "headers": {"Content-Type": "application/json"}}
     if report_auth:
@@ -86,25 +97,137 @@ def post_success_report(aip, report, report_url, report_auth=(), session_id=None
     url = report_url + f"api/fixity/{aip}"
 
     try:
-        response = requests.post(url, **kwargs)
+        response = http_for(client).post(url, **kwargs)
     except requests.ConnectionError:
         report.posted = False
         raise ReportServiceException(
             f"Unable to connect to report service at URL {report_url}"
         )
 
-    if not response.status_code == 201:
+    return _check_success_status(response.status_code, aip, report)
+
+
+def _success_body(report, session_id):
+    if session_id:
+        return report.result.text_with(session_uuid=session_id)
+    return report.report
+
+
+def _check_success_status(status_code, aip, report):
+    if not status_code == 201:
         report.posted = False
     else:
         report.posted = True
 
-    if response.status_code == 500:
+    if status_code == 500:
         raise ReportServiceException(
             f"Report service encountered an internal error when attempting to POST report for AIP {aip}"
         )
-    elif response.status_code != 201:
+    elif status_code != 201:
         raise ReportServiceException(
-            f"Report service returned {response.status_code} when attempting to POST report for AIP {aip}"
+            f"Report service returned {status_code} when attempting to POST report for AIP {aip}"
         )
 
     return report.posted
+
+
+class BulkUnavailable(ReportServiceException):
+    """
+    The report service has no bulk endpoint (see post_reports).
+    """
+
+
+# Responses of report services without a bulk endpoint.
+BULK_UNAVAILABLE_STATUSES = (404, 405, 501)
+
+
+def pre_scan_item(aip, start_time, session_id=None):
+    """
+    Return the pre-scan report of an AIP as an item of post_reports().
+    """
+    check_valid_uuid(aip)
+    return {
+        "aip": aip,
+        "kind": "pre-scan",
+        "report": json.loads(_pre_scan_body(start_time, session_id)),
+    }
+
+
+def report_item(aip, report, session_id=None):
+    """
+    Return the report of a scan of an AIP as an item of post_reports().
+    """
+    check_valid_uuid(aip)
+    return {
+        "aip": aip,
+        "kind": "report",
+        "report": _success_data(report, session_id),
+    }
+
+
+def _success_data(report, session_id):
+    data = report.result.data
+    if session_id and data is not None:
+        data = {**data, "session_uuid": session_id}
+    return data
+
+
+def post_reports(items, report_url, report_auth=(), client=None):
+    """
+    POST many pre-scan and scan reports to a remote system at once,
+    through its bulk endpoint, api/fixity/bulk.
+
+    items are dicts made by pre_scan_item() and report_item(), sent as
+    {"reports": items}. The response lists the outcome of each item, in
+    the same order, as {"results": [{"status": 201}, {"status": 400,
+    "error": "..."}, ...]}: the status the item would have got from the
+    per-AIP endpoint, and optionally an error message.
+
+    Returns, for each item, None if it was accepted, or a
+    ReportServiceException saying why not. Raises BulkUnavailable if the
+    report service has no bulk endpoint, and ReportServiceException if
+    the request as a whole failed.
+    """
+    kwargs = {
+        "data": json.dumps({"reports": items}),
+        "headers": {"Content-Type": "application/json"},
+    }
+    if report_auth:
+        kwargs["auth"] = report_auth
+
+    try:
+        response = http_for(client).post(report_url + "api/fixity/bulk", **kwargs)
+    except requests.ConnectionError:
+        raise ReportServiceException(
+            f"Unable to connect to report service at URL {report_url}"
+        )
+
+    if response.status_code in BULK_UNAVAILABLE_STATUSES:
+        raise BulkUnavailable(
+            f"Report service returned {response.status_code} for bulk reports"
+        )
+    if response.status_code != 200:
+        raise ReportServiceException(
+            f"Report service returned {response.status_code} for bulk reports"
+        )
+    try:
+        results = response.json()["results"]
+    except (ValueError, KeyError, TypeError):
+        raise ReportServiceException("Report service returned an invalid bulk response")
+    if not isinstance(results, list) or len(results) != len(items):
+        raise ReportServiceException("Report service returned an invalid bulk response")
+
+    return [
+        _item_error(item, result) for item, result in zip(items, results, strict=True)
+    ]
+
+
+def _item_error(item, result):
+    status = result.get("status") if isinstance(result, dict) else None
+    if status == 201:
+        return None
+    message = result.get("error") if isinstance(result, dict) else None
+    return ReportServiceException(
+        f"Report service returned {status} for the {item['kind']} report of AIP "
+        f"{item['aip']}" + (f": {message}" if message else "")
+    )
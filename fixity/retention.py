@@ -0,0 +1,154 @@
+"""
+Retention of reports: `fixity compact` removes the reports of old
+successful scans, keeping counts of them in monthly rollups.
+"""
+
+import sys
+
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import select
+
+from .models import AIP
+from .models import FileFailure
+from .models import Report
+from .models import ReportRollup
+from .models import Session
+
+# Number of latest reports of each AIP kept in full.
+KEEP = 10
+
+# Number of AIPs whose reports are looked at, and of reports removed, per
+# transaction.
+ROLLUP_BATCH = 1000
+
+
+def roll_up_reports(engine, keep=KEEP, batch_size=ROLLUP_BATCH):
+    """
+    Remove the reports of successful scans older than the latest `keep`
+    reports of their AIP, adding them to the AIP's rollup for the month
+    they ended in (see ReportRollup). Reports of failed scans, and reports
+    not yet posted to the report service, are kept.
+
+    Works through the AIPs batch_size at a time, and removes at most
+    batch_size reports per transaction, so scans can save their reports
+    in between. Reports saved meanwhile are newer than the ones removed,
+    which only makes these older. Returns the number of reports removed.
+    """
+    removed = 0
+    last_aip_id = 0
+    session = Session(bind=engine)
+    try:
+        while True:
+            aip_ids = session.scalars(
+                select(AIP.id)
+                .where(AIP.id > last_aip_id)
+                .order_by(AIP.id)
+                .limit(batch_size)
+            ).all()
+            if not aip_ids:
+                return removed
+            expired = session.execute(_expired_reports(aip_ids, keep)).all()
+            session.rollback()
+            for start in range(0, len(expired), batch_size):
+                removed += _roll_up(session, expired[start : start + batch_size])
+            last_aip_id = aip_ids[-1]
+    finally:
+        session.close()
+
+
+def _expired_reports(aip_ids, keep):
+    """
+    Query the ID, AIP ID and end time of the reports of the AIPs that
+    roll_up_reports() removes.
+    """
+    rank = (
+        func.row_number()
+        .over(
+            partition_by=Report.aip_id,
+            order_by=(Report.ended.desc().nulls_last(), Report.id.desc()),
+        )
+        .label("rank")
+    )
+    ranked = (
+        select(
+            Report.id, Report.aip_id, Report.ended, Report.success, Report.posted, rank
+        )
+        .where(Report.aip_id.in_(aip_ids))
+        .subquery()
+    )
+    return (
+        select(ranked.c.id, ranked.c.aip_id, ranked.c.ended)
+        .where(
+            ranked.c.rank > keep,
+            ranked.c.success.is_(True),
+            ranked.c.posted.is_not(False),
+            ranked.c.ended.is_not(None),
+        )
+        .order_by(ranked.c.id)
+    )
+
+
+def _roll_up(session, reports):
+    months = {}
+    for _, aip_id, ended in reports:
+        key = (aip_id, ended.date().replace(day=1))
+        count, first, last = months.get(key, (0, ended, ended))
+        months[key] = (count + 1, min(first, ended), max(last, ended))
+
+    rollups = {
+        (rollup.aip_id, rollup.month): rollup
+        for rollup in session.scalars(
+            select(ReportRollup).where(
+                ReportRollup.aip_id.in_({aip_id for aip_id, _ in months}),
+                ReportRollup.month.in_({month for _, month in months}),
+            )
+        )
+    }
+    for (aip_id, month), (count, first, last) in months.items():
+        rollup = rollups.get((aip_id, month))
+        if rollup is None:
+            session.add(
+                ReportRollup(
+                    aip_id=aip_id,
+                    month=month,
+                    success_count=count,
+                    first_ended=first,
+                    last_ended=last,
+                )
+            )
+            continue
+        rollup.success_count += count
+        rollup.first_ended = min(filter(None, (rollup.first_ended, first)))
+        rollup.last_ended = max(filter(None, (rollup.last_ended, last)))
+
+    ids = [id for id, _, _ in reports]
+    session.execute(
+        delete(FileFailure).where(FileFailure.report_id.in_(ids)),
+        execution_options={"synchronize_session": False},
+    )
+    session.execute(
+        delete(Report).where(Report.id.in_(ids)),
+        execution_options={"synchronize_session": False},
+    )
+    session.commit()
+    session.expunge_all()
+    return len(ids)
+
+
+def run(args, stream=None):
+    """
+    Run `fixity compact` with parsed arguments, printing a summary to
+    stream (by default standard output). Returns the exit status.
+    """
+    if stream is None:
+        stream = sys.stdout
+    session = Session()
+    engine = session.get_bind()
+    session.close()
+    removed = roll_up_reports(engine, keep=args.keep)
+    print(
+        f"Rolled up {removed} reports of successful scans into monthly counts",
+        file=stream,
+    )
+    return 0
@@ -0,0 +1,276 @@
+import threading
+from collections import Counter
+from collections import deque
+from datetime import datetime
+from time import monotonic
+
+from sqlalchemy import func
+from sqlalchemy import select
+
+from .models import AIP
+from .models import Report
+
+# Maximum number of AIPs read ahead of the scans, waiting for a free
+# slot in their location.
+LOOKAHEAD = 1000
+
+
+def location_of(aip):
+    """
+    Return the UUID of the location an AIP is stored in.
+
+    aip is a dict as returned by the storage service API, whose
+    current_location is a resource URI such as
+    "/api/v2/location/<uuid>/". Returns None if the AIP has no location.
+    """
+    uri = aip.get("current_location")
+    if not uri:
+        return None
+    return uri.rstrip("/").rsplit("/", 1)[-1]
+
+
+def last_scanned(session):
+    """
+    Return when each AIP was last scanned, as a dict mapping AIP UUIDs to
+    the latest `ended` of their reports.
+
+    Computed with a single grouped query over the reports table. AIPs
+    without reports are left out.
+    """
+    query = (
+        select(AIP.uuid, func.max(Report.ended))
+        .join(Report, Report.aip_id == AIP.id)
+        .group_by(AIP.uuid)
+    )
+    return dict(session.execute(query).all())
+
+
+def scan_durations(session):
+    """
+    Return how long the latest completed scan of each AIP took, as a dict
+    mapping AIP UUIDs to seconds.
+
+    Computed with a single query over the reports table. Reports of scans
+    that raised an error (whose success is unknown) are not counted.
+    """
+    latest = (
+        select(func.max(Report.id).label("id"))
+        .where(Report.success.is_not(None))
+        .group_by(Report.aip_id)
+        .subquery()
+    )
+    query = (
+        select(AIP.uuid, Report.begun, Report.ended)
+        .join(Report, Report.aip_id == AIP.id)
+        .join(latest, latest.c.id == Report.id)
+    )
+    return {
+        uuid: (ended - begun).total_seconds()
+        for uuid, begun, ended in session.execute(query)
+        if begun is not None and ended is not None
+    }
+
+
+def order_by_staleness(listed, last_scanned):
+    """
+    Sort a list of AIPs in place from the least recently scanned, with
+    AIPs that were never scanned first, given the result of last_scanned().
+    AIPs scanned equally recently stay in listing order.
+    """
+
+    def key(aip):
+        ended = last_scanned.get(aip["uuid"])
+        return ended is not None, ended or datetime.min
+
+    listed.sort(key=key)
+
+
+def order_by_cost(listed, durations):
+    """
+    Sort a list of AIPs in place from the most expensive to scan, given
+    the result of scan_durations().
+
+    An AIP's cost is how long its last scan took. AIPs without one are
+    estimated from their size at the rate (bytes per second) of the AIPs
+    that have both, or ordered by size alone if there are none. Picking
+    the longest scans first, as workers become free, keeps a large AIP
+    from being started last and stretching the run.
+    """
+    scanned_bytes = 0
+    scanned_seconds = 0.0
+    for aip in listed:
+        duration = durations.get(aip["uuid"])
+        if duration is not None and aip.get("size"):
+            scanned_bytes += aip["size"]
+            scanned_seconds += duration
+    rate = scanned_bytes / scanned_seconds if scanned_seconds else None
+
+    def key(aip):
+        size = aip.get("size") or 0
+        if rate is None:
+            return size
+        duration = durations.get(aip["uuid"])
+        if duration is None:
+            return size / rate
+        return duration
+
+    listed.sort(key=key, reverse=True)
+
+
+def listing_order(order, session):
+    """
+    Return a function sorting a list of listed AIPs in place for the given
+    scanall order, or None to scan AIPs in listing order.
+    """
+    if order == "stalest":
+        scanned = last_scanned(session)
+        return lambda listed: order_by_staleness(listed, scanned)
+    if order == "largest":
+        durations = scan_durations(session)
+        return lambda listed: order_by_cost(listed, durations)
+    return None
+
+
+def reordered(aips, sort):
+    """
+    Yield the AIPs of a listing in the order set by sort.
+
+    The whole listing is read and passed to sort before the first AIP is
+    yielded. If reading it fails part way, the AIPs listed until then are
+    yielded before the error is raised.
+    """
+    listed = []
+    error = None
+    try:
+        for aip in aips:
+            listed.append(aip)
+    except Exception as e:
+        error = e
+    sort(listed)
+    yield from listed
+    if error is not None:
+        raise error
+
+
+class LocationScheduler:
+    """
+    Decides which AIP to scan next when several scans run concurrently.
+
+    AIPs are queued per storage location and handed out round-robin
+    across locations, so scans are interleaved over every location
+    instead of following the order of the listing. A location with as
+    many scans in flight as its limit is skipped until one of them is
+    done, so no single storage backend gets more than its share of
+    check_fixity requests while the others sit idle.
+
+    default_limit is the maximum number of scans in flight per location,
+    or None for no limit. limits maps location UUIDs to a limit that
+    overrides the default for that location.
+
+    With keep_order, the earliest pushed item of the locations under their
+    limit is handed out instead, so a listing sorted for scanall's --order
+    (e.g. largest first) keeps its order, only held back by the limits.
+    """
+
+    def __init__(
+        self, default_limit=None, limits=None, lookahead=LOOKAHEAD, keep_order=False
+    ):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.lookahead = lookahead
+        self.keep_order = keep_order
+        self._queues = {}
+        self._rotation = deque()
+        self._in_flight = Counter()
+        self._queued = 0
+        self._pushed = 0
+
+    def __len__(self):
+        return self._queued
+
+    def full(self):
+        return self._queued >= self.lookahead
+
+    def limit(self, location):
+        return self.limits.get(location, self.default_limit)
+
+    def push(self, item, location):
+        if location not in self._queues:
+            self._queues[location] = deque()
+            self._rotation.append(location)
+        self._queues[location].append((self._pushed, item))
+        self._pushed += 1
+        self._queued += 1
+
+    def pop(self):
+        """
+        Return the next (item, location) pair to scan, or None if every
+        queued item is in a location that is at its limit.
+
+        The location is counted as having one more scan in flight until
+        done() is called for it.
+        """
+        if self.keep_order:
+            available = [
+                location for location in self._rotation if not self._at_limit(location)
+            ]
+            if not available:
+                return None
+            location = min(available, key=lambda location: self._queues[location][0][0])
+        else:
+            for _ in range(len(self._rotation)):
+                location = self._rotation[0]
+                self._rotation.rotate(-1)
+                if not self._at_limit(location):
+                    break
+            else:
+                return None
+        queue = self._queues[location]
+        _, item = queue.popleft()
+        if not queue:
+            del self._queues[location]
+            self._rotation.remove(location)
+        self._queued -= 1
+        self._in_flight[location] += 1
+        return item, location
+
+    def done(self, location):
+        self._in_flight[location] -= 1
+
+    def _at_limit(self, location):
+        limit = self.limit(location)
+        return limit is not None and self._in_flight[location] >= limit
+
+
+class TimeBudget:
+    """
+    Wall-clock budget of a scanall run.
+
+    deadline is a time.monotonic() value. A new scan is only started if it
+    can be expected to end before the deadline, so exhausted() turns true
+    once less time is left than the average duration of the scans so far,
+    as reported through record(). Once it has, ran_out stays set.
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.ran_out = False
+        self._scans = 0
+        self._total_duration = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        with self._lock:
+            self._scans += 1
+            self._total_duration += duration
+
+    def expected_duration(self):
+        with self._lock:
+            if not self._scans:
+                return 0.0
+            return self._total_duration / self._scans
+
+    def exhausted(self):
+        if monotonic() + self.expected_duration() >= self.deadline:
+            self.ran_out = True
+        return self.ran_out
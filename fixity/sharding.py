@@ -0,0 +1,50 @@
+import hashlib
+
+# Multiplier of the linear congruential generator used by jump_hash.
+JUMP_MULTIPLIER = 2862933555777941757
+
+
+def jump_hash(key, buckets):
+    """
+    Map a 64-bit integer key to one of `buckets` buckets, numbered from 0.
+
+    Jump consistent hash (Lamping and Veach, 2014): when the number of
+    buckets grows from n to n + 1, only about 1/(n + 1) of the keys move,
+    all of them to the new bucket.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * JUMP_MULTIPLIER + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def aip_key(aip_uuid):
+    """
+    Return a 64-bit key for an AIP UUID, spread evenly whatever the UUID
+    version and the same on every host.
+    """
+    digest = hashlib.blake2b(aip_uuid.lower().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def in_shard(aip_uuid, shard):
+    """
+    Return True if the AIP belongs to shard, an (index, count) pair with
+    index counted from 1.
+    """
+    index, count = shard
+    return jump_hash(aip_key(aip_uuid), count) == index - 1
+
+
+def parse_shard(value):
+    """
+    Parse an INDEX/COUNT shard such as "2/5" into an (index, count) pair,
+    raising ValueError if it isn't one of the COUNT shards.
+    """
+    index, sep, count = value.partition("/")
+    index, count = int(index), int(count)
+    if not sep or not 1 <= index <= count:
+        raise ValueError(value)
+    return index, count
@@ -1,13 +1,28 @@
 import calendar
-import json
+import itertools
+import queue
+import threading
+from contextlib import nullcontext
 from datetime import datetime
 
 import requests
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm.exc import NoResultFound
 
 from . import utils
+from .http_client import http_for
 from .models import AIP
 from .models import Report
+from .models import ScanResult
+
+# Maximum number of AIPs looked up per query by load_aips().
+PRELOAD_BATCH = 500
+
+# Number of pages of the AIP listing fetched ahead of the scans.
+PREFETCH_PAGES = 2
 
 UNABLE_TO_CONNECT_ERROR = (
     "Unable to connect to storage service instance at {} (is it running?)"
@@ -28,36 +43,26 @@ class StorageServiceError(Exception):
         super().__init__(message)
 
 
-def _get_aips(ss_url, ss_user, ss_key, uri=None):
-    try:
-        if uri:
-            url = ss_url + uri
-            response = requests.get(url)
-        else:
-            url = ss_url + "api/v2/file/"
-            params = {"username": ss_user, "api_key": ss_key}
-            response = requests.get(url, params=params)
-    except requests.ConnectionError:
-        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
-
-    if response.status_code == 500:
+def _check_aips_status(status_code, ss_url):
+    if status_code == 500:
         raise StorageServiceError(
             f'Storage service at "{ss_url}" encountered an internal error while requesting AIPs'
         )
-    elif response.status_code == 504:
+    elif status_code == 504:
         raise StorageServiceError(
             f'Storage service at "{ss_url}" encountered a gateway timeout while requesting AIPs'
         )
-    elif response.status_code == 401:
+    elif status_code == 401:
         raise StorageServiceError(
             f'Storage service at "{ss_url}" failed authentication while requesting AIPs'
         )
-    elif response.status_code != 200:
+    elif status_code != 200:
         raise StorageServiceError(
-            f'Storage service at "{ss_url}" returned {response.status_code} while requesting AIPs'
+            f'Storage service at "{ss_url}" returned {status_code} while requesting AIPs'
         )
 
-    results = response.json()
+
+def _filter_aips(results):
     filtered_aips = [
         aip
         for aip in results["objects"]
@@ -67,68 +72,230 @@ def _get_aips(ss_url, ss_user, ss_key, uri=None):
     return results
 
 
-def get_all_aips(ss_url, ss_user, ss_key):
+def _get_aips(ss_url, ss_user, ss_key, uri=None, client=None):
+    try:
+        if uri:
+            url = ss_url + uri
+            response = http_for(client).get(url)
+        else:
+            url = ss_url + "api/v2/file/"
+            params = {"username": ss_user, "api_key": ss_key}
+            response = http_for(client).get(url, params=params)
+    except requests.ConnectionError:
+        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
+
+    _check_aips_status(response.status_code, ss_url)
+    return _filter_aips(response.json())
+
+
+def get_all_aips(ss_url, ss_user, ss_key, client=None):
     """
     Returns a list of all AIPs stored in a storage service installation.
     Each AIP in the list is a dict as returned by the storage
     service API.
-    """
 
-    results = _get_aips(ss_url, ss_user, ss_key)
-    aips = results["objects"]
+    client, if passed, is an HTTPClient whose connections are reused.
+    """
+    return list(iter_aips(ss_url, ss_user, ss_key, client=client))
 
-    # The "next" key contains a prebuilt URL with query
-    # parameters to the next set of items; use that to keep
-    # iterating until we hit the end of the available AIPs.
-    while results["meta"]["next"] is not None:
-        results = _get_aips(ss_url, ss_user, ss_key, uri=results["meta"]["next"][1:])
-        aips.extend(results["objects"])
 
-    return aips
+def iter_aips(ss_url, ss_user, ss_key, client=None, prefetch=PREFETCH_PAGES):
+    """
+    Returns an iterator over all AIPs stored in a storage service
+    installation, in the same order as get_all_aips.
+
+    The first page of results is fetched before returning, so errors
+    reaching the storage service are raised immediately. Later pages are
+    fetched by a background thread while the caller consumes earlier
+    ones; at most `prefetch` pages are buffered ahead of the caller, so
+    memory use doesn't grow with the number of AIPs. Errors fetching a
+    later page are raised by the iterator when it reaches that page.
+    """
+    return itertools.chain.from_iterable(
+        iter_aip_pages(ss_url, ss_user, ss_key, client=client, prefetch=prefetch)
+    )
 
 
-def get_single_aip(uuid, ss_url, ss_user, ss_key):
+def iter_aip_pages(ss_url, ss_user, ss_key, client=None, prefetch=PREFETCH_PAGES):
     """
-    Fetch detailed information on an AIP from the storage service.
-
-    Given an AIP UUID, fetches a dict with full information on the AIP
-    from the storage service.
+    Like iter_aips, but iterates over the pages of the listing, as lists
+    of AIPs.
     """
-    utils.check_valid_uuid(uuid)
+    results = _get_aips(ss_url, ss_user, ss_key, client=client)
+    next_uri = results["meta"]["next"]
+    if next_uri is None:
+        return iter([results["objects"]])
+
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up once the consumer has gone away, rather than
+        # blocking forever on a full queue.
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_pages():
+        uri = next_uri
+        try:
+            # The "next" key contains a prebuilt URL with query
+            # parameters to the next set of items; use that to keep
+            # iterating until we hit the end of the available AIPs.
+            while uri is not None:
+                page = _get_aips(ss_url, ss_user, ss_key, uri=uri[1:], client=client)
+                if not put(page["objects"]):
+                    return
+                uri = page["meta"]["next"]
+        except Exception as e:
+            put(e)
+        else:
+            put(None)
 
-    params = {"username": ss_user, "api_key": ss_key}
-    try:
-        response = requests.get(ss_url + "api/v2/file/" + uuid + "/", params=params)
-    except requests.ConnectionError:
-        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
+    thread = threading.Thread(target=fetch_pages, name="fixity-listing", daemon=True)
+    thread.start()
 
-    if response.status_code == 500:
+    def iterate():
+        try:
+            yield results["objects"]
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+
+    return iterate()
+
+
+def _check_single_aip_status(status_code, uuid, ss_url):
+    if status_code == 500:
         raise StorageServiceError(
             f'Storage service at "{ss_url}" encountered an internal error while requesting AIP with UUID {uuid}'
         )
-    elif response.status_code == 504:
+    elif status_code == 504:
         raise StorageServiceError(
             f'Storage service at "{ss_url}" encounterd a gateway timeout while requesting AIP with UUID {uuid}'
         )
-    elif response.status_code == 401:
+    elif status_code == 401:
         raise StorageServiceError(
             f'Storage service at "{ss_url}" failed authentication while requesting AIP with UUID {uuid}'
         )
-    if response.status_code != 200:
+    if status_code != 200:
         raise StorageServiceError(
-            f'Storage service at "{ss_url}" returned {response.status_code} while requesting AIP with UUID {uuid}'
+            f'Storage service at "{ss_url}" returned {status_code} while requesting AIP with UUID {uuid}'
+        )
+
+
+def get_single_aip(uuid, ss_url, ss_user, ss_key, client=None):
+    """
+    Fetch detailed information on an AIP from the storage service.
+
+    Given an AIP UUID, fetches a dict with full information on the AIP
+    from the storage service.
+
+    client, if passed, is an HTTPClient whose connections are reused.
+    """
+    utils.check_valid_uuid(uuid)
+
+    params = {"username": ss_user, "api_key": ss_key}
+    try:
+        response = http_for(client).get(
+            ss_url + "api/v2/file/" + uuid + "/", params=params
         )
+    except requests.ConnectionError:
+        raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
+
+    _check_single_aip_status(response.status_code, uuid, ss_url)
     return response.json()
 
 
+def load_aips(session, uuids, batch_size=PRELOAD_BATCH):
+    """
+    Return the AIP models of a batch of AIPs, as a dict mapping their UUIDs
+    to AIP instances of session, adding the AIPs that aren't in the
+    database yet.
+
+    AIPs are looked up with one query per batch_size UUIDs, and the
+    missing ones are added with a single INSERT, committed on its own so
+    that other processes sharing the database aren't kept waiting for the
+    session's next commit. If another process added some of them first,
+    the others are added one at a time.
+    """
+    aips = _find_aips(session, uuids, batch_size)
+    missing = [uuid for uuid in dict.fromkeys(uuids) if uuid not in aips]
+    if missing:
+        try:
+            _insert_aips(session, missing)
+        except IntegrityError:
+            for uuid in missing:
+                try:
+                    _insert_aips(session, [uuid])
+                except IntegrityError:
+                    pass
+        aips.update(_find_aips(session, missing, batch_size))
+    return aips
+
+
+def _insert_aips(session, uuids):
+    with session.get_bind().begin() as connection:
+        connection.execute(insert(AIP), [{"uuid": uuid} for uuid in uuids])
+
+
+def _find_aips(session, uuids, batch_size):
+    uuids = list(uuids)
+    aips = {}
+    for start in range(0, len(uuids), batch_size):
+        query = select(AIP).where(AIP.uuid.in_(uuids[start : start + batch_size]))
+        aips.update((aip.uuid, aip) for aip in session.scalars(query))
+    return aips
+
+
 def create_report(aip, success, begun, ended, report_string):
-    return Report(
+    """
+    Return a new Report of a scan of aip. report_string is the JSON report,
+    as a string or a ScanResult.
+    """
+    if aip.id is not None:
+        # Link the report by ID and leave the AIP, and its session, alone:
+        # the report may be saved from another thread, with another
+        # session (see writer.ReportWriter).
+        return Report(
+            aip_id=aip.id,
+            begun=begun,
+            ended=ended,
+            success=success,
+            report=report_string,
+        )
+    report = Report(
         aip=aip, begun=begun, ended=ended, success=success, report=report_string
     )
+    # The report is now in aip.reports: add it to the AIP's session right
+    # away, so that a commit from another thread doesn't find it there
+    # before the caller adds it.
+    session = object_session(aip)
+    if session is not None:
+        session.add(report)
+    return report
 
 
 def scan_aip(
-    aip_uuid, ss_url, ss_user, ss_key, session, start_time=None, force_local=False
+    aip_uuid,
+    ss_url,
+    ss_user,
+    ss_key,
+    session,
+    start_time=None,
+    force_local=False,
+    session_lock=None,
+    client=None,
 ):
     """
     Scans fixity for the given AIP.
@@ -152,6 +319,12 @@ def scan_aip(
     force_local, if True, will request the Storage Service to perform a local
     fixity check, instead of using the Space's fixity (if available).
 
+    session_lock, if passed, is a lock held around every use of session
+    and every creation of model objects attached to it. It must be passed
+    when several threads share the same session.
+
+    client, if passed, is an HTTPClient whose connections are reused.
+
     A tuple of (success, report) is returned.
 
     success is a trilean that returns True or False for success or failure,
@@ -162,101 +335,104 @@ def scan_aip(
     If the storage service returns a 404, raises a StorageServiceError.
     A report is still saved to the database in this case.
     """
-    if isinstance(aip_uuid, AIP):
-        aip = aip_uuid
-    else:
-        utils.check_valid_uuid(aip_uuid)
+    if session_lock is None:
+        session_lock = nullcontext()
 
-        try:
-            aip = session.query(AIP).filter_by(uuid=aip_uuid).one()
-        except NoResultFound:
-            aip = AIP(uuid=aip_uuid)
+    aip = _get_aip_model(aip_uuid, session, session_lock)
 
     if not start_time:
         begun = utils.utcnow()
     else:
         begun = start_time
 
-    params = {"username": ss_user, "api_key": ss_key}
-    if force_local:
-        params = {"username": ss_user, "api_key": ss_key, "force_local": force_local}
     try:
-        response = requests.get(
-            ss_url + "api/v2/file/" + aip.uuid + "/check_fixity/", params=params
+        response = http_for(client).get(
+            ss_url + "api/v2/file/" + aip.uuid + "/check_fixity/",
+            params=_check_fixity_params(ss_user, ss_key, force_local),
         )
     except requests.ConnectionError:
         raise StorageServiceError(UNABLE_TO_CONNECT_ERROR.format(ss_url))
     ended = utils.utcnow()
 
-    begun_int = int(calendar.timegm(begun.utctimetuple()))
-    ended_int = int(calendar.timegm(ended.utctimetuple()))
+    _check_scan_status(response.status_code, aip, ss_url, begun, ended, session_lock)
+    return _create_scan_report(response.json(), aip, begun, ended, session_lock)
 
-    # Typically occurs if the storage service is unable to find the
+
+def _get_aip_model(aip_uuid, session, session_lock):
+    if isinstance(aip_uuid, AIP):
+        return aip_uuid
+
+    utils.check_valid_uuid(aip_uuid)
+
+    with session_lock:
+        # AIPs added since the last commit aren't flushed yet, and an AIP
+        # can be listed twice when the listing changes while it is paged.
+        for pending in session.new:
+            if isinstance(pending, AIP) and pending.uuid == aip_uuid:
+                return pending
+        try:
+            return session.query(AIP).filter_by(uuid=aip_uuid).one()
+        except NoResultFound:
+            return AIP(uuid=aip_uuid)
+
+
+def _check_fixity_params(ss_user, ss_key, force_local):
+    params = {"username": ss_user, "api_key": ss_key}
+    if force_local:
+        params = {"username": ss_user, "api_key": ss_key, "force_local": force_local}
+    return params
+
+
+def _check_scan_status(status_code, aip, ss_url, begun, ended, session_lock):
+    """
+    Raise a StorageServiceError, carrying a report, for non-200 responses
+    to a check_fixity request.
+    """
+    if status_code == 200:
+        return
+
+    # 404 typically occurs if the storage service is unable to find the
     # requested AIP, or if the requested API call is not available.
-    if response.status_code == 404:
-        json_report = {
-            "success": None,
-            "message": "Storage service returned 404",
-            "started": begun_int,
-            "finished": ended_int,
-        }
-        report = create_report(aip, None, begun, ended, json.dumps(json_report))
-        raise StorageServiceError(
-            f'A fixity scan could not be started for the AIP with uuid "{aip.uuid}"',
-            report=report,
-        )
-    if response.status_code == 500:
-        json_report = {
-            "success": None,
-            "message": "Storage service returned 500",
-            "started": begun_int,
-            "finished": ended_int,
-        }
-        report = create_report(aip, None, begun, ended, json.dumps(json_report))
-        raise StorageServiceError(
-            f'Storage service at "{ss_url}" encountered an internal error while scanning AIP {aip.uuid}',
-            report=report,
-        )
-    if response.status_code == 401:
-        json_report = {
-            "success": None,
-            "message": "Storage service returned 401",
-            "started": begun_int,
-            "finished": ended_int,
-        }
-        report = create_report(aip, None, begun, ended, json.dumps(json_report))
-        raise StorageServiceError(
-            f'Storage service at "{ss_url}" failed authentication while scanning AIP {aip.uuid}',
-            report=report,
+    if status_code == 404:
+        message = (
+            f'A fixity scan could not be started for the AIP with uuid "{aip.uuid}"'
         )
-    if response.status_code != 200:
-        json_report = {
-            "success": None,
-            "message": f"Storage service returned {response.status_code}",
-            "started": begun_int,
-            "finished": ended_int,
-        }
-        report = create_report(aip, None, begun, ended, json.dumps(json_report))
-        raise StorageServiceError(
-            f'Storage service at "{ss_url}" returned {response.status_code} while scanning AIP {aip.uuid}',
-            report=report,
-        )
-
-    report = response.json()
+    elif status_code == 500:
+        message = f'Storage service at "{ss_url}" encountered an internal error while scanning AIP {aip.uuid}'
+    elif status_code == 401:
+        message = f'Storage service at "{ss_url}" failed authentication while scanning AIP {aip.uuid}'
+    else:
+        message = f'Storage service at "{ss_url}" returned {status_code} while scanning AIP {aip.uuid}'
+    json_report = {
+        "success": None,
+        "message": f"Storage service returned {status_code}",
+        "started": int(calendar.timegm(begun.utctimetuple())),
+        "finished": int(calendar.timegm(ended.utctimetuple())),
+    }
+    with session_lock:
+        report = create_report(aip, None, begun, ended, ScanResult(json_report))
+    raise StorageServiceError(message, report=report)
+
+
+def _create_scan_report(report, aip, begun, ended, session_lock):
+    """
+    Build the (success, report) tuple returned by scan_aip from the JSON
+    body of a successful check_fixity response.
+    """
     if report.get("timestamp"):
         timestamp = datetime.strptime(report["timestamp"], "%Y-%m-%dT%H:%M:%S")
         timestamp = int(calendar.timegm(timestamp.utctimetuple()))
         report["started"] = timestamp
         report["finished"] = timestamp
     else:
-        report["started"] = begun_int
-        report["finished"] = ended_int
+        report["started"] = int(calendar.timegm(begun.utctimetuple()))
+        report["finished"] = int(calendar.timegm(ended.utctimetuple()))
     if "success" not in report:
         report["success"] = None
 
     success = report.get("success", None)
-    report_string = json.dumps(report)
 
-    report_object = create_report(aip, success, begun, ended, report_string)
+    with session_lock:
+        report_object = create_report(aip, success, begun, ended, ScanResult(report))
 
     return (success, report_object)
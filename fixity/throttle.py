@@ -0,0 +1,109 @@
+import threading
+from typing import Any
+
+import requests
+
+# Statuses showing the Storage Service is overloaded rather than that a
+# particular AIP couldn't be scanned.
+OVERLOAD_STATUSES = {500, 502, 503, 504}
+
+# Delay added or removed, in seconds, on each adjustment.
+DELAY_STEP = 1.0
+
+# Weights of the short and long term moving averages of response times.
+SHORT_WEIGHT = 0.3
+LONG_WEIGHT = 0.02
+
+# How much slower than usual responses must get to count as congestion.
+SLOWDOWN_FACTOR = 2.0
+
+
+class AdaptiveThrottle:
+    """
+    Adjust the pace of a scanall run to how the Storage Service copes.
+
+    An additive-increase/multiplicative-decrease controller, fed with the
+    response time and status of every check_fixity request through
+    observe(), and with the requests that get no response at all through
+    observe_error(). Responses with an overload status (5xx), requests
+    without a response, or a short term average response time at least
+    SLOWDOWN_FACTOR times the long term average, halve the number of
+    concurrent scans and double the delay between starting scans. Other responses grow concurrency by roughly
+    one scan for every `concurrency` responses, and shorten the delay by
+    DELAY_STEP, so spare capacity is picked up gradually.
+
+    Runs start with one scan at a time and min_delay between scans. The
+    delay stays within [min_delay, max_delay] seconds and the concurrency
+    within [1, max_concurrency].
+    """
+
+    def __init__(
+        self, min_delay: float = 0.0, max_delay: float = 60.0, max_concurrency: int = 1
+    ) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.delay = min_delay
+        self._concurrency = 1.0
+        self._short_latency: float | None = None
+        self._long_latency: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self) -> int:
+        return int(self._concurrency)
+
+    def observe(self, latency: float, status_code: int) -> None:
+        """
+        Record the response time, in seconds, and status of a check_fixity
+        request, and adjust the delay and concurrency accordingly.
+        """
+        with self._lock:
+            if status_code in OVERLOAD_STATUSES or self._slowing_down(latency):
+                self._back_off()
+            else:
+                self._speed_up()
+
+    def observe_error(self) -> None:
+        """
+        Record a check_fixity request that failed without a response, e.g.
+        on a connection error or a timeout, which backs off like an
+        overload status.
+        """
+        with self._lock:
+            self._back_off()
+
+    def response_hook(
+        self, response: requests.Response, *args: Any, **kwargs: Any
+    ) -> None:
+        """
+        requests response hook feeding check_fixity responses to observe().
+        """
+        if "/check_fixity/" in response.request.url:
+            self.observe(response.elapsed.total_seconds(), response.status_code)
+
+    def error_hook(self, url: str, error: BaseException) -> None:
+        """
+        HTTPClient error hook feeding failed check_fixity requests to
+        observe_error().
+        """
+        if "/check_fixity/" in url:
+            self.observe_error()
+
+    def _slowing_down(self, latency: float) -> bool:
+        if self._short_latency is None:
+            self._short_latency = self._long_latency = latency
+            return False
+        self._short_latency += SHORT_WEIGHT * (latency - self._short_latency)
+        self._long_latency += LONG_WEIGHT * (latency - self._long_latency)
+        return self._short_latency >= SLOWDOWN_FACTOR * self._long_latency
+
+    def _back_off(self) -> None:
+        self._concurrency = max(1.0, self._concurrency / 2)
+        self.delay = min(self.max_delay, max(self.delay * 2, DELAY_STEP))
+
+    def _speed_up(self) -> None:
+        self._concurrency = min(
+            float(self.max_concurrency), self._concurrency + 1 / self._concurrency
+        )
+        self.delay = max(self.min_delay, self.delay - DELAY_STEP)
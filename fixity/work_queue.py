@@ -0,0 +1,330 @@
+import itertools
+import os
+import socket
+import threading
+from datetime import timedelta
+from time import sleep
+from uuid import uuid4
+
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import utils
+from .models import QueuedAIP
+from .models import ScanSession
+from .models import Session
+
+# Seconds a worker holds the AIPs it claimed without renewing its lease.
+LEASE_DURATION = 300.0
+
+# Number of AIPs claimed at a time.
+CLAIM_BATCH = 10
+
+# Seconds to wait before claiming again when every AIP left is leased by
+# other workers.
+POLL_INTERVAL = 1.0
+
+# Number of AIPs inserted per statement when filling the queue.
+ENQUEUE_BATCH = 1000
+
+
+def enqueue(session, scan_session, aips, batch_size=ENQUEUE_BATCH):
+    """
+    Add the listed AIPs to the work queue of scan_session.
+
+    AIPs are inserted and committed in batches as the listing streams in,
+    so workers can start claiming them before the listing is complete.
+    Once every AIP is queued, the queue is marked as complete (see
+    finish_enqueuing). Returns the number of AIPs queued.
+    """
+    aips = iter(aips)
+    batches = iter(lambda: list(itertools.islice(aips, batch_size)), [])
+    return enqueue_pages(session, scan_session, batches)
+
+
+def enqueue_pages(session, scan_session, pages):
+    """
+    Like enqueue, but for a listing given as lists of AIPs, such as the
+    pages of the storage service listing: each list is inserted and
+    committed as soon as it comes.
+    """
+    count = 0
+    for page in pages:
+        if page:
+            count += _insert(
+                session,
+                [
+                    {
+                        "session_id": scan_session.id,
+                        "aip_uuid": aip["uuid"],
+                        "current_location": aip.get("current_location"),
+                        "done": False,
+                    }
+                    for aip in page
+                ],
+            )
+    finish_enqueuing(session, scan_session)
+    return count
+
+
+def finish_enqueuing(session, scan_session):
+    """
+    Record that no more AIPs will be added to the work queue of
+    scan_session, so its workers end the session once the queue is done.
+    """
+    scan_session.enqueued = utils.utcnow()
+    session.commit()
+
+
+def _insert(session, rows):
+    session.execute(insert(QueuedAIP), rows)
+    session.commit()
+    return len(rows)
+
+
+class Enqueuer:
+    """
+    Fills the work queue of a scanall session from a thread of its own,
+    with a session of its own, page by page (see enqueue_pages), so the
+    worker listing the AIPs starts scanning the first page while later
+    pages are fetched and queued.
+
+    An error raised while iterating over pages is kept in error rather
+    than raised, and the queue is marked as complete anyway, so workers
+    don't wait for AIPs that won't be queued. Leaving the context waits
+    for the thread to end.
+    """
+
+    def __init__(self, engine, scan_session, pages):
+        self.session = Session(bind=engine)
+        self.scan_session_id = scan_session.id
+        self.pages = pages
+        self.error = None
+        self._thread = None
+
+    def _run(self):
+        try:
+            scan_session = self.session.get(ScanSession, self.scan_session_id)
+            try:
+                enqueue_pages(self.session, scan_session, self.pages)
+            except Exception as e:
+                self.error = e
+                self.session.rollback()
+                finish_enqueuing(self.session, scan_session)
+        finally:
+            self.session.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._run, name="fixity-enqueue", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._thread.join()
+
+
+class LeaseQueue:
+    """
+    A worker's view of the work queue of a scanall session.
+
+    batches() claims AIPs in batches by leasing them for lease_duration
+    seconds. A background thread renews the leases of the AIPs claimed
+    and not done yet every third of lease_duration, while they wait for
+    or go through their scan. An AIP whose lease expires (because its
+    worker died or hung) can be claimed again by any worker, so work
+    moves to the workers that are still running, at their own pace.
+
+    complete() marks an AIP as done in the caller's session, so that it
+    is committed together with the AIP's report: an AIP is only ever
+    scanned again if its report was lost with its worker.
+
+    Claims are single UPDATE statements re-checking that the AIPs are
+    still free, so two workers never hold the same AIP, on SQLite (where
+    writes are serialized) as on PostgreSQL (where a row updated
+    concurrently is re-checked before being updated).
+    """
+
+    def __init__(
+        self,
+        session,
+        scan_session,
+        lease_duration=LEASE_DURATION,
+        batch_size=CLAIM_BATCH,
+        poll_interval=POLL_INTERVAL,
+    ):
+        self.engine = session.get_bind()
+        self.session_id = scan_session.id
+        self.lease_duration = lease_duration
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        # AIPs this worker claimed and already returned from claim().
+        self._handed_out = set()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def batches(self):
+        """
+        Yield the batches of AIPs this worker claims, as lists of dicts like
+        those of the storage service listing, until no AIP is left that
+        this worker could claim, and none will be queued any more.
+        """
+        while True:
+            claimed = self.claim()
+            if claimed:
+                yield claimed
+            elif self._others_pending() or not self._enqueued():
+                sleep(self.poll_interval)
+            else:
+                return
+
+    def claim(self):
+        """
+        Lease up to batch_size free AIPs and return them.
+        """
+        now = utils.utcnow()
+        free = select(QueuedAIP.id).where(*self._free(now))
+        free = free.order_by(QueuedAIP.id).limit(self.batch_size)
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(QueuedAIP)
+                .where(QueuedAIP.id.in_(free.scalar_subquery()), *self._free(now))
+                .values(lease_owner=self.owner, lease_expires=self._expiry())
+            )
+            rows = connection.execute(
+                select(QueuedAIP.aip_uuid, QueuedAIP.current_location)
+                .where(*self._held())
+                .order_by(QueuedAIP.id)
+            ).all()
+        claimed = [
+            {"uuid": aip_uuid, "current_location": location}
+            for aip_uuid, location in rows
+            if aip_uuid not in self._handed_out
+        ]
+        self._handed_out.update(aip["uuid"] for aip in claimed)
+        return claimed
+
+    def complete(self, session, aip_uuid):
+        """
+        Mark an AIP as done, as part of session's current transaction.
+        """
+        session.execute(
+            update(QueuedAIP)
+            .where(
+                QueuedAIP.session_id == self.session_id,
+                QueuedAIP.aip_uuid == aip_uuid,
+                QueuedAIP.lease_owner == self.owner,
+            )
+            .values(done=True)
+        )
+
+    def renew(self):
+        """
+        Extend the leases of the AIPs this worker holds and hasn't done.
+        """
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(QueuedAIP)
+                .where(*self._held())
+                .values(lease_expires=self._expiry())
+            )
+
+    def release(self, session):
+        """
+        Return the AIPs this worker holds and hasn't done to the pool, as
+        part of session's current transaction.
+        """
+        session.execute(
+            update(QueuedAIP)
+            .where(*self._held())
+            .values(lease_owner=None, lease_expires=None)
+        )
+
+    def remaining(self, session):
+        """
+        Return the number of AIPs of the session that aren't done.
+        """
+        return session.scalar(
+            select(func.count(QueuedAIP.id)).where(
+                QueuedAIP.session_id == self.session_id, QueuedAIP.done.is_(False)
+            )
+        )
+
+    def _free(self, now):
+        return (
+            QueuedAIP.session_id == self.session_id,
+            QueuedAIP.done.is_(False),
+            or_(QueuedAIP.lease_owner.is_(None), QueuedAIP.lease_expires < now),
+        )
+
+    def _held(self):
+        return (
+            QueuedAIP.session_id == self.session_id,
+            QueuedAIP.done.is_(False),
+            QueuedAIP.lease_owner == self.owner,
+        )
+
+    def _expiry(self):
+        return utils.utcnow() + timedelta(seconds=self.lease_duration)
+
+    def _others_pending(self):
+        with self.engine.connect() as connection:
+            return connection.scalar(
+                select(func.count(QueuedAIP.id)).where(
+                    QueuedAIP.session_id == self.session_id,
+                    QueuedAIP.done.is_(False),
+                    or_(
+                        QueuedAIP.lease_owner.is_(None),
+                        QueuedAIP.lease_owner != self.owner,
+                    ),
+                )
+            )
+
+    def _enqueued(self):
+        with self.engine.connect() as connection:
+            return (
+                connection.scalar(
+                    select(ScanSession.enqueued).where(
+                        ScanSession.id == self.session_id
+                    )
+                )
+                is not None
+            )
+
+    def _renew_periodically(self):
+        while not self._stop.wait(self.lease_duration / 3):
+            try:
+                self.renew()
+            except SQLAlchemyError:
+                # E.g. the database is busy; there's time to retry before
+                # the leases expire.
+                pass
+
+    def __enter__(self):
+        self._heartbeat = threading.Thread(
+            target=self._renew_periodically, name="fixity-lease", daemon=True
+        )
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._heartbeat.join()
+
+
+def has_queue(session, scan_session):
+    """
+    Return True if scan_session has a work queue.
+    """
+    return (
+        session.scalar(
+            select(QueuedAIP.id).where(QueuedAIP.session_id == scan_session.id).limit(1)
+        )
+        is not None
+    )
@@ -0,0 +1,181 @@
+import threading
+from queue import Empty
+from queue import Queue
+from time import monotonic
+
+from . import models
+from .checkpoints import COMMIT_EVERY
+from .checkpoints import COMMIT_INTERVAL
+from .models import ScannedAIP
+
+# Maximum number of reports and checkpoints waiting to be written; scans
+# wait for the writer beyond that.
+MAX_PENDING = 1000
+
+_CLOSE = object()
+
+
+class ReportWriter:
+    """
+    Saves the reports and checkpoints of a scanall run from a thread of
+    its own, with a session of its own, so scans never wait for each
+    other to use the database.
+
+    Scans hand their report to add(), then call done() for their AIP.
+    Both are queued, and written in order by the writer thread, which
+    commits as soon as it has written a checkpoint and nothing else is
+    waiting to be written, so each AIP is saved as its scan completes.
+    When items queue up faster than that, it commits every `every` items
+    or `interval` seconds after the first uncommitted one, whichever comes
+    first. A run that is killed only loses the batch being written, and
+    as an AIP's checkpoint is written after its report, every AIP
+    recorded as scanned has its report saved.
+    Committed objects are expunged from the writer's session, so memory
+    use doesn't grow with the number of AIPs scanned.
+
+    With a work queue (a LeaseQueue), AIPs are also marked as done in the
+    queue, in the same transaction as their checkpoint.
+
+    If writing fails, the error is raised by the next add() or done(),
+    and by close(), and nothing else is written. A batch failing to be
+    written is rolled back and written again item by item, so the items
+    queued before the failing one are still saved.
+    """
+
+    def __init__(
+        self,
+        engine,
+        scan_session,
+        every=COMMIT_EVERY,
+        interval=COMMIT_INTERVAL,
+        queue=None,
+        max_pending=MAX_PENDING,
+    ):
+        self.session = models.Session(bind=engine)
+        self.scan_session_id = scan_session.id
+        self.every = every
+        self.interval = interval
+        self.queue = queue
+        self.error = None
+        self._items = Queue(max_pending)
+        self._thread = None
+        # Items written since the last commit, with the file failures of
+        # reports, which are cleared as they are saved.
+        self._batch = []
+
+    def add(self, report):
+        self._put(("report", report))
+
+    def done(self, aip_uuid):
+        self._put(("done", aip_uuid))
+
+    def close(self):
+        """
+        Write and commit everything queued, then stop the writer thread.
+        """
+        self._items.put(_CLOSE)
+        self._thread.join()
+        self.session.close()
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        self._items.put(item)
+
+    def _run(self):
+        try:
+            self._write_items()
+        except Exception as e:
+            # Whatever failed, keep taking items until closed, so that
+            # scans get the error rather than wait for room in the queue.
+            self._fail(e)
+            while self._items.get() is not _CLOSE:
+                pass
+
+    def _write_items(self):
+        uncommitted = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+            try:
+                item = self._items.get(timeout=timeout)
+            except Empty:
+                item = None
+            if item is _CLOSE:
+                self._commit()
+                return
+            if item is not None and self.error is None:
+                self._batch.append((item, getattr(item[1], "pending_failures", None)))
+                try:
+                    self._write(*item)
+                except Exception:
+                    self._write_one_by_one()
+                uncommitted += 1
+                if deadline is None:
+                    deadline = monotonic() + self.interval
+            caught_up = item is not None and item[0] == "done" and self._items.empty()
+            if (
+                caught_up
+                or uncommitted >= self.every
+                or (deadline is not None and monotonic() >= deadline)
+            ):
+                self._commit()
+                uncommitted = 0
+                deadline = None
+
+    def _write(self, kind, value):
+        if kind == "report":
+            self.session.add(value)
+            return
+        self.session.add(ScannedAIP(session_id=self.scan_session_id, aip_uuid=value))
+        if self.queue is not None:
+            self.queue.complete(self.session, value)
+
+    def _commit(self):
+        if self.error is not None:
+            return
+        try:
+            self.session.commit()
+        except Exception:
+            self._write_one_by_one()
+        self._batch = []
+        self.session.expunge_all()
+
+    def _write_one_by_one(self):
+        """
+        Roll back the batch being written, and write its items again,
+        committing each, up to the first one failing again.
+        """
+        batch, self._batch = self._batch, []
+        for (kind, value), failures in batch:
+            try:
+                self.session.rollback()
+                if kind == "report":
+                    value.pending_failures = failures
+                self._write(kind, value)
+                self.session.commit()
+            except Exception as e:
+                self._fail(e)
+                return
+            self.session.expunge_all()
+
+    def _fail(self, error):
+        # Items queued from then on are dropped, so that scans waiting to
+        # queue theirs aren't blocked, and get the error instead.
+        self.error = error
+        try:
+            self.session.rollback()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._run, name="fixity-writer", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,27 @@
+import os
+import shutil
+import tempfile
+
+from fixity import models
+
+_database_directory = None
+
+
+def pytest_configure(config):
+    """
+    Point the tests at a database in a temporary directory rather than the
+    one in the package directory. Set before the test modules are
+    imported, since some of them make sessions at import time.
+    """
+    global _database_directory
+    _database_directory = tempfile.mkdtemp(prefix="fixity-tests-")
+    path = os.path.join(_database_directory, "fixity.db")
+    os.environ[models.DATABASE_URL_VARIABLE] = f"sqlite:///{path}"
+
+
+def pytest_unconfigure(config):
+    os.environ.pop(models.DATABASE_URL_VARIABLE, None)
+    if models.engine is not None:
+        models.engine.dispose()
+    if _database_directory is not None:
+        shutil.rmtree(_database_directory, ignore_errors=True)
@@ -0,0 +1,170 @@
+"""
+A stand-in for the Storage Service and the report service, serving on a
+local port.
+"""
+
+import collections
+import json
+import threading
+import time
+from collections.abc import Iterable
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from types import TracebackType
+from typing import Any
+
+BULK_PATH = "/api/fixity/bulk"
+
+SCAN_REPORT = {
+    "success": True,
+    "message": "",
+    "failures": {"files": {"missing": [], "changed": [], "untracked": []}},
+    "timestamp": None,
+}
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    As the Storage Service, lists aip_uuids, knows every AIP asked about,
+    and scans each in scan_time seconds, successfully unless it is in
+    failed_uuids, which get a 500, or in dropped_uuids, whose connection
+    is closed without a response.
+
+    As the report service, serves the per-AIP endpoint and the bulk
+    endpoint (see reporting.post_reports). Without bulk, the bulk endpoint
+    answers 404, like report services that don't have one. Reports of the
+    AIPs in rejected get a 400, from either endpoint.
+
+    Records the paths of GET requests (gets), the (path, JSON body) pairs
+    of POST requests (posts), the number of scans of each AIP (checks),
+    and the largest number of scans served at the same time
+    (max_in_flight).
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        aip_uuids: Iterable[str] = (),
+        failed_uuids: Iterable[str] = (),
+        dropped_uuids: Iterable[str] = (),
+        bulk: bool = True,
+        scan_time: float = 0.1,
+    ) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.aip_uuids = list(aip_uuids)
+        self.failed_uuids = set(failed_uuids)
+        self.dropped_uuids = set(dropped_uuids)
+        self.bulk = bulk
+        self.scan_time = scan_time
+        self.rejected: set[str] = set()
+        self.gets: list[str] = []
+        self.posts: list[tuple[str, Any]] = []
+        self.checks: collections.Counter[str] = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    def reports(self) -> list[tuple[str, str]]:
+        """
+        Return the (AIP UUID, kind) pairs of the reports received, from
+        either endpoint, in order.
+        """
+        received: list[tuple[str, str]] = []
+        for path, body in self.posts:
+            if path == BULK_PATH:
+                received.extend((item["aip"], item["kind"]) for item in body["reports"])
+            else:
+                kind = "report" if "success" in body else "pre-scan"
+                received.append((path.rsplit("/", 1)[-1], kind))
+        return received
+
+    def __enter__(self) -> "StubServer":
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def do_GET(self) -> None:
+        server = self.server
+        path = self.path.split("?")[0]
+        with server.lock:
+            server.gets.append(path)
+        if path == "/api/v2/file/":
+            self._respond(
+                200,
+                {
+                    "meta": {"next": None},
+                    "objects": [
+                        {"package_type": "AIP", "status": "UPLOADED", "uuid": uuid}
+                        for uuid in server.aip_uuids
+                    ],
+                },
+            )
+        elif path.endswith("/check_fixity/"):
+            aip_uuid = path.split("/")[-3]
+            with server.lock:
+                server.checks[aip_uuid] += 1
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            time.sleep(server.scan_time)
+            with server.lock:
+                server.in_flight -= 1
+            if aip_uuid in server.dropped_uuids:
+                self.close_connection = True
+            elif aip_uuid in server.failed_uuids:
+                self._respond(500, {})
+            else:
+                self._respond(200, SCAN_REPORT)
+        else:
+            self._respond(200, {"uuid": path.split("/")[-2]})
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        if self.path == BULK_PATH and not server.bulk:
+            self._respond(404)
+            return
+        with server.lock:
+            server.posts.append((self.path, body))
+        if self.path == BULK_PATH:
+            results = [
+                {"status": 400, "error": "rejected"}
+                if item["aip"] in server.rejected
+                else {"status": 201}
+                for item in body["reports"]
+            ]
+            self._respond(200, {"results": results})
+        elif self.path.rsplit("/", 1)[-1] in server.rejected:
+            self._respond(400)
+        else:
+            self._respond(201)
+
+    def _respond(self, status: int, body: Any = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
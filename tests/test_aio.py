@@ -0,0 +1,120 @@
+import io
+import uuid
+
+import pytest
+from sqlalchemy import event
+
+from fixity import fixity
+from fixity import models
+
+from .stub_server import StubServer
+
+pytest.importorskip("aiohttp")
+
+STORAGE_SERVICE_USER = "test"
+STORAGE_SERVICE_KEY = "test"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    aip_uuids = [str(uuid.uuid4()) for _ in range(8)]
+    with StubServer(aip_uuids, failed_uuids=aip_uuids[:1]) as server:
+        monkeypatch.setenv("STORAGE_SERVICE_URL", server.url)
+        monkeypatch.setenv("STORAGE_SERVICE_USER", STORAGE_SERVICE_USER)
+        monkeypatch.setenv("STORAGE_SERVICE_KEY", STORAGE_SERVICE_KEY)
+        yield server
+
+
+def test_async_scanall(server, monkeypatch):
+    monkeypatch.setenv("REPORT_URL", server.url)
+    stream = io.StringIO()
+
+    response = fixity.main(
+        ["scanall", "--engine", "async", "--workers", "4", "--sort"], stream=stream
+    )
+
+    assert response == 1
+
+    stream.seek(0)
+    lines = [line.strip() for line in stream.readlines()]
+    failed_uuid = server.aip_uuids[0]
+    assert lines[0] == (
+        f'Storage service at "{server.url}" encountered an internal error while scanning AIP {failed_uuid}'
+    )
+    assert sorted(lines[1:-2]) == sorted(
+        f"Fixity scan succeeded for AIP: {aip_uuid}"
+        for aip_uuid in server.aip_uuids[1:]
+    )
+    assert lines[-2] == "Successfully scanned 8 AIPs"
+    assert lines[-1].startswith("Throughput: ")
+
+    assert 1 < server.max_in_flight <= 4
+
+    # Every AIP gets a pre-scan report; only completed scans get a final one.
+    session_uuids = {body["session_uuid"] for _, body in server.posts}
+    assert len(session_uuids) == 1
+    assert len(server.posts) == 8 + 7
+
+
+def test_async_scan(server):
+    aip_uuid = server.aip_uuids[1]
+    stream = io.StringIO()
+
+    response = fixity.main(["scan", aip_uuid, "--engine", "async"], stream=stream)
+
+    assert response == 0
+    assert stream.getvalue().strip() == f"Fixity scan succeeded for AIP: {aip_uuid}"
+    assert server.gets == [
+        f"/api/v2/file/{aip_uuid}/",
+        f"/api/v2/file/{aip_uuid}/check_fixity/",
+    ]
+
+
+def test_async_scanall_reports_unreachable_storage_service(monkeypatch):
+    monkeypatch.setenv("STORAGE_SERVICE_URL", "http://127.0.0.1:1/")
+    monkeypatch.setenv("STORAGE_SERVICE_USER", STORAGE_SERVICE_USER)
+    monkeypatch.setenv("STORAGE_SERVICE_KEY", STORAGE_SERVICE_KEY)
+
+    response = fixity.main(["scanall", "--engine", "async"])
+
+    assert str(response) == (
+        "Unable to connect to storage service instance at http://127.0.0.1:1/ (is it running?)"
+    )
+
+
+def test_async_scanall_with_adaptive_throttle(server):
+    stream = io.StringIO()
+
+    response = fixity.main(
+        ["scanall", "--engine", "async", "--workers", "4", "--throttle", "auto"],
+        stream=stream,
+    )
+
+    assert response == 1
+    assert "Successfully scanned 8 AIPs" in stream.getvalue()
+    # Scans start one at a time and concurrency only grows with responses.
+    assert server.max_in_flight < 4
+
+
+def test_async_scanall_looks_up_aips_in_batches(monkeypatch):
+    aip_uuids = [str(uuid.uuid4()) for _ in range(20)]
+    aip_queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT") and "FROM aips" in statement:
+            aip_queries.append(statement)
+
+    with StubServer(aip_uuids, scan_time=0) as server:
+        monkeypatch.setenv("STORAGE_SERVICE_URL", server.url)
+        monkeypatch.setenv("STORAGE_SERVICE_USER", STORAGE_SERVICE_USER)
+        monkeypatch.setenv("STORAGE_SERVICE_KEY", STORAGE_SERVICE_KEY)
+        event.listen(models.engine, "before_cursor_execute", record)
+        try:
+            response = fixity.main(["scanall", "--engine", "async", "--workers", "4"])
+        finally:
+            event.remove(models.engine, "before_cursor_execute", record)
+
+    assert response == 0
+    # Batches of 1, 2, 4, 8 and 5 AIPs, each looked up before and after
+    # adding them, rather than one lookup per AIP.
+    assert len(aip_queries) == 10
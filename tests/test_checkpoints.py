@@ -0,0 +1,51 @@
+from unittest import mock
+
+from fixity import checkpoints
+from fixity.models import ScannedAIP
+from fixity.models import ScanSession
+from fixity.models import Session
+
+
+def test_start_session_creates_a_new_session():
+    session = Session()
+
+    scan_session = checkpoints.start_session(session)
+
+    assert scan_session.id is not None
+    assert scan_session.ended is None
+    assert checkpoints.scanned_aips(session, scan_session) == set()
+    assert checkpoints.start_session(session, checkpoints.LATEST) == scan_session
+    assert checkpoints.start_session(session, scan_session.uuid) == scan_session
+    session.close()
+
+
+def test_start_session_only_resumes_unfinished_sessions():
+    session = Session()
+    scan_session = checkpoints.start_session(session)
+    checkpoints.Checkpointer(session, scan_session).finish()
+
+    assert checkpoints.start_session(session, scan_session.uuid) is None
+    assert checkpoints.start_session(session, "not-a-session") is None
+    session.close()
+
+
+def test_checkpointer_commits_periodically():
+    session = mock.Mock()
+    scan_session = ScanSession(id=1)
+    checkpointer = checkpoints.Checkpointer(
+        session, scan_session, every=3, interval=3600
+    )
+
+    for aip_uuid in ["a", "b", "c", "d"]:
+        checkpointer.done(aip_uuid)
+
+    assert session.add.call_count == 4
+    added = session.add.call_args.args[0]
+    assert isinstance(added, ScannedAIP)
+    assert (added.session_id, added.aip_uuid) == (1, "d")
+    assert session.commit.call_count == 1
+
+    checkpointer.finish()
+
+    assert session.commit.call_count == 2
+    assert scan_session.ended is not None
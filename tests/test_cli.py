@@ -0,0 +1,49 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from fixity import checkpoints
+from fixity import cli
+from fixity import models
+from fixity import outbox
+from fixity import retention
+from fixity import work_queue
+
+REPO_ROOT = Path(__file__).parent.parent
+
+
+def test_invalid_arguments_are_rejected_before_importing_the_scanning_code():
+    code = (
+        "import sys\n"
+        "from fixity import cli\n"
+        "assert isinstance(cli.main(['scan']), cli.ArgumentError)\n"
+        "loaded = {'fixity.fixity', 'fixity.models', 'requests', 'sqlalchemy'}\n"
+        "print(sorted(loaded & set(sys.modules)))\n"
+    )
+
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout == "[]\n"
+
+
+def test_missing_environment_variables_are_reported(monkeypatch):
+    monkeypatch.delenv("STORAGE_SERVICE_URL", raising=False)
+
+    response = cli.main(["scanall"])
+
+    assert isinstance(response, cli.ArgumentError)
+    assert str(response) == "Missing environment variable: STORAGE_SERVICE_URL"
+
+
+def test_defaults_match_the_scanning_code():
+    assert cli.LATEST == checkpoints.LATEST
+    assert cli.LEASE_DURATION == work_queue.LEASE_DURATION
+    assert cli.KEEP == retention.KEEP
+    assert cli.BULK_INTERVAL == outbox.BULK_INTERVAL
+    assert cli.FAILURE_KINDS == models.FAILURE_KINDS
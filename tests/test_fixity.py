@@ -1,20 +1,37 @@
+import collections
 import io
+import itertools
 import json
+import pathlib
+import re
+import threading
+import time
 import uuid
 from datetime import datetime
 from datetime import timezone
+from typing import Any
 from typing import TextIO
 from unittest import mock
 
 import pytest
 import requests
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import select
 
 from fixity import fixity
+from fixity import models
 from fixity import reporting
 from fixity.fixity import ArgumentError
+from fixity.models import AIP
+from fixity.models import QueuedAIP
 from fixity.models import Report
+from fixity.models import ScanSession
 from fixity.models import Session
 from fixity.storage_service import StorageServiceError
+from fixity.throttle import AdaptiveThrottle
+
+from .stub_server import StubServer
 
 SESSION = Session()
 STORAGE_SERVICE_URL = "http://localhost:8000/"
@@ -57,12 +74,28 @@ def mock_check_fixity() -> list[mock.Mock]:
     ]
 
 
-def _assert_stream_content_matches(stream: TextIO, expected: list[str]) -> None:
+# Throughput depends on timing, so only its format is checked.
+THROUGHPUT = re.compile(r"Throughput: \d+\.\d{2} AIPs/s, \d+ bytes/s")
+
+
+def _matching_lines(
+    lines: list[str], expected: list[str | re.Pattern[str]]
+) -> list[str | re.Pattern[str]]:
+    return [
+        pattern if isinstance(pattern, re.Pattern) and pattern.fullmatch(line) else line
+        for line, pattern in itertools.zip_longest(lines, expected, fillvalue="")
+    ]
+
+
+def _assert_stream_content_matches(
+    stream: TextIO, expected: list[str | re.Pattern[str]]
+) -> None:
     stream.seek(0)
-    assert [line.strip() for line in stream.readlines()] == expected
+    lines = [line.strip() for line in stream.readlines()]
+    assert _matching_lines(lines, expected) == expected
 
 
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_scan(
     _get: mock.Mock, environment: None, mock_check_fixity: list[mock.Mock]
 ) -> None:
@@ -90,7 +123,7 @@ def test_scan(
 
 @mock.patch("time.time_ns")
 @mock.patch("time.time")
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_scan_if_timestamps_argument_is_passed(
     _get: mock.Mock,
     time: mock.Mock,
@@ -128,9 +161,9 @@ def test_scan_if_timestamps_argument_is_passed(
 
 @mock.patch("fixity.fixity.uuid4")
 @mock.patch("fixity.utils.utcnow")
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 @mock.patch(
-    "requests.post",
+    "requests.Session.post",
     side_effect=[
         mock.Mock(status_code=201, spec=requests.Response),
         mock.Mock(status_code=201, spec=requests.Response),
@@ -196,10 +229,10 @@ def test_scan_if_report_url_exists(
 
 
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
 )
 @mock.patch(
-    "requests.post",
+    "requests.Session.post",
     side_effect=[
         mock.Mock(
             status_code=404,
@@ -240,7 +273,7 @@ def test_scan_handles_exceptions_if_report_url_exists(
 
 
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -275,7 +308,7 @@ def test_scan_handles_exceptions(_get: mock.Mock, environment: None) -> None:
 
 
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
     side_effect=[
         mock.Mock(
             **{
@@ -305,6 +338,34 @@ def test_scan_handles_exceptions_if_no_scan_attempted(
     assert Report(aip_id=aip_id).success is None
 
 
+@mock.patch(
+    "requests.Session.get",
+    side_effect=[
+        mock.Mock(**{"status_code": 200}, spec=requests.Response),
+        requests.ConnectionError,
+    ],
+)
+def test_scan_links_exception_reports_to_the_aip(
+    _get: mock.Mock, environment: None
+) -> None:
+    aip_id = str(uuid.uuid4())
+
+    fixity.main(["scan", aip_id])
+
+    session = Session()
+    aip = session.scalars(select(AIP).where(AIP.uuid == aip_id)).one()
+    report = session.scalars(select(Report).where(Report.aip_id == aip.id)).one()
+    assert report.success is None
+    assert json.loads(report.report)["message"].startswith(
+        f"Exception encountered while scanning AIP {aip_id}"
+    )
+    assert (
+        session.scalar(select(func.count(Report.id)).where(Report.aip_id == aip_id))
+        == 0
+    )
+    session.close()
+
+
 @pytest.mark.parametrize(
     "status, error_message",
     [
@@ -327,11 +388,9 @@ def test_scan_message(status: bool, error_message: str) -> None:
 
 
 @mock.patch(
-    "requests.get",
+    "requests.Session.get",
 )
-def test_scanall(
-    _get: mock.Mock, environment: None, mock_check_fixity: list[mock.Mock]
-) -> None:
+def test_scanall(_get: mock.Mock, environment: None) -> None:
     aip1_uuid = str(uuid.uuid4())
     aip2_uuid = str(uuid.uuid4())
     _get.side_effect = [
@@ -356,8 +415,8 @@ def test_scanall(
             },
             spec=requests.Response,
         ),
-        *mock_check_fixity,
-        *mock_check_fixity,
+        mock_scan_aip,
+        mock_scan_aip,
     ]
     stream = io.StringIO()
 
@@ -371,11 +430,22 @@ def test_scanall(
             f"Fixity scan succeeded for AIP: {aip1_uuid}",
             f"Fixity scan succeeded for AIP: {aip2_uuid}",
             "Successfully scanned 2 AIPs",
+            THROUGHPUT,
         ],
     )
 
+    # AIPs found in the listing are scanned without asking the storage
+    # service about them again.
+    assert _get.mock_calls[1:] == [
+        mock.call(
+            f"{STORAGE_SERVICE_URL}api/v2/file/{aip_uuid}/check_fixity/",
+            params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
+        )
+        for aip_uuid in (aip1_uuid, aip2_uuid)
+    ]
+
 
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_scanall_handles_exceptions(_get: mock.Mock, environment: None) -> None:
     aip_id1 = str(uuid.uuid4())
     aip_id2 = str(uuid.uuid4())
@@ -422,7 +492,7 @@ def test_scanall_handles_exceptions(_get: mock.Mock, environment: None) -> None:
     ]
     stream = io.StringIO()
 
-    response = fixity.main(["scanall"], stream=stream)
+    response = fixity.main(["scanall", "--recheck-after", "0"], stream=stream)
 
     assert response == 1
 
@@ -432,11 +502,12 @@ def test_scanall_handles_exceptions(_get: mock.Mock, environment: None) -> None:
             f"Internal error encountered while scanning AIP {aip_id1} (StorageServiceError)",
             f'Storage service at "{STORAGE_SERVICE_URL}" failed authentication while scanning AIP {aip_id2}',
             "Successfully scanned 2 AIPs",
+            THROUGHPUT,
         ],
     )
 
 
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_main_handles_exceptions_if_scanall_fails(
     _get: mock.Mock, environment: None
 ) -> None:
@@ -485,7 +556,7 @@ def test_main_handles_exceptions_if_scanall_fails(
     ]
     stream = io.StringIO()
 
-    result = fixity.main(["scanall"], stream=stream)
+    result = fixity.main(["scanall", "--recheck-after", "0"], stream=stream)
 
     assert result == 1
 
@@ -495,14 +566,13 @@ def test_main_handles_exceptions_if_scanall_fails(
             f"Internal error encountered while scanning AIP {aip_id1} (StorageServiceError)",
             f'Storage service at "{STORAGE_SERVICE_URL}" failed authentication while scanning AIP {aip_id2}',
             "Successfully scanned 2 AIPs",
+            THROUGHPUT,
         ],
     )
 
 
-@mock.patch("requests.get")
-def test_scanall_if_sort_argument_is_passed(
-    _get: mock.Mock, environment: None, mock_check_fixity: list[mock.Mock]
-) -> None:
+@mock.patch("requests.Session.get")
+def test_scanall_if_sort_argument_is_passed(_get: mock.Mock, environment: None) -> None:
     aip1_uuid = str(uuid.uuid4())
     aip2_uuid = str(uuid.uuid4())
     aip3_uuid = str(uuid.uuid4())
@@ -539,14 +609,7 @@ def test_scanall_if_sort_argument_is_passed(
             },
             spec=requests.Response,
         ),
-        *mock_check_fixity,
-        mock.Mock(
-            **{
-                "status_code": 200,
-                "json.return_value": {},
-            },
-            spec=requests.Response,
-        ),
+        mock_scan_aip,
         mock.Mock(
             **{
                 "status_code": 500,
@@ -561,14 +624,7 @@ def test_scanall_if_sort_argument_is_passed(
             },
             spec=requests.Response,
         ),
-        *mock_check_fixity,
-        mock.Mock(
-            **{
-                "status_code": 200,
-                "json.return_value": {},
-            },
-            spec=requests.Response,
-        ),
+        mock_scan_aip,
         mock.Mock(
             **{
                 "status_code": 401,
@@ -591,48 +647,35 @@ def test_scanall_if_sort_argument_is_passed(
 
     assert response == 1
 
-    stream.seek(0)
-    assert [line.rstrip() for line in stream.readlines()] == [
-        f'Storage service at "{STORAGE_SERVICE_URL}" encountered an internal error while scanning AIP {aip2_uuid}',
-        f'Storage service at "{STORAGE_SERVICE_URL}" failed authentication while scanning AIP {aip4_uuid}',
-        f"Fixity scan succeeded for AIP: {aip1_uuid}",
-        f"Fixity scan succeeded for AIP: {aip3_uuid}",
-        "Successfully scanned 4 AIPs",
-    ]
+    _assert_stream_content_matches(
+        stream,
+        [
+            f'Storage service at "{STORAGE_SERVICE_URL}" encountered an internal error while scanning AIP {aip2_uuid}',
+            f'Storage service at "{STORAGE_SERVICE_URL}" failed authentication while scanning AIP {aip4_uuid}',
+            f"Fixity scan succeeded for AIP: {aip1_uuid}",
+            f"Fixity scan succeeded for AIP: {aip3_uuid}",
+            "Successfully scanned 4 AIPs",
+            THROUGHPUT,
+        ],
+    )
 
     assert _get.mock_calls == [
         mock.call(
             f"{STORAGE_SERVICE_URL}api/v2/file/",
             params={"username": "test", "api_key": "test"},
         ),
-        mock.call(
-            f"{STORAGE_SERVICE_URL}api/v2/file/{aip1_uuid}/",
-            params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
-        ),
         mock.call(
             f"{STORAGE_SERVICE_URL}api/v2/file/{aip1_uuid}/check_fixity/",
             params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
         ),
-        mock.call(
-            f"{STORAGE_SERVICE_URL}api/v2/file/{aip2_uuid}/",
-            params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
-        ),
         mock.call(
             f"{STORAGE_SERVICE_URL}api/v2/file/{aip2_uuid}/check_fixity/",
             params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
         ),
-        mock.call(
-            f"{STORAGE_SERVICE_URL}api/v2/file/{aip3_uuid}/",
-            params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
-        ),
         mock.call(
             f"{STORAGE_SERVICE_URL}api/v2/file/{aip3_uuid}/check_fixity/",
             params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
         ),
-        mock.call(
-            f"{STORAGE_SERVICE_URL}api/v2/file/{aip4_uuid}/",
-            params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
-        ),
         mock.call(
             f"{STORAGE_SERVICE_URL}api/v2/file/{aip4_uuid}/check_fixity/",
             params={"username": STORAGE_SERVICE_USER, "api_key": STORAGE_SERVICE_KEY},
@@ -640,7 +683,7 @@ def test_scanall_if_sort_argument_is_passed(
     ]
 
 
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_main_handles_exception_if_environment_key_is_missing(
     _get: mock.Mock, mock_check_fixity: list[mock.Mock]
 ) -> None:
@@ -652,7 +695,7 @@ def test_main_handles_exception_if_environment_key_is_missing(
     assert isinstance(response, ArgumentError)
 
 
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_scanall_handles_exception_if_storage_service_raises_exception(
     _get: mock.Mock, environment: None
 ) -> None:
@@ -674,7 +717,7 @@ def test_scanall_handles_exception_if_storage_service_raises_exception(
     assert isinstance(response, StorageServiceError)
 
 
-@mock.patch("requests.get")
+@mock.patch("requests.Session.get")
 def test_main_verifies_urls_with_trailing_slash(
     _get: mock.Mock,
     monkeypatch: pytest.MonkeyPatch,
@@ -712,3 +755,695 @@ def test_main_validates_arguments() -> None:
 
     assert str(response) == "An AIP UUID must be specified when scanning a single AIP"
     assert isinstance(response, ArgumentError)
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_with_workers(_get: mock.Mock, environment: None) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(6)]
+    failed_uuid = aip_uuids[3]
+    listing = mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "meta": {"next": None},
+                "objects": [
+                    {"package_type": "AIP", "status": "UPLOADED", "uuid": aip_uuid}
+                    for aip_uuid in aip_uuids
+                ],
+            },
+        },
+        spec=requests.Response,
+    )
+
+    def get(url: str, params: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/{failed_uuid}/check_fixity/":
+            return mock.Mock(status_code=500, spec=requests.Response)
+        if url.endswith("/check_fixity/"):
+            return mock_scan_aip
+        return mock.Mock(
+            **{"status_code": 200, "json.return_value": {}}, spec=requests.Response
+        )
+
+    _get.side_effect = get
+    stream = io.StringIO()
+
+    response = fixity.main(["scanall", "--workers", "3", "--sort"], stream=stream)
+
+    assert response == 1
+
+    stream.seek(0)
+    lines = [line.strip() for line in stream.readlines()]
+    assert lines[0] == (
+        f'Storage service at "{STORAGE_SERVICE_URL}" encountered an internal error while scanning AIP {failed_uuid}'
+    )
+    assert sorted(lines[1:-2]) == sorted(
+        f"Fixity scan succeeded for AIP: {aip_uuid}"
+        for aip_uuid in aip_uuids
+        if aip_uuid != failed_uuid
+    )
+    assert lines[-2] == "Successfully scanned 6 AIPs"
+    assert THROUGHPUT.fullmatch(lines[-1])
+    assert _get.call_count == 1 + len(aip_uuids)
+
+
+def test_main_validates_workers_argument(environment: None) -> None:
+    response = fixity.main(["scanall", "--workers", "0"])
+
+    assert str(response) == "The number of workers must be at least 1"
+    assert isinstance(response, ArgumentError)
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_scans_listed_aips_if_a_later_page_fails(
+    _get: mock.Mock, environment: None
+) -> None:
+    aip_uuid = str(uuid.uuid4())
+    first_page = mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "meta": {"next": "/api/v2/file/?offset=1"},
+                "objects": [
+                    {"package_type": "AIP", "status": "UPLOADED", "uuid": aip_uuid}
+                ],
+            },
+        },
+        spec=requests.Response,
+    )
+
+    # The second page is fetched in the background while the first AIP
+    # is being scanned, so route responses by URL rather than call order.
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return first_page
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/?offset=1":
+            return mock.Mock(status_code=504, spec=requests.Response)
+        return mock_scan_aip
+
+    _get.side_effect = get
+    stream = io.StringIO()
+
+    response = fixity.main(["scanall"], stream=stream)
+
+    assert (
+        str(response)
+        == f'Storage service at "{STORAGE_SERVICE_URL}" encountered a gateway timeout while requesting AIPs'
+    )
+    assert isinstance(response, StorageServiceError)
+    _assert_stream_content_matches(
+        stream,
+        [
+            f"Fixity scan succeeded for AIP: {aip_uuid}",
+            "Successfully scanned 1 AIPs",
+            THROUGHPUT,
+        ],
+    )
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_limits_concurrent_scans_per_location(
+    _get: mock.Mock, environment: None
+) -> None:
+    locations = {"slow": str(uuid.uuid4()), "fast": str(uuid.uuid4())}
+    aips = {
+        str(uuid.uuid4()): name for name in ("slow", "slow", "slow", "fast", "fast")
+    }
+    listing = mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "meta": {"next": None},
+                "objects": [
+                    {
+                        "package_type": "AIP",
+                        "status": "UPLOADED",
+                        "uuid": aip_uuid,
+                        "current_location": f"/api/v2/location/{locations[name]}/",
+                    }
+                    for aip_uuid, name in aips.items()
+                ],
+            },
+        },
+        spec=requests.Response,
+    )
+    lock = threading.Lock()
+    in_flight: collections.Counter[str] = collections.Counter()
+    max_in_flight: collections.Counter[str] = collections.Counter()
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        name = aips[url.split("/")[-3]]
+        with lock:
+            in_flight[name] += 1
+            max_in_flight[name] = max(max_in_flight[name], in_flight[name])
+        time.sleep(0.05)
+        with lock:
+            in_flight[name] -= 1
+        return mock_scan_aip
+
+    _get.side_effect = get
+    stream = io.StringIO()
+
+    response = fixity.main(
+        [
+            "scanall",
+            "--workers",
+            "4",
+            "--location-limit",
+            "3",
+            "--location-limit-override",
+            f"{locations['slow']}=1",
+        ],
+        stream=stream,
+    )
+
+    assert response == 0
+    assert max_in_flight == {"slow": 1, "fast": 2}
+    stream.seek(0)
+    lines = [line.strip() for line in stream.readlines()]
+    assert sorted(lines[:-2]) == sorted(
+        f"Fixity scan succeeded for AIP: {aip_uuid}" for aip_uuid in aips
+    )
+    assert lines[-2] == "Successfully scanned 5 AIPs"
+    assert THROUGHPUT.fullmatch(lines[-1])
+
+
+@pytest.mark.parametrize(
+    "override",
+    ["no-limit", "location=0", "location=many"],
+)
+def test_main_validates_location_limit_overrides(
+    environment: None, override: str
+) -> None:
+    response = fixity.main(["scanall", "--location-limit-override", override])
+
+    assert isinstance(response, ArgumentError)
+
+
+def test_scanall_with_adaptive_throttle_backs_off_when_scans_fail(
+    environment: None, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(12)]
+    history: list[tuple[str, int, float]] = []
+
+    class RecordingThrottle(AdaptiveThrottle):
+        """
+        Record the kind of every observation and the concurrency and delay
+        it leads to.
+        """
+
+        def observe(self, latency: float, status_code: int) -> None:
+            super().observe(latency, status_code)
+            kind = "overload" if status_code >= 500 else "response"
+            history.append((kind, self.concurrency, self.delay))
+
+        def observe_error(self) -> None:
+            super().observe_error()
+            history.append(("error", self.concurrency, self.delay))
+
+    monkeypatch.setattr(fixity, "AdaptiveThrottle", RecordingThrottle)
+
+    # The Storage Service copes with the first scans, then starts failing
+    # them, with a 5xx or by dropping the connection.
+    with StubServer(
+        aip_uuids,
+        failed_uuids=aip_uuids[8:10],
+        dropped_uuids=aip_uuids[10:],
+        scan_time=0.05,
+    ) as server:
+        monkeypatch.setenv("STORAGE_SERVICE_URL", server.url)
+        response = fixity.main(
+            [
+                "scanall",
+                "--workers",
+                "4",
+                "--throttle",
+                "auto",
+                "--throttle-max",
+                "0.1",
+            ]
+        )
+
+    assert response == 1
+    assert sorted(server.checks) == sorted(aip_uuids)
+    # Runs start with one scan at a time, and speed up as scans succeed.
+    assert history[0] == ("response", 2, 0)
+    assert server.max_in_flight > 1
+    # Both kinds of failure halve the concurrency and raise the delay.
+    kinds = [kind for kind, _, _ in history]
+    assert kinds.count("overload") == 2
+    assert kinds.count("error") == 2
+    for (_, before, _), (kind, after, delay) in itertools.pairwise(history):
+        if kind != "response":
+            assert after == max(1, before // 2)
+            assert delay == 0.1
+
+
+@pytest.mark.parametrize(
+    "bounds",
+    [["--throttle-min", "-1"], ["--throttle-min", "5", "--throttle-max", "1"]],
+)
+def test_main_validates_throttle_bounds(environment: None, bounds: list[str]) -> None:
+    response = fixity.main(["scanall", "--throttle", "auto", *bounds])
+
+    assert isinstance(response, ArgumentError)
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_resumes_an_interrupted_session(
+    _get: mock.Mock, environment: None
+) -> None:
+    first_uuid, second_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+    pages = {
+        f"{STORAGE_SERVICE_URL}api/v2/file/": {
+            "meta": {"next": "/api/v2/file/?offset=1"},
+            "objects": [
+                {"package_type": "AIP", "status": "UPLOADED", "uuid": first_uuid}
+            ],
+        },
+        f"{STORAGE_SERVICE_URL}api/v2/file/?offset=1": {
+            "meta": {"next": None},
+            "objects": [
+                {"package_type": "AIP", "status": "UPLOADED", "uuid": second_uuid}
+            ],
+        },
+    }
+    listing_fails = True
+    scanned = []
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url in pages:
+            if listing_fails and "offset" in url:
+                return mock.Mock(status_code=504, spec=requests.Response)
+            return mock.Mock(
+                **{"status_code": 200, "json.return_value": pages[url]},
+                spec=requests.Response,
+            )
+        scanned.append(url.split("/")[-3])
+        return mock_scan_aip
+
+    _get.side_effect = get
+
+    # The first run is interrupted by the listing failing after one AIP.
+    response = fixity.main(["scanall"])
+    assert isinstance(response, StorageServiceError)
+    assert scanned == [first_uuid]
+
+    listing_fails = False
+    stream = io.StringIO()
+    response = fixity.main(["scanall", "--resume"], stream=stream)
+
+    assert response == 0
+    assert scanned == [first_uuid, second_uuid]
+    scan_session = SESSION.scalars(
+        select(ScanSession).order_by(ScanSession.id.desc())
+    ).first()
+    assert scan_session.ended is not None
+    _assert_stream_content_matches(
+        stream,
+        [
+            f"Fixity scan succeeded for AIP: {second_uuid}",
+            "Successfully scanned 1 AIPs",
+            THROUGHPUT,
+            f"Skipped 1 AIPs already scanned in session {scan_session.uuid}",
+        ],
+    )
+
+    # A finished session can't be resumed.
+    response = fixity.main(["scanall", "--resume", scan_session.uuid])
+    assert isinstance(response, ArgumentError)
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_scans_stalest_aips_first(_get: mock.Mock, environment: None) -> None:
+    recent, never, old = (str(uuid.uuid4()) for _ in range(3))
+    for aip_uuid, ended in (
+        (recent, datetime(2024, 6, 1)),
+        (old, datetime(2021, 6, 1)),
+    ):
+        SESSION.add(
+            Report(aip=AIP(uuid=aip_uuid), ended=ended, success=True, report="{}")
+        )
+    SESSION.commit()
+    listing = mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "meta": {"next": None},
+                "objects": [
+                    {"package_type": "AIP", "status": "UPLOADED", "uuid": aip_uuid}
+                    for aip_uuid in (recent, never, old)
+                ],
+            },
+        },
+        spec=requests.Response,
+    )
+    scanned = []
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        scanned.append(url.split("/")[-3])
+        return mock_scan_aip
+
+    _get.side_effect = get
+
+    response = fixity.main(["scanall", "--order", "stalest"])
+
+    assert response == 0
+    assert scanned == [never, old, recent]
+
+
+def _listing(aip_uuids: list[str]) -> mock.Mock:
+    return mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "meta": {"next": None},
+                "objects": [
+                    {"package_type": "AIP", "status": "UPLOADED", "uuid": aip_uuid}
+                    for aip_uuid in aip_uuids
+                ],
+            },
+        },
+        spec=requests.Response,
+    )
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_stops_starting_scans_when_out_of_time(
+    _get: mock.Mock, environment: None
+) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(4)]
+    listing = _listing(aip_uuids)
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        time.sleep(0.1)
+        return mock_scan_aip
+
+    _get.side_effect = get
+    stream = io.StringIO()
+
+    # After the first scan, less time is left than a scan takes.
+    response = fixity.main(["scanall", "--max-duration", "0.15"], stream=stream)
+
+    assert response == fixity.BUDGET_EXHAUSTED
+    scan_session = SESSION.scalars(
+        select(ScanSession).order_by(ScanSession.id.desc())
+    ).first()
+    assert scan_session.ended is None
+    _assert_stream_content_matches(
+        stream,
+        [
+            f"Fixity scan succeeded for AIP: {aip_uuids[0]}",
+            "Successfully scanned 1 AIPs",
+            THROUGHPUT,
+            f"Time budget exhausted with 3 AIPs left to scan; continue with --resume {scan_session.uuid}",
+        ],
+    )
+    # The AIPs left are counted without being looked up or added.
+    assert (
+        SESSION.scalar(select(func.count(AIP.id)).where(AIP.uuid == aip_uuids[3])) == 0
+    )
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_with_a_past_deadline_scans_nothing(
+    _get: mock.Mock, environment: None
+) -> None:
+    _get.return_value = _listing([str(uuid.uuid4()) for _ in range(3)])
+    stream = io.StringIO()
+
+    response = fixity.main(
+        ["scanall", "--workers", "2", "--deadline", "2000-01-01T00:00"],
+        stream=stream,
+    )
+
+    assert response == fixity.BUDGET_EXHAUSTED
+    assert _get.call_count == 1
+    stream.seek(0)
+    assert stream.read().startswith("Time budget exhausted with 3 AIPs left to scan")
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_scans_largest_aips_first(_get: mock.Mock, environment: None) -> None:
+    sizes = {str(uuid.uuid4()): size for size in (10, 1000, 100)}
+    listing = _listing(list(sizes))
+    for aip in listing.json.return_value["objects"]:
+        aip["size"] = sizes[aip["uuid"]]
+    scanned = []
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        scanned.append(sizes[url.split("/")[-3]])
+        return mock_scan_aip
+
+    _get.side_effect = get
+    stream = io.StringIO()
+
+    response = fixity.main(["scanall", "--order", "largest"], stream=stream)
+
+    assert response == 0
+    assert scanned == [1000, 100, 10]
+    stream.seek(0)
+    assert THROUGHPUT.fullmatch(stream.readlines()[-1].strip())
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_only_scans_its_shard(_get: mock.Mock, environment: None) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(12)]
+    listing = _listing(aip_uuids)
+    scanned: list[str] = []
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        scanned.append(url.split("/")[-3])
+        return mock_scan_aip
+
+    _get.side_effect = get
+    shards = []
+    for index in (1, 2, 3):
+        scanned.clear()
+        response = fixity.main(["scanall", "--shard", f"{index}/3"])
+        assert response == 0
+        shards.append(set(scanned))
+        scan_session = SESSION.scalars(
+            select(ScanSession).order_by(ScanSession.id.desc())
+        ).first()
+        assert (scan_session.shard_index, scan_session.shard_count) == (index, 3)
+
+    assert set().union(*shards) == set(aip_uuids)
+    assert sum(len(shard) for shard in shards) == len(aip_uuids)
+
+
+@pytest.mark.parametrize("shard", ["1", "0/2", "3/2"])
+def test_main_validates_shard(environment: None, shard: str) -> None:
+    response = fixity.main(["scanall", "--shard", shard])
+
+    assert isinstance(response, ArgumentError)
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_through_the_work_queue(_get: mock.Mock, environment: None) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(5)]
+    listing = _listing(aip_uuids)
+    scanned = []
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        scanned.append(url.split("/")[-3])
+        return mock_scan_aip
+
+    _get.side_effect = get
+
+    response = fixity.main(["scanall", "--queue", "--workers", "2"])
+
+    assert response == 0
+    assert sorted(scanned) == sorted(aip_uuids)
+    scan_session = SESSION.scalars(
+        select(ScanSession).order_by(ScanSession.id.desc())
+    ).first()
+    assert scan_session.ended is not None
+    assert (
+        SESSION.scalars(
+            select(QueuedAIP.done).where(QueuedAIP.session_id == scan_session.id)
+        ).all()
+        == [True] * 5
+    )
+
+    # Workers can only join unfinished sessions.
+    response = fixity.main(["work", scan_session.uuid])
+    assert isinstance(response, ArgumentError)
+
+
+@mock.patch("requests.Session.get")
+def test_main_uses_the_database_url(
+    _get: mock.Mock,
+    environment: None,
+    mock_check_fixity: list[mock.Mock],
+    tmp_path: pathlib.Path,
+) -> None:
+    _get.side_effect = mock_check_fixity
+    aip_uuid = str(uuid.uuid4())
+    url = f"sqlite:///{tmp_path / 'fixity.db'}"
+    engine = models.engine
+
+    try:
+        response = fixity.main(["scan", aip_uuid, "--database-url", url])
+        session = Session()
+        reported = session.scalars(select(AIP.uuid).join(Report)).all()
+        session.close()
+    finally:
+        models.engine = engine
+        Session.configure(bind=engine)
+
+    assert response == 0
+    assert reported == [aip_uuid]
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_loads_aips_in_batches(_get: mock.Mock, environment: None) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(50)]
+    listing = _listing(aip_uuids)
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        return mock_scan_aip
+
+    _get.side_effect = get
+    aip_queries = []
+
+    def record(
+        conn: Any,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        if statement.startswith("SELECT") and "FROM aips" in statement:
+            aip_queries.append(statement)
+
+    event.listen(models.engine, "before_cursor_execute", record)
+    try:
+        response = fixity.main(["scanall"])
+    finally:
+        event.remove(models.engine, "before_cursor_execute", record)
+
+    assert response == 0
+    # Batches of 1, 2, 4, 8, 16 and 19 AIPs, each looked up before and
+    # after adding them.
+    assert len(aip_queries) == 12
+    assert SESSION.scalar(
+        select(func.count(Report.id)).join(AIP).where(AIP.uuid.in_(aip_uuids))
+    ) == len(aip_uuids)
+
+
+def test_batches_double_up_to_the_maximum_size() -> None:
+    assert list(fixity._batches(range(20), 5)) == [
+        [0],
+        [1, 2],
+        [3, 4, 5, 6],
+        [7, 8, 9, 10, 11],
+        [12, 13, 14, 15, 16],
+        [17, 18, 19],
+    ]
+
+
+@mock.patch("requests.Session.post")
+@mock.patch("requests.Session.get")
+def test_scanall_posts_reports_in_the_background(
+    _get: mock.Mock,
+    _post: mock.Mock,
+    environment: None,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(3)]
+    listing = _listing(aip_uuids)
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        return mock_scan_aip
+
+    _get.side_effect = get
+    _post.return_value = mock.Mock(status_code=201, spec=requests.Response)
+    monkeypatch.setenv("REPORT_URL", REPORT_URL)
+
+    response = fixity.main(["scanall", "--workers", "2"])
+
+    assert response == 0
+    for aip_uuid in aip_uuids:
+        bodies = [
+            json.loads(call.kwargs["data"])
+            for call in _post.mock_calls
+            if call.args[0] == f"{REPORT_URL}api/fixity/{aip_uuid}"
+        ]
+        assert ["success" in body for body in bodies] == [False, True]
+    assert SESSION.scalars(
+        select(Report.posted).join(AIP).where(AIP.uuid.in_(aip_uuids))
+    ).all() == [True, True, True]
+
+
+@mock.patch(
+    "requests.Session.post",
+    side_effect=[
+        mock.Mock(status_code=201, spec=requests.Response),
+        mock.Mock(status_code=503, spec=requests.Response),
+    ],
+)
+@mock.patch("requests.Session.get")
+def test_scan_queues_reports_it_could_not_post(
+    _get: mock.Mock,
+    _post: mock.Mock,
+    environment: None,
+    mock_check_fixity: list[mock.Mock],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    _get.side_effect = mock_check_fixity
+    monkeypatch.setenv("REPORT_URL", REPORT_URL)
+    aip_id = str(uuid.uuid4())
+
+    response = fixity.main(["scan", aip_id])
+
+    assert response == 0
+    post = SESSION.scalars(
+        select(models.ReportPost).where(models.ReportPost.aip_uuid == aip_id)
+    ).one()
+    assert post.report.posted is False
+    assert post.attempts == 0
+
+
+@mock.patch("requests.Session.get")
+def test_scanall_sends_reports_in_bulk(
+    _get: mock.Mock, environment: None, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    aip_uuids = [str(uuid.uuid4()) for _ in range(4)]
+    listing = _listing(aip_uuids)
+
+    def get(url: str, **kwargs: dict[str, str]) -> mock.Mock:
+        if url == f"{STORAGE_SERVICE_URL}api/v2/file/":
+            return listing
+        return mock_scan_aip
+
+    _get.side_effect = get
+
+    with StubServer() as server:
+        monkeypatch.setenv("REPORT_URL", server.url)
+        response = fixity.main(["scanall", "--report-batch-size", "10"])
+
+    assert response == 0
+    assert {path for path, _ in server.posts} == {"/api/fixity/bulk"}
+    for aip_uuid in aip_uuids:
+        assert [
+            kind for received, kind in server.reports() if received == aip_uuid
+        ] == ["pre-scan", "report"]
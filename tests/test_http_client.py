@@ -0,0 +1,68 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+import pytest
+import requests
+
+from fixity.http_client import HTTPClient
+from fixity.http_client import http_for
+
+STORAGE_SERVICE_URL = "http://localhost:8000/"
+REPORT_URL = "http://localhost:8003/"
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+@pytest.fixture
+def server():
+    server = HTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    server.client_ports = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_client_mounts_a_pool_per_service():
+    client = HTTPClient(
+        STORAGE_SERVICE_URL, REPORT_URL, ss_pool_size=4, report_pool_size=2
+    )
+
+    ss_adapter = client.session.get_adapter(f"{STORAGE_SERVICE_URL}api/v2/file/")
+    report_adapter = client.session.get_adapter(f"{REPORT_URL}api/fixity/")
+
+    assert ss_adapter is not report_adapter
+    assert ss_adapter._pool_maxsize == 4
+    assert report_adapter._pool_maxsize == 2
+    assert ss_adapter._pool_block is True
+
+
+def test_client_reuses_connections(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    with HTTPClient(url) as client:
+        for _ in range(5):
+            assert client.get(url + "api/v2/file/").status_code == 200
+
+    assert len(server.client_ports) == 1
+
+
+def test_http_for_falls_back_to_requests():
+    client = HTTPClient(STORAGE_SERVICE_URL)
+
+    assert http_for(None) is requests
+    assert http_for(client) is client
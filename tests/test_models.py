@@ -0,0 +1,494 @@
+import json
+from datetime import date
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import insert
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy import text
+
+from fixity import models
+
+
+def test_add_missing_columns_upgrades_existing_tables():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE scan_sessions ("
+                "id INTEGER PRIMARY KEY, uuid VARCHAR(36) NOT NULL, "
+                "started DATETIME, ended DATETIME)"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO scan_sessions (id, uuid) VALUES (1, 'session')")
+        )
+
+    models.add_missing_columns(engine)
+
+    columns = {c["name"] for c in inspect(engine).get_columns("scan_sessions")}
+    assert {"shard_index", "shard_count"} <= columns
+    with engine.connect() as connection:
+        assert connection.execute(
+            text("SELECT uuid, shard_count FROM scan_sessions")
+        ).all() == [("session", None)]
+    # Tables that don't exist yet are left to create_all().
+    assert not inspect(engine).has_table("reports")
+
+
+def test_add_missing_indexes_merges_duplicate_aips():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE aips (id INTEGER PRIMARY KEY, uuid VARCHAR(36) NOT NULL)"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE reports (id INTEGER PRIMARY KEY, aip_id INTEGER, "
+                "begun DATETIME, ended DATETIME, success BOOLEAN, posted BOOLEAN, "
+                "report TEXT)"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO aips (id, uuid) VALUES (1, 'a'), (2, 'b'), (3, 'a')")
+        )
+        connection.execute(
+            text("INSERT INTO reports (id, aip_id) VALUES (1, 1), (2, 2), (3, 3)")
+        )
+
+    models.add_missing_indexes(engine)
+
+    indexes = {
+        index["name"]: index
+        for table in ("aips", "reports")
+        for index in inspect(engine).get_indexes(table)
+    }
+    assert indexes["ix_aips_uuid"]["unique"]
+    assert indexes["ix_reports_aip_id_ended"]["column_names"] == ["aip_id", "ended"]
+    with engine.connect() as connection:
+        assert connection.execute(
+            text("SELECT id, uuid FROM aips ORDER BY id")
+        ).all() == [(1, "a"), (2, "b")]
+        assert connection.execute(
+            text("SELECT id, aip_id FROM reports ORDER BY id")
+        ).all() == [(1, 1), (2, 2), (3, 1)]
+
+
+def test_aip_lookups_use_the_uuid_index():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+
+    with engine.connect() as connection:
+        plan = connection.execute(
+            text("EXPLAIN QUERY PLAN SELECT id FROM aips WHERE uuid = 'a'")
+        ).all()
+
+    assert "USING COVERING INDEX ix_aips_uuid" in plan[0][-1]
+
+
+@pytest.fixture
+def restore_engine():
+    engine = models.engine
+    yield
+    models.engine = engine
+    models.Session.configure(bind=engine)
+
+
+def test_configure_connects_sessions_to_the_database_url(tmp_path, restore_engine):
+    url = f"sqlite:///{tmp_path / 'fixity.db'}"
+
+    engine = models.configure(url)
+
+    assert models.engine is engine
+    assert str(models.Session().get_bind().url) == url
+    assert {"aips", "reports", "scan_sessions"} <= set(
+        inspect(engine).get_table_names()
+    )
+
+
+def test_configure_reads_the_environment(tmp_path, monkeypatch, restore_engine):
+    url = f"sqlite:///{tmp_path / 'env.db'}"
+    monkeypatch.setenv(models.DATABASE_URL_VARIABLE, url)
+
+    engine = models.configure()
+
+    assert str(engine.url) == url
+
+
+def test_reports_are_inserted_in_bulk(tmp_path, restore_engine):
+    engine = models.configure(f"sqlite:///{tmp_path / 'fixity.db'}")
+    executions = []
+
+    @event.listens_for(engine, "before_execute")
+    def record(conn, clauseelement, multiparams, params, execution_options):
+        if str(clauseelement).startswith("INSERT INTO reports"):
+            executions.append(len(multiparams))
+
+    session = models.Session()
+    aip = models.AIP(uuid="a7f2a05b-0fdf-42f1-a46c-4522a831cf17")
+    session.add_all(models.Report(aip=aip, success=True) for _ in range(50))
+    session.commit()
+
+    assert executions == [50]
+    assert session.query(models.Report).count() == 50
+    session.close()
+
+
+def test_sessions_connect_to_the_database_on_first_use(
+    tmp_path, monkeypatch, restore_engine
+):
+    url = f"sqlite:///{tmp_path / 'lazy.db'}"
+    monkeypatch.setenv(models.DATABASE_URL_VARIABLE, url)
+    models.engine = None
+
+    session = models.Session()
+
+    assert str(models.engine.url) == url
+    assert session.get_bind() is models.engine
+    session.close()
+
+
+def test_sqlite_databases_use_write_ahead_logging(tmp_path, restore_engine):
+    engine = models.configure(f"sqlite:///{tmp_path / 'fixity.db'}")
+
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1
+
+
+FAILED_REPORT = json.dumps(
+    {
+        "success": False,
+        "message": "invalid bag",
+        "started": 1400022946,
+        "finished": 1400022946,
+        "failures": {
+            "files": {
+                "changed": [{"path": f"data/objects/{n}.jp2"} for n in range(500)],
+                "missing": [{"path": "manifest-sha512.txt"}],
+                "untracked": [],
+            }
+        },
+    }
+)
+
+
+def test_reports_are_stored_compressed_and_summarized():
+    report = models.Report(report=FAILED_REPORT)
+
+    assert report.report == FAILED_REPORT
+    assert report.legacy_report is None
+    assert len(report.compressed_report) < len(FAILED_REPORT) / 10
+    assert (report.message, report.started, report.finished) == (
+        "invalid bag",
+        1400022946,
+        1400022946,
+    )
+    assert (report.changed_count, report.missing_count, report.untracked_count) == (
+        500,
+        1,
+        0,
+    )
+
+
+def test_reports_that_are_not_json_objects_are_stored_as_is():
+    report = models.Report(report="not JSON")
+
+    assert report.report == "not JSON"
+    assert report.message is None
+    assert report.changed_count is None
+
+
+def test_reports_keep_the_scan_result_they_are_set_from(monkeypatch):
+    data = json.loads(FAILED_REPORT)
+    result = models.ScanResult(data)
+    report = models.Report(report=result)
+
+    assert report.result is result
+    assert json.loads(report.report) == data
+    assert len(report.pending_failures) == 501
+    # The report was serialized once, and isn't decompressed or parsed
+    # again to be read.
+    monkeypatch.setattr(models, "parse_report", None)
+    monkeypatch.setattr(models.zlib, "decompress", None)
+    assert report.report is result.text
+    assert report.result.message == "invalid bag"
+
+
+def test_scan_results_are_parsed_from_reports_read_back():
+    report = models.Report(report=FAILED_REPORT)
+    report._result = None
+
+    assert report.result.data == json.loads(FAILED_REPORT)
+    assert report.result.text == FAILED_REPORT
+    assert report.result is report.result
+
+
+def test_scan_result_fields_are_appended_to_the_text():
+    result = models.ScanResult({"success": True, "message": ""}, '{"success": true}')
+
+    assert result.text_with() == '{"success": true}'
+    assert (
+        result.text_with(session_uuid="session")
+        == '{"success": true, "session_uuid": "session"}'
+    )
+    # Fields already in the report replace it.
+    assert json.loads(result.text_with(message="scanned")) == {
+        "success": True,
+        "message": "scanned",
+    }
+    assert models.ScanResult({}).text_with(session_uuid="session") == (
+        '{"session_uuid": "session"}'
+    )
+    # Reports that aren't JSON objects can't have fields added.
+    assert models.ScanResult.parse("not JSON").text_with(session_uuid="session") == (
+        "not JSON"
+    )
+
+
+def test_configure_compacts_reports_of_earlier_versions(tmp_path, restore_engine):
+    path = tmp_path / "fixity.db"
+    legacy = create_engine(f"sqlite:///{path}")
+    with legacy.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE reports (id INTEGER PRIMARY KEY, aip_id INTEGER, "
+                "begun DATETIME, ended DATETIME, success BOOLEAN, posted BOOLEAN, "
+                "report VARCHAR(1000))"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO reports (id, report) VALUES (1, :report), (2, NULL)"),
+            {"report": FAILED_REPORT},
+        )
+    legacy.dispose()
+
+    models.configure(f"sqlite:///{path}")
+
+    session = models.Session()
+    first, second = session.scalars(
+        select(models.Report).order_by(models.Report.id)
+    ).all()
+    assert first.legacy_report is None
+    assert first.report == FAILED_REPORT
+    assert first.changed_count == 500
+    assert second.report is None
+    session.close()
+
+
+def test_compact_reports_works_in_batches():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(models.Report.__table__),
+            [{"report": json.dumps({"message": str(n)})} for n in range(5)],
+        )
+
+    assert models.compact_reports(engine, batch_size=2) == 5
+    assert models.compact_reports(engine) == 0
+    with engine.connect() as connection:
+        messages = connection.scalars(select(models.Report.message)).all()
+    assert sorted(messages) == ["0", "1", "2", "3", "4"]
+
+
+def test_file_failures_are_saved_with_their_report(tmp_path, restore_engine):
+    models.configure(f"sqlite:///{tmp_path / 'fixity.db'}")
+    session = models.Session()
+    aip = models.AIP(uuid="a7f2a05b-0fdf-42f1-a46c-4522a831cf17")
+    report = models.Report(aip=aip, success=False, report=FAILED_REPORT)
+    session.add(report)
+    session.commit()
+
+    failures = session.scalars(select(models.FileFailure)).all()
+    assert len(failures) == 501
+    assert {(failure.report_id, failure.aip_id) for failure in failures} == {
+        (report.id, aip.id)
+    }
+    assert ("missing", "manifest-sha512.txt") in {
+        (failure.kind, failure.path) for failure in failures
+    }
+    session.close()
+
+
+def test_configure_indexes_the_failures_of_earlier_reports(tmp_path, restore_engine):
+    path = tmp_path / "fixity.db"
+    legacy = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(legacy)
+    with legacy.begin() as connection:
+        connection.execute(
+            insert(models.Report.__table__),
+            [
+                {
+                    "aip_id": 1,
+                    **models.compact_report(FAILED_REPORT, json.loads(FAILED_REPORT)),
+                },
+                {"aip_id": 2, **models.compact_report("{}", {})},
+            ],
+        )
+        connection.execute(text("DROP TABLE file_failures"))
+    legacy.dispose()
+
+    models.configure(f"sqlite:///{path}")
+
+    session = models.Session()
+    rows = session.execute(
+        select(models.FileFailure.report_id, models.FileFailure.aip_id).distinct()
+    ).all()
+    assert rows == [(1, 1)]
+    assert session.query(models.FileFailure).count() == 501
+    session.close()
+
+
+def latest_status(session, aip):
+    status = session.get(models.LatestStatus, aip.id)
+    session.refresh(status)
+    return (
+        status.last_result,
+        status.last_scanned,
+        status.last_success,
+        status.consecutive_failures,
+    )
+
+
+def test_latest_status_is_updated_as_reports_are_saved():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = models.Session(bind=engine)
+    aip = models.AIP(uuid="a7f2a05b-0fdf-42f1-a46c-4522a831cf17")
+    day = [datetime(2024, 5, n) for n in range(1, 6)]
+
+    session.add(models.Report(aip=aip, ended=day[1], success=True))
+    session.commit()
+    assert latest_status(session, aip) == (True, day[1], day[1], 0)
+
+    # Failures, and scans that couldn't be made, in one flush.
+    session.add_all(
+        [
+            models.Report(aip=aip, ended=day[3], success=None),
+            models.Report(aip=aip, ended=day[2], success=False),
+        ]
+    )
+    session.commit()
+    assert latest_status(session, aip) == (None, day[3], day[1], 1)
+
+    session.add(models.Report(aip=aip, ended=day[4], success=False))
+    session.commit()
+    assert latest_status(session, aip) == (False, day[4], day[1], 2)
+
+    # Reports of earlier scans saved late don't change it.
+    session.add(models.Report(aip=aip, ended=day[0], success=True))
+    session.commit()
+    assert latest_status(session, aip) == (False, day[4], day[1], 2)
+
+    assert models.rebuild_latest_status(engine, batch_size=1) == 1
+    assert latest_status(session, aip) == (False, day[4], day[1], 2)
+    session.close()
+
+
+def test_reports_of_unknown_aips_have_no_latest_status():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = models.Session(bind=engine)
+
+    session.add(
+        models.Report(
+            aip_id="a7f2a05b-0fdf-42f1-a46c-4522a831cf17",
+            ended=datetime(2024, 5, 1),
+            success=None,
+        )
+    )
+    session.commit()
+
+    assert session.query(models.LatestStatus).count() == 0
+    session.close()
+
+
+def test_configure_builds_the_latest_status_of_earlier_reports(
+    tmp_path, restore_engine
+):
+    path = tmp_path / "fixity.db"
+    legacy = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(legacy)
+    with legacy.begin() as connection:
+        connection.execute(
+            insert(models.AIP), [{"uuid": "a"}, {"uuid": "b"}, {"uuid": "c"}]
+        )
+        connection.execute(
+            insert(models.Report.__table__),
+            [
+                {"aip_id": 1, "ended": datetime(2024, 5, 1), "success": True},
+                {"aip_id": 1, "ended": datetime(2024, 5, 2), "success": False},
+                {"aip_id": 2, "ended": datetime(2024, 5, 2), "success": True},
+                {"aip_id": 3, "ended": datetime(2024, 5, 2), "success": False},
+            ],
+        )
+        connection.execute(
+            insert(models.ReportRollup),
+            [
+                {
+                    "aip_id": aip_id,
+                    "month": date(2024, 4, 1),
+                    "success_count": 3,
+                    "last_ended": datetime(2024, 4, 30),
+                }
+                for aip_id in (1, 3)
+            ],
+        )
+        connection.execute(text("DROP TABLE latest_status"))
+    legacy.dispose()
+
+    models.configure(f"sqlite:///{path}")
+
+    session = models.Session()
+    statuses = session.execute(
+        select(
+            models.LatestStatus.aip_id,
+            models.LatestStatus.last_result,
+            models.LatestStatus.last_success,
+            models.LatestStatus.consecutive_failures,
+        ).order_by(models.LatestStatus.aip_id)
+    ).all()
+    assert statuses == [
+        (1, False, datetime(2024, 5, 1), 1),
+        (2, True, datetime(2024, 5, 2), 0),
+        (3, False, datetime(2024, 4, 30), 1),
+    ]
+    session.close()
+
+
+def test_configure_queues_the_reports_earlier_versions_could_not_post(
+    tmp_path, restore_engine
+):
+    path = tmp_path / "fixity.db"
+    legacy = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(legacy)
+    with legacy.begin() as connection:
+        connection.execute(insert(models.AIP), [{"uuid": "a"}, {"uuid": "b"}])
+        connection.execute(
+            insert(models.Report.__table__),
+            [
+                {"aip_id": 1, "success": True, "posted": False},
+                {"aip_id": 1, "success": True, "posted": True},
+                {"aip_id": 2, "success": False, "posted": False},
+                {"aip_id": 2, "success": None, "posted": False},
+            ],
+        )
+        connection.execute(text("DROP TABLE report_posts"))
+    legacy.dispose()
+
+    models.configure(f"sqlite:///{path}")
+
+    session = models.Session()
+    queued = session.execute(
+        select(models.ReportPost.report_id, models.ReportPost.aip_uuid).order_by(
+            models.ReportPost.report_id
+        )
+    ).all()
+    assert queued == [(1, "a"), (3, "b")]
+    session.close()
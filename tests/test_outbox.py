@@ -0,0 +1,263 @@
+import io
+import json
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy import select
+
+from fixity import models
+from fixity import outbox
+from fixity import utils
+from fixity.cli import main
+from fixity.models import AIP
+from fixity.models import Report
+from fixity.models import ReportPost
+from fixity.outbox import ReportOutbox
+
+from .stub_server import StubServer
+
+REPORT_URL = "http://localhost:8003/"
+REPORT = json.dumps({"success": True, "message": ""})
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fixity.db'}")
+    models.Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def queue_reports(engine, count, success=True, session_id=None):
+    """
+    Save count reports of new AIPs queued to be posted, and return the
+    UUIDs of their AIPs.
+    """
+    session = models.Session(bind=engine)
+    aip_uuids = []
+    for _ in range(count):
+        aip_uuids.append(str(uuid.uuid4()))
+        report = Report(aip=AIP(uuid=aip_uuids[-1]), success=success, report=REPORT)
+        outbox.queue_report(report, aip_uuids[-1], session_id=session_id)
+        session.add(report)
+    session.commit()
+    session.close()
+    return aip_uuids
+
+
+def posts(engine):
+    session = models.Session(bind=engine)
+    rows = session.execute(
+        select(ReportPost.aip_uuid, ReportPost.attempts, Report.posted).join(
+            Report, ReportPost.report_id == Report.id
+        )
+    ).all()
+    session.close()
+    return rows
+
+
+def response(status_code):
+    return mock.Mock(status_code=status_code, spec=requests.Response)
+
+
+def test_reports_of_scans_that_could_not_be_made_are_not_queued():
+    report = Report(success=None, report=REPORT)
+
+    outbox.queue_report(report, str(uuid.uuid4()))
+
+    assert report.post is None
+    assert report.posted is None
+
+
+@mock.patch("requests.post")
+def test_flush_posts_the_queued_reports(_post, engine):
+    aip_uuids = queue_reports(engine, 3, session_id="session")
+    _post.side_effect = [response(201), response(500), response(201)]
+
+    assert ReportOutbox(engine, REPORT_URL, workers=1).flush() == (2, 1)
+
+    assert [call.args[0] for call in _post.mock_calls] == [
+        f"{REPORT_URL}api/fixity/{aip_uuid}" for aip_uuid in aip_uuids
+    ]
+    assert json.loads(_post.mock_calls[0].kwargs["data"])["session_uuid"] == "session"
+    assert posts(engine) == [(aip_uuids[1], 1, False)]
+    session = models.Session(bind=engine)
+    assert session.scalars(select(Report.posted).order_by(Report.id)).all() == [
+        True,
+        False,
+        True,
+    ]
+    session.close()
+
+
+@mock.patch("requests.post")
+def test_failed_posts_are_retried_later(_post, engine):
+    [aip_uuid] = queue_reports(engine, 1)
+    _post.return_value = response(503)
+    reports = ReportOutbox(engine, REPORT_URL)
+
+    assert reports.flush() == (0, 1)
+    # Not due yet.
+    assert reports.flush() == (0, 0)
+    assert reports.flush(due_only=False) == (0, 1)
+
+    assert posts(engine) == [(aip_uuid, 2, False)]
+    session = models.Session(bind=engine)
+    post = session.scalars(select(ReportPost)).one()
+    assert post.claimed_by is None
+    assert post.next_attempt > utils.utcnow().replace(tzinfo=None) + timedelta(
+        seconds=outbox.RETRY_DELAY
+    )
+    assert post.last_error
+    session.close()
+
+
+def test_retry_delays_double_up_to_the_maximum():
+    assert [outbox.retry_delay(attempts) for attempts in (1, 2, 3)] == [60, 120, 240]
+    assert outbox.retry_delay(20) == outbox.MAX_RETRY_DELAY
+
+
+@mock.patch("requests.post")
+def test_posts_claimed_by_another_process_are_left_alone(_post, engine):
+    queue_reports(engine, 1)
+    other = ReportOutbox(engine, REPORT_URL)
+    other._claim(0, due_only=True)
+
+    assert ReportOutbox(engine, REPORT_URL).flush(due_only=False) == (0, 0)
+    _post.assert_not_called()
+
+
+@mock.patch("requests.post")
+def test_reports_are_posted_after_the_pre_scan_report(_post, engine):
+    aip_uuid = str(uuid.uuid4())
+    _post.return_value = response(201)
+
+    with ReportOutbox(engine, REPORT_URL, workers=2, poll_interval=0.01) as reports:
+        reports.pre_scan(aip_uuid, datetime(2024, 5, 1), session_id="session")
+        session = models.Session(bind=engine)
+        report = Report(aip=AIP(uuid=aip_uuid), success=True, report=REPORT)
+        outbox.queue_report(report, aip_uuid, session_id="session")
+        session.add(report)
+        session.commit()
+        session.close()
+
+    assert [json.loads(call.kwargs["data"]) for call in _post.mock_calls] == [
+        {"started": 1714521600, "session_uuid": "session"},
+        {"success": True, "message": "", "session_uuid": "session"},
+    ]
+    assert posts(engine) == []
+
+
+@mock.patch("requests.Session.post")
+def test_flush_reports_command(_post, engine, monkeypatch):
+    queue_reports(engine, 2)
+    _post.side_effect = [response(201), response(500)]
+    monkeypatch.setenv("REPORT_URL", REPORT_URL)
+    previous = models.engine
+    stream = io.StringIO()
+    try:
+        status = main(
+            ["flush-reports", "--database-url", str(engine.url)], stream=stream
+        )
+    finally:
+        models.engine = previous
+        models.Session.configure(bind=previous)
+
+    assert status == 1
+    assert stream.getvalue() == (
+        "Posted 1 queued reports\n1 reports could not be posted and remain queued\n"
+    )
+
+
+def test_flush_reports_requires_the_report_url(monkeypatch):
+    monkeypatch.delenv("REPORT_URL", raising=False)
+
+    assert str(main(["flush-reports"])) == "Missing environment variable: REPORT_URL"
+
+
+@pytest.fixture
+def report_server():
+    with StubServer() as server:
+        yield server
+
+
+def test_reports_are_sent_in_bulk(engine, report_server):
+    aip_uuids = queue_reports(engine, 5, session_id="session")
+    report_server.rejected.add(aip_uuids[1])
+
+    reports = ReportOutbox(engine, report_server.url, bulk_size=2)
+    reports.pre_scan(aip_uuids[0], datetime(2024, 5, 1))
+    assert reports.flush() == (4, 1)
+
+    assert [len(body["reports"]) for _, body in report_server.posts] == [1, 2, 2, 1]
+    assert report_server.reports() == [(aip_uuids[0], "pre-scan")] + [
+        (aip_uuid, "report") for aip_uuid in aip_uuids
+    ]
+    assert report_server.posts[1][1]["reports"][0]["report"] == {
+        "success": True,
+        "message": "",
+        "session_uuid": "session",
+    }
+    assert posts(engine) == [(aip_uuids[1], 1, False)]
+
+
+def test_bulk_reports_of_scans_during_a_flush_follow_their_pre_scan(
+    engine, report_server
+):
+    backlog = queue_reports(engine, 4)
+    reports = ReportOutbox(engine, report_server.url, batch_size=2, bulk_size=1)
+    post_bulk = reports._post_bulk
+    scanned = []
+
+    def post_bulk_while_scanning(posts):
+        # An AIP is scanned while the backlog is being sent.
+        if not scanned:
+            scanned.extend(queue_reports(engine, 1))
+            reports.pre_scan(scanned[0], datetime(2024, 5, 1))
+        return post_bulk(posts)
+
+    reports._post_bulk = post_bulk_while_scanning
+    assert reports.flush() == (5, 0)
+
+    received = report_server.reports()
+    assert received[:2] == [(aip_uuid, "report") for aip_uuid in backlog[:2]]
+    assert received.index((scanned[0], "pre-scan")) < received.index(
+        (scanned[0], "report")
+    )
+
+
+def test_bulk_reports_fall_back_to_one_request_per_report(engine):
+    aip_uuids = queue_reports(engine, 3)
+
+    with StubServer(bulk=False) as server:
+        reports = ReportOutbox(engine, server.url, bulk_size=2)
+        reports.pre_scan(aip_uuids[0], datetime(2024, 5, 1))
+        assert reports.flush() == (3, 0)
+
+    assert reports.bulk_size is None
+    assert [path for path, _ in server.posts] == [
+        f"/api/fixity/{aip_uuid}" for aip_uuid in aip_uuids[:1] + aip_uuids
+    ]
+    assert server.reports()[0] == (aip_uuids[0], "pre-scan")
+    assert posts(engine) == []
+
+
+def test_bulk_reports_wait_for_a_full_batch_or_the_interval(engine, report_server):
+    reports = ReportOutbox(engine, report_server.url, bulk_size=3, bulk_interval=60)
+    queue_reports(engine, 2)
+    assert not reports._ready()
+
+    queue_reports(engine, 1)
+    assert reports._ready()
+
+    reports.flush()
+    reports.bulk_interval = 0.01
+    reports.pre_scan(str(uuid.uuid4()), datetime(2024, 5, 1))
+    time.sleep(0.02)
+    assert reports._ready()
@@ -0,0 +1,169 @@
+import io
+import json
+from argparse import Namespace
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import select
+from sqlalchemy import text
+
+from fixity import models
+from fixity import queries
+from fixity.cli import main
+
+AIP_1 = "a7f2a05b-0fdf-42f1-a46c-4522a831cf17"
+AIP_2 = "6ca1ff8e-5c3c-4b24-a9a7-83b69e2a2f2c"
+ENDED = datetime(2024, 5, 14, 12, 0)
+
+
+def failed_report(changed=(), missing=()):
+    return json.dumps(
+        {
+            "success": False,
+            "failures": {
+                "files": {
+                    "changed": [{"path": path} for path in changed],
+                    "missing": [{"path": path} for path in missing],
+                    "untracked": [],
+                }
+            },
+        }
+    )
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = models.Session(bind=engine)
+    session.add_all(
+        [
+            models.Report(
+                aip=models.AIP(uuid=AIP_1),
+                ended=ENDED,
+                success=False,
+                report=failed_report(
+                    changed=["data/objects/a.tif", "data/objects0.txt"],
+                    missing=["data/logs/b.log"],
+                ),
+            ),
+            models.Report(
+                aip=models.AIP(uuid=AIP_2),
+                ended=ENDED,
+                success=False,
+                report=failed_report(missing=["data/objects/c.tif"]),
+            ),
+        ]
+    )
+    session.commit()
+    yield session
+    session.close()
+
+
+def test_find_file_failures_by_path_prefix(session):
+    assert queries.find_file_failures(session, path="data/objects/") == [
+        (AIP_1, "changed", "data/objects/a.tif", ENDED),
+        (AIP_2, "missing", "data/objects/c.tif", ENDED),
+    ]
+
+
+def test_find_file_failures_by_kind_and_aip(session):
+    assert queries.find_file_failures(session, kind="missing") == [
+        (AIP_1, "missing", "data/logs/b.log", ENDED),
+        (AIP_2, "missing", "data/objects/c.tif", ENDED),
+    ]
+    assert queries.find_file_failures(session, kind="missing", aip_uuid=AIP_2) == [
+        (AIP_2, "missing", "data/objects/c.tif", ENDED),
+    ]
+
+
+def test_path_prefix_lookups_use_the_path_index(session):
+    query = text(
+        "EXPLAIN QUERY PLAN SELECT * FROM file_failures WHERE path >= :start "
+        "AND path < :end"
+    )
+    plan = session.execute(
+        query, {"start": "data/objects/", "end": queries._prefix_end("data/objects/")}
+    ).all()
+
+    assert "USING INDEX ix_file_failures_path_kind" in plan[0][-1]
+
+
+def test_print_file_failures(session):
+    stream = io.StringIO()
+    args = Namespace(command="failures", path="data/logs/", kind=None, aip=None)
+
+    assert queries.print_file_failures(session, args, stream) == 0
+    assert stream.getvalue() == (
+        f"{AIP_1}\tmissing\tdata/logs/b.log\t2024-05-14 12:00:00\n"
+    )
+
+
+def test_failures_command_needs_no_storage_service(tmp_path, monkeypatch):
+    for name in ("STORAGE_SERVICE_URL", "STORAGE_SERVICE_USER", "STORAGE_SERVICE_KEY"):
+        monkeypatch.delenv(name, raising=False)
+    engine = models.engine
+    stream = io.StringIO()
+    try:
+        status = main(
+            [
+                "failures",
+                "--path",
+                "data/",
+                "--database-url",
+                f"sqlite:///{tmp_path / 'fixity.db'}",
+            ],
+            stream=stream,
+        )
+    finally:
+        models.engine = engine
+        models.Session.configure(bind=engine)
+
+    assert status == 0
+    assert stream.getvalue() == ""
+
+
+def test_find_status_of_an_aip(session):
+    session.add(
+        models.Report(
+            aip=session.scalars(select(models.AIP).filter_by(uuid=AIP_2)).one(),
+            ended=datetime(2024, 5, 15),
+            success=True,
+        )
+    )
+    session.commit()
+
+    assert queries.find_status(session, aip_uuid=AIP_2) == [
+        (AIP_2, True, datetime(2024, 5, 15), datetime(2024, 5, 15), 0)
+    ]
+
+
+def test_find_status_lists_the_failing_aips(session):
+    assert queries.find_status(session) == [
+        (AIP_1, False, ENDED, None, 1),
+        (AIP_2, False, ENDED, None, 1),
+    ]
+
+
+def test_failing_aips_are_found_with_the_status_index(session):
+    query = text(
+        "EXPLAIN QUERY PLAN SELECT * FROM latest_status "
+        "WHERE last_result IS 0 OR last_result IS NULL"
+    )
+    plan = " ".join(row[-1] for row in session.execute(query))
+
+    assert "ix_latest_status_last_result_last_scanned" in plan
+
+
+def test_print_status(session):
+    stream = io.StringIO()
+    args = Namespace(command="status", aip=AIP_1)
+
+    assert queries.print_status(session, args, stream) == 0
+    assert stream.getvalue() == f"{AIP_1}\tfailed\t2024-05-14 12:00:00\t-\t1\n"
+
+    args.aip = "00000000-0000-0000-0000-000000000000"
+    assert queries.print_status(session, args, stream) == (
+        "No scan of AIP 00000000-0000-0000-0000-000000000000 is recorded"
+    )
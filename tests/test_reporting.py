@@ -1,3 +1,4 @@
+import json
 import os
 from datetime import datetime
 from unittest import mock
@@ -80,6 +81,23 @@ def test_posting_success_report(_post):
     reporting.post_success_report(aip.uuid, report, REPORT_URL)
 
 
+@mock.patch(
+    "requests.post", side_effect=[mock.Mock(status_code=201, spec=requests.Response)]
+)
+def test_posting_success_report_with_a_session(_post):
+    json_report = json_string("test_failed_report.json")
+    report = Report(success=False, report=json_report)
+    reporting.post_success_report(
+        "ed42aadc-d854-46c6-b455-cd384eef1618",
+        report,
+        REPORT_URL,
+        session_id="session",
+    )
+
+    body = json.loads(_post.call_args.kwargs["data"])
+    assert body == {**json.loads(json_report), "session_uuid": "session"}
+
+
 def test_posting_success_report_raises_on_invalid_uuid():
     with pytest.raises(InvalidUUID):
         reporting.post_success_report("foo", None, None)
@@ -167,3 +185,67 @@ def test_posting_success_report_success_none():
         report=json_report,
     )
     assert reporting.post_success_report(aip.uuid, report, REPORT_URL) is None
+
+
+BULK_ITEMS = [
+    reporting.pre_scan_item(
+        "be1074fe-217b-46e0-afec-400ea1a2eb36", datetime.fromtimestamp(1400022946)
+    ),
+    reporting.report_item(
+        "90cf0850-f5d2-4023-95e2-0e2b7a1e1b8e",
+        Report(success=True, report='{"success": true}'),
+        session_id="session",
+    ),
+]
+
+
+@mock.patch(
+    "requests.post",
+    side_effect=[
+        mock.Mock(
+            **{
+                "status_code": 200,
+                "json.return_value": {
+                    "results": [{"status": 201}, {"status": 400, "error": "invalid"}]
+                },
+            },
+            spec=requests.Response,
+        )
+    ],
+)
+def test_posting_reports_in_bulk(_post):
+    errors = reporting.post_reports(BULK_ITEMS, REPORT_URL)
+
+    assert errors[0] is None
+    assert str(errors[1]) == (
+        "Report service returned 400 for the report report of AIP "
+        "90cf0850-f5d2-4023-95e2-0e2b7a1e1b8e: invalid"
+    )
+    assert _post.mock_calls[0].args == (REPORT_URL + "api/fixity/bulk",)
+    assert json.loads(_post.mock_calls[0].kwargs["data"])["reports"][1] == {
+        "aip": "90cf0850-f5d2-4023-95e2-0e2b7a1e1b8e",
+        "kind": "report",
+        "report": {"success": True, "session_uuid": "session"},
+    }
+
+
+@mock.patch(
+    "requests.post", side_effect=[mock.Mock(status_code=404, spec=requests.Response)]
+)
+def test_posting_reports_in_bulk_raises_without_a_bulk_endpoint(_post):
+    with pytest.raises(reporting.BulkUnavailable):
+        reporting.post_reports(BULK_ITEMS, REPORT_URL)
+
+
+@mock.patch(
+    "requests.post",
+    side_effect=[
+        mock.Mock(
+            **{"status_code": 200, "json.return_value": {"results": [{"status": 201}]}},
+            spec=requests.Response,
+        )
+    ],
+)
+def test_posting_reports_in_bulk_raises_on_invalid_responses(_post):
+    with pytest.raises(reporting.ReportServiceException):
+        reporting.post_reports(BULK_ITEMS, REPORT_URL)
@@ -0,0 +1,126 @@
+import io
+from argparse import Namespace
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import select
+
+from fixity import models
+from fixity import retention
+from fixity.models import AIP
+from fixity.models import FileFailure
+from fixity.models import Report
+from fixity.models import ReportRollup
+
+AIP_UUID = "a7f2a05b-0fdf-42f1-a46c-4522a831cf17"
+FAILED_REPORT = (
+    '{"success": false, "failures": {"files": '
+    '{"changed": [{"path": "data/objects/a.tif"}], "missing": [], "untracked": []}}}'
+)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    return engine
+
+
+def add_reports(engine, aip_uuid, results, start=datetime(2024, 1, 30)):
+    """
+    Save one report per result, a day apart from start, where each result
+    is True (success), False (failure) or None (success not posted yet).
+    """
+    session = models.Session(bind=engine)
+    aip = AIP(uuid=aip_uuid)
+    for day, result in enumerate(results):
+        session.add(
+            Report(
+                aip=aip,
+                ended=start + timedelta(days=day),
+                success=result is not False,
+                posted=result is not None,
+                report="{}" if result is not False else FAILED_REPORT,
+            )
+        )
+    session.commit()
+    session.close()
+
+
+def test_roll_up_reports_keeps_the_latest_reports_and_failures(engine):
+    # Jan 30, Jan 31 (failed), Feb 1, Feb 2 (not posted), then 3 more.
+    add_reports(engine, AIP_UUID, [True, False, True, None, True, True, True])
+
+    assert retention.roll_up_reports(engine, keep=3) == 2
+
+    session = models.Session(bind=engine)
+    kept = session.scalars(select(Report.ended).order_by(Report.ended)).all()
+    assert [ended.day for ended in kept] == [31, 2, 3, 4, 5]
+    rollups = session.execute(
+        select(
+            ReportRollup.month,
+            ReportRollup.success_count,
+            ReportRollup.first_ended,
+            ReportRollup.last_ended,
+        ).order_by(ReportRollup.month)
+    ).all()
+    assert rollups == [
+        (date(2024, 1, 1), 1, datetime(2024, 1, 30), datetime(2024, 1, 30)),
+        (date(2024, 2, 1), 1, datetime(2024, 2, 1), datetime(2024, 2, 1)),
+    ]
+    assert session.query(FileFailure).count() == 1
+    session.close()
+
+    assert retention.roll_up_reports(engine, keep=3) == 0
+
+
+def test_roll_up_reports_adds_to_existing_rollups_in_batches(engine):
+    add_reports(engine, AIP_UUID, [True] * 5, start=datetime(2024, 3, 1))
+    add_reports(
+        engine,
+        "6ca1ff8e-5c3c-4b24-a9a7-83b69e2a2f2c",
+        [True] * 3,
+        start=datetime(2024, 3, 1),
+    )
+    assert retention.roll_up_reports(engine, keep=4, batch_size=1) == 1
+    session = models.Session(bind=engine)
+    aip = session.scalars(select(AIP).where(AIP.uuid == AIP_UUID)).one()
+    session.add_all(
+        Report(aip=aip, ended=datetime(2024, 3, 10 + day), success=True, posted=True)
+        for day in range(2)
+    )
+    session.commit()
+
+    assert retention.roll_up_reports(engine, keep=4, batch_size=1) == 2
+
+    rollup = session.scalars(select(ReportRollup)).one()
+    assert (rollup.aip_id, rollup.month, rollup.success_count) == (
+        aip.id,
+        date(2024, 3, 1),
+        3,
+    )
+    assert (rollup.first_ended, rollup.last_ended) == (
+        datetime(2024, 3, 1),
+        datetime(2024, 3, 3),
+    )
+    session.close()
+
+
+def test_run_prints_a_summary(tmp_path):
+    previous = models.engine
+    try:
+        engine = models.configure(f"sqlite:///{tmp_path / 'fixity.db'}")
+        add_reports(engine, AIP_UUID, [True] * 3)
+        stream = io.StringIO()
+
+        assert retention.run(Namespace(keep=1), stream) == 0
+    finally:
+        models.engine = previous
+        models.Session.configure(bind=previous)
+
+    assert stream.getvalue() == (
+        "Rolled up 2 reports of successful scans into monthly counts\n"
+    )
@@ -0,0 +1,175 @@
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+
+import pytest
+
+from fixity import scheduling
+from fixity.models import AIP
+from fixity.models import Report
+from fixity.models import Session
+from fixity.storage_service import StorageServiceError
+
+LOCATION_A = "7d20c992-bc92-4f92-a794-7161ee2cc2b6"
+LOCATION_B = "1c6e1c72-9d8e-47a6-a2ae-6bf10e0be7e4"
+
+
+def test_location_of():
+    aip = {"current_location": f"/api/v2/location/{LOCATION_A}/"}
+
+    assert scheduling.location_of(aip) == LOCATION_A
+    assert scheduling.location_of({}) is None
+
+
+def test_scheduler_interleaves_locations():
+    scheduler = scheduling.LocationScheduler()
+    for item in ("a1", "a2", "a3"):
+        scheduler.push(item, LOCATION_A)
+    scheduler.push("b1", LOCATION_B)
+
+    assert [scheduler.pop()[0] for _ in range(4)] == ["a1", "b1", "a2", "a3"]
+    assert scheduler.pop() is None
+    assert len(scheduler) == 0
+
+
+def test_scheduler_enforces_limits():
+    scheduler = scheduling.LocationScheduler(default_limit=2, limits={LOCATION_B: 1})
+    for item in ("a1", "a2", "a3"):
+        scheduler.push(item, LOCATION_A)
+    for item in ("b1", "b2"):
+        scheduler.push(item, LOCATION_B)
+
+    assert scheduler.pop() == ("a1", LOCATION_A)
+    assert scheduler.pop() == ("b1", LOCATION_B)
+    assert scheduler.pop() == ("a2", LOCATION_A)
+    # Both locations are at their limit.
+    assert scheduler.pop() is None
+
+    scheduler.done(LOCATION_B)
+    assert scheduler.pop() == ("b2", LOCATION_B)
+    assert scheduler.pop() is None
+
+    scheduler.done(LOCATION_A)
+    assert scheduler.pop() == ("a3", LOCATION_A)
+
+
+def test_scheduler_keeps_the_order_within_limits():
+    scheduler = scheduling.LocationScheduler(default_limit=2, keep_order=True)
+    for item, location in (
+        ("a1", LOCATION_A),
+        ("a2", LOCATION_A),
+        ("a3", LOCATION_A),
+        ("b1", LOCATION_B),
+        ("a4", LOCATION_A),
+    ):
+        scheduler.push(item, location)
+
+    assert scheduler.pop() == ("a1", LOCATION_A)
+    assert scheduler.pop() == ("a2", LOCATION_A)
+    # Location A is at its limit.
+    assert scheduler.pop() == ("b1", LOCATION_B)
+    assert scheduler.pop() is None
+
+    scheduler.done(LOCATION_A)
+    assert scheduler.pop() == ("a3", LOCATION_A)
+
+
+def test_scheduler_is_full_at_its_lookahead():
+    scheduler = scheduling.LocationScheduler(lookahead=2)
+    scheduler.push("a1", LOCATION_A)
+
+    assert not scheduler.full()
+
+    scheduler.push("a2", LOCATION_A)
+
+    assert scheduler.full()
+
+
+def test_order_by_staleness():
+    listed = [{"uuid": u} for u in ("recent", "never", "old", "also-never")]
+    last_scanned = {
+        "recent": datetime(2024, 5, 1),
+        "old": datetime(2023, 1, 1),
+    }
+
+    scheduling.order_by_staleness(listed, last_scanned)
+
+    assert [aip["uuid"] for aip in listed] == ["never", "also-never", "old", "recent"]
+
+
+def test_order_by_cost_uses_durations_and_sizes():
+    listed = [
+        {"uuid": "small", "size": 10},
+        {"uuid": "slow", "size": 10},
+        {"uuid": "large", "size": 1000},
+        {"uuid": "medium", "size": 200},
+    ]
+    # "slow" took as long as 500 bytes would at the rate of "medium".
+    durations = {"slow": 50.0, "medium": 20.0}
+
+    scheduling.order_by_cost(listed, durations)
+
+    assert [aip["uuid"] for aip in listed] == ["large", "slow", "medium", "small"]
+
+
+def test_order_by_cost_falls_back_to_size():
+    listed = [{"uuid": "a", "size": 1}, {"uuid": "b"}, {"uuid": "c", "size": 5}]
+
+    scheduling.order_by_cost(listed, {})
+
+    assert [aip["uuid"] for aip in listed] == ["c", "a", "b"]
+
+
+def test_reordered_yields_listed_aips_before_errors():
+    def listing():
+        yield {"uuid": "b"}
+        yield {"uuid": "a"}
+        raise StorageServiceError("page failed")
+
+    ordered = scheduling.reordered(listing(), lambda listed: listed.sort(key=str))
+
+    assert next(ordered) == {"uuid": "a"}
+    assert next(ordered) == {"uuid": "b"}
+    with pytest.raises(StorageServiceError):
+        next(ordered)
+
+
+def test_last_scanned_returns_latest_report_per_aip():
+    session = Session()
+    aip = AIP(uuid=str(uuid.uuid4()))
+    unscanned = AIP(uuid=str(uuid.uuid4()))
+    session.add_all([aip, unscanned])
+    for day in (3, 1, 2):
+        session.add(
+            Report(
+                aip=aip,
+                begun=datetime(2024, 1, day) - timedelta(minutes=day),
+                ended=datetime(2024, 1, day),
+                success=True,
+            )
+        )
+    session.flush()
+
+    last_scanned = scheduling.last_scanned(session)
+
+    assert last_scanned[aip.uuid] == datetime(2024, 1, 3)
+    assert unscanned.uuid not in last_scanned
+    # Durations come from the most recently recorded scan.
+    durations = scheduling.scan_durations(session)
+    assert durations[aip.uuid] == 120
+    assert unscanned.uuid not in durations
+    session.rollback()
+    session.close()
+
+
+def test_time_budget_leaves_room_for_an_average_scan():
+    budget = scheduling.TimeBudget(time.monotonic() + 60)
+    assert not budget.exhausted()
+
+    budget.record(30)
+    budget.record(90)
+
+    assert budget.expected_duration() == 60
+    assert budget.exhausted()
+    assert budget.ran_out
@@ -0,0 +1,52 @@
+import uuid
+from collections import Counter
+
+import pytest
+
+from fixity import sharding
+
+AIP_UUIDS = [str(uuid.UUID(int=i * 7919 + 1, version=4)) for i in range(2000)]
+
+
+def test_every_aip_is_in_exactly_one_shard():
+    for aip_uuid in AIP_UUIDS[:200]:
+        shards = [i for i in range(1, 4) if sharding.in_shard(aip_uuid, (i, 3))]
+        assert len(shards) == 1
+
+
+def test_shards_are_balanced():
+    counts = Counter(
+        sharding.jump_hash(sharding.aip_key(aip_uuid), 4) for aip_uuid in AIP_UUIDS
+    )
+
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > 0.8 * len(AIP_UUIDS) / 4
+
+
+def test_adding_a_shard_only_moves_aips_to_it():
+    moved = 0
+    for aip_uuid in AIP_UUIDS:
+        key = sharding.aip_key(aip_uuid)
+        before, after = sharding.jump_hash(key, 4), sharding.jump_hash(key, 5)
+        if before != after:
+            assert after == 4
+            moved += 1
+
+    # About a fifth of the AIPs move to the new shard.
+    assert 0.15 < moved / len(AIP_UUIDS) < 0.25
+
+
+def test_aip_key_ignores_case():
+    aip_uuid = AIP_UUIDS[0]
+
+    assert sharding.aip_key(aip_uuid) == sharding.aip_key(aip_uuid.upper())
+
+
+@pytest.mark.parametrize("value", ["3", "0/3", "4/3", "a/b", "1/"])
+def test_parse_shard_rejects_invalid_shards(value):
+    with pytest.raises(ValueError):
+        sharding.parse_shard(value)
+
+
+def test_parse_shard():
+    assert sharding.parse_shard("2/5") == (2, 5)
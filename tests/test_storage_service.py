@@ -1,10 +1,15 @@
 import json
+import time
+import uuid
 from unittest import mock
 
 import pytest
 import requests
+from sqlalchemy import event
 
+from fixity import models
 from fixity import storage_service
+from fixity.models import AIP
 from fixity.models import Session
 from fixity.utils import InvalidUUID
 
@@ -383,3 +388,132 @@ def test_fixity_scan_raises_with_bad_auth(_get):
         )
 
     assert "failed authentication" in str(ex.value)
+
+
+def _listing_page(uuids, next_uri):
+    return mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "meta": {"next": next_uri},
+                "objects": [
+                    {"package_type": "AIP", "status": "UPLOADED", "uuid": uuid}
+                    for uuid in uuids
+                ],
+            },
+        },
+        spec=requests.Response,
+    )
+
+
+@mock.patch("requests.get")
+def test_iter_aips_streams_pages_in_order(_get):
+    pages = [[f"{page}-{item}" for item in range(3)] for page in range(5)]
+    _get.side_effect = [
+        _listing_page(uuids, f"/api/v2/file/?offset={3 * (i + 1)}")
+        for i, uuids in enumerate(pages[:-1])
+    ] + [_listing_page(pages[-1], None)]
+
+    aips = storage_service.iter_aips(
+        STORAGE_SERVICE_URL, STORAGE_SERVICE_USER, STORAGE_SERVICE_KEY, prefetch=1
+    )
+
+    # Only the first page has been requested synchronously; the producer
+    # can run at most one buffered page (plus the one it holds) ahead.
+    assert next(aips)["uuid"] == "0-0"
+    time.sleep(0.2)
+    assert _get.call_count <= 3
+
+    assert ["0-0"] + [aip["uuid"] for aip in aips] == sum(pages, [])
+    assert _get.mock_calls[1] == mock.call(
+        f"{STORAGE_SERVICE_URL}api/v2/file/?offset=3"
+    )
+
+
+@mock.patch("requests.get")
+def test_iter_aips_raises_errors_from_later_pages(_get):
+    _get.side_effect = [
+        _listing_page(["a", "b"], "/api/v2/file/?offset=2"),
+        mock.Mock(status_code=500, spec=requests.Response),
+    ]
+
+    aips = storage_service.iter_aips(
+        STORAGE_SERVICE_URL, STORAGE_SERVICE_USER, STORAGE_SERVICE_KEY
+    )
+
+    assert next(aips)["uuid"] == "a"
+    assert next(aips)["uuid"] == "b"
+    with pytest.raises(storage_service.StorageServiceError) as ex:
+        next(aips)
+
+    assert "internal error" in str(ex.value)
+
+
+@mock.patch(
+    "requests.get",
+    return_value=mock.Mock(
+        **{
+            "status_code": 200,
+            "json.return_value": {
+                "success": True,
+                "message": "",
+                "failures": {"files": {"missing": [], "changed": [], "untracked": []}},
+                "timestamp": None,
+            },
+        },
+        spec=requests.Response,
+    ),
+)
+def test_fixity_scan_reuses_aips_added_since_the_last_commit(_get):
+    session = Session()
+    aip_uuid = str(uuid.uuid4())
+
+    _, first = storage_service.scan_aip(
+        aip_uuid,
+        STORAGE_SERVICE_URL,
+        STORAGE_SERVICE_USER,
+        STORAGE_SERVICE_KEY,
+        session,
+    )
+    session.add(first)
+    _, second = storage_service.scan_aip(
+        aip_uuid,
+        STORAGE_SERVICE_URL,
+        STORAGE_SERVICE_USER,
+        STORAGE_SERVICE_KEY,
+        session,
+    )
+    session.add(second)
+    session.commit()
+
+    assert second.aip is first.aip
+    assert len(first.aip.reports) == 2
+    session.close()
+
+
+def test_load_aips_adds_missing_aips_in_bulk():
+    session = Session()
+    existing = AIP(uuid=str(uuid.uuid4()))
+    session.add(existing)
+    session.commit()
+    new_uuids = [str(uuid.uuid4()) for _ in range(3)]
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0])
+
+    event.listen(models.engine, "before_cursor_execute", record)
+    try:
+        aips = storage_service.load_aips(
+            session, [existing.uuid, *new_uuids], batch_size=2
+        )
+    finally:
+        event.remove(models.engine, "before_cursor_execute", record)
+
+    assert aips[existing.uuid] is existing
+    assert sorted(aips) == sorted([existing.uuid, *new_uuids])
+    assert all(aip.id is not None for aip in aips.values())
+    # Two lookups of two UUIDs, one INSERT, and two lookups of the AIPs added.
+    assert statements.count("SELECT") == 4
+    assert statements.count("INSERT") == 1
+    session.close()
@@ -0,0 +1,95 @@
+from unittest import mock
+
+from fixity.throttle import DELAY_STEP
+from fixity.throttle import AdaptiveThrottle
+
+
+def test_throttle_starts_at_the_minimum():
+    throttle = AdaptiveThrottle(min_delay=2.0, max_delay=30.0, max_concurrency=8)
+
+    assert throttle.delay == 2.0
+    assert throttle.concurrency == 1
+
+
+def test_throttle_increases_concurrency_additively():
+    throttle = AdaptiveThrottle(max_concurrency=4)
+
+    concurrencies = []
+    for _ in range(12):
+        throttle.observe(1.0, 200)
+        concurrencies.append(throttle.concurrency)
+
+    # Roughly one more scan for every `concurrency` successful responses.
+    assert concurrencies[:7] == [2, 2, 2, 3, 3, 3, 4]
+    assert max(concurrencies) == 4
+
+
+def test_throttle_backs_off_multiplicatively_on_overload():
+    throttle = AdaptiveThrottle(max_delay=10.0, max_concurrency=16)
+    for _ in range(200):
+        throttle.observe(1.0, 200)
+    assert throttle.concurrency == 16
+
+    throttle.observe(1.0, 504)
+    assert throttle.concurrency == 8
+    assert throttle.delay == DELAY_STEP
+
+    for _ in range(10):
+        throttle.observe(1.0, 503)
+    assert throttle.concurrency == 1
+    assert throttle.delay == 10.0
+
+
+def test_throttle_backs_off_when_responses_slow_down():
+    throttle = AdaptiveThrottle(max_concurrency=8)
+    for _ in range(50):
+        throttle.observe(1.0, 200)
+    assert throttle.concurrency == 8
+
+    for _ in range(5):
+        throttle.observe(10.0, 200)
+
+    assert throttle.concurrency < 8
+    assert throttle.delay > 0
+
+
+def test_throttle_recovers_down_to_the_minimum_delay():
+    throttle = AdaptiveThrottle(min_delay=0.5, max_delay=4.0)
+    for _ in range(5):
+        throttle.observe(1.0, 500)
+    assert throttle.delay == 4.0
+
+    for _ in range(10):
+        throttle.observe(1.0, 200)
+
+    assert throttle.delay == 0.5
+
+
+def test_response_hook_only_observes_check_fixity_requests():
+    throttle = AdaptiveThrottle(max_concurrency=4)
+    response = mock.Mock(status_code=500)
+    response.elapsed.total_seconds.return_value = 1.0
+
+    response.request.url = "http://localhost:8000/api/v2/file/?limit=10"
+    throttle.response_hook(response)
+    assert throttle.delay == 0
+
+    response.request.url = "http://localhost:8000/api/v2/file/uuid/check_fixity/"
+    throttle.response_hook(response)
+    assert throttle.delay == DELAY_STEP
+
+
+def test_throttle_backs_off_on_requests_without_a_response():
+    throttle = AdaptiveThrottle(max_concurrency=4)
+    for _ in range(20):
+        throttle.observe(1.0, 200)
+    assert throttle.concurrency == 4
+
+    throttle.error_hook("http://localhost:8000/api/v2/file/?limit=10", OSError())
+    assert throttle.concurrency == 4
+
+    throttle.error_hook(
+        "http://localhost:8000/api/v2/file/uuid/check_fixity/", OSError()
+    )
+    assert throttle.concurrency == 2
+    assert throttle.delay == DELAY_STEP
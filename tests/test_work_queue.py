@@ -0,0 +1,166 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+
+from fixity import checkpoints
+from fixity import work_queue
+from fixity.models import QueuedAIP
+from fixity.models import Session
+
+from .stub_server import StubServer
+
+REPO_ROOT = Path(__file__).parent.parent
+
+
+@pytest.fixture
+def session():
+    session = Session()
+    yield session
+    session.close()
+
+
+def _queued_session(session, count):
+    scan_session = checkpoints.start_session(session)
+    aip_uuids = [str(uuid.uuid4()) for _ in range(count)]
+    work_queue.enqueue(
+        session, scan_session, [{"uuid": aip_uuid} for aip_uuid in aip_uuids]
+    )
+    return scan_session, aip_uuids
+
+
+def test_workers_claim_disjoint_batches(session):
+    scan_session, aip_uuids = _queued_session(session, 5)
+    first = work_queue.LeaseQueue(session, scan_session, batch_size=3)
+    second = work_queue.LeaseQueue(session, scan_session, batch_size=3)
+
+    first_claim = [aip["uuid"] for aip in first.claim()]
+    second_claim = [aip["uuid"] for aip in second.claim()]
+
+    assert first_claim == aip_uuids[:3]
+    assert second_claim == aip_uuids[3:]
+    assert second.claim() == []
+    assert first.remaining(session) == 5
+
+
+def test_expired_leases_return_to_the_pool(session):
+    scan_session, aip_uuids = _queued_session(session, 3)
+    stalled = work_queue.LeaseQueue(session, scan_session, lease_duration=0.01)
+    worker = work_queue.LeaseQueue(session, scan_session)
+    stalled.claim()
+    time.sleep(0.05)
+
+    assert [aip["uuid"] for aip in worker.claim()] == aip_uuids
+
+    # The stalled worker no longer owns its AIPs and can't complete them.
+    stalled.complete(session, aip_uuids[0])
+    worker.complete(session, aip_uuids[1])
+    session.commit()
+    assert worker.remaining(session) == 2
+
+
+def test_leases_are_renewed_while_working(session):
+    scan_session, _ = _queued_session(session, 2)
+    worker = work_queue.LeaseQueue(session, scan_session, lease_duration=0.3)
+    other = work_queue.LeaseQueue(session, scan_session)
+
+    with worker:
+        worker.claim()
+        time.sleep(0.6)
+        assert other.claim() == []
+
+    worker.release(session)
+    session.commit()
+    assert len(other.claim()) == 2
+
+
+def test_workers_wait_for_the_queue_to_be_filled(session):
+    scan_session = checkpoints.start_session(session)
+    worker = work_queue.LeaseQueue(session, scan_session, poll_interval=0.01)
+    claimed = []
+
+    def work():
+        for batch in worker.batches():
+            claimed.extend(aip["uuid"] for aip in batch)
+
+    thread = threading.Thread(target=work, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    # The queue is empty, but the AIPs are still being listed.
+    assert thread.is_alive()
+
+    aip_uuid = str(uuid.uuid4())
+    work_queue.enqueue(session, scan_session, [{"uuid": aip_uuid}])
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert claimed == [aip_uuid]
+
+
+def test_enqueuer_queues_each_page_as_it_comes(session):
+    scan_session = checkpoints.start_session(session)
+    worker = work_queue.LeaseQueue(session, scan_session)
+    first_page = [{"uuid": str(uuid.uuid4())} for _ in range(2)]
+    second_page = [{"uuid": str(uuid.uuid4())}]
+    listed = threading.Event()
+
+    def pages():
+        yield first_page
+        # The next page is only listed once the first one was claimed.
+        assert listed.wait(timeout=5)
+        yield second_page
+        raise ValueError("listing failed")
+
+    with work_queue.Enqueuer(session.get_bind(), scan_session, pages()) as enqueuer:
+        claimed = []
+        while not claimed:
+            time.sleep(0.01)
+            claimed = worker.claim()
+        listed.set()
+
+    assert claimed == [dict(aip, current_location=None) for aip in first_page]
+    assert isinstance(enqueuer.error, ValueError)
+    # The queue is complete despite the error.
+    assert [aip["uuid"] for aip in worker.claim()] == [second_page[0]["uuid"]]
+    session.refresh(scan_session)
+    assert scan_session.enqueued is not None
+
+
+def test_worker_processes_share_a_queue(session):
+    scan_session, aip_uuids = _queued_session(session, 30)
+    with StubServer() as server:
+        env = dict(
+            os.environ,
+            PYTHONPATH=str(REPO_ROOT),
+            STORAGE_SERVICE_URL=server.url,
+            STORAGE_SERVICE_USER="test",
+            STORAGE_SERVICE_KEY="test",
+        )
+        env.pop("REPORT_URL", None)
+        workers = [
+            subprocess.Popen(
+                [sys.executable, "-m", "fixity.fixity", "work", scan_session.uuid],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            for _ in range(3)
+        ]
+        for worker in workers:
+            _, stderr = worker.communicate(timeout=60)
+            assert worker.returncode == 0, stderr
+
+    assert server.checks == dict.fromkeys(aip_uuids, 1)
+    rows = session.scalars(
+        select(QueuedAIP).where(QueuedAIP.session_id == scan_session.id)
+    ).all()
+    assert all(row.done for row in rows)
+    assert len({row.lease_owner for row in rows}) > 1
+    session.refresh(scan_session)
+    assert scan_session.ended is not None
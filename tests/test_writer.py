@@ -0,0 +1,135 @@
+import json
+import time
+import uuid
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from fixity import checkpoints
+from fixity import models
+from fixity.models import AIP
+from fixity.models import FileFailure
+from fixity.models import Report
+from fixity.models import Session
+from fixity.writer import ReportWriter
+
+
+@pytest.fixture
+def session():
+    session = Session()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def aip(session):
+    aip = AIP(uuid=str(uuid.uuid4()))
+    session.add(aip)
+    session.commit()
+    return aip
+
+
+def _saved_reports(aip):
+    session = Session()
+    reports = session.scalars(select(Report).where(Report.aip_id == aip.id))
+    saved = [report.report for report in reports]
+    session.close()
+    return saved
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_writer_commits_in_batches(session, aip):
+    scan_session = checkpoints.start_session(session)
+
+    with ReportWriter(models.engine, scan_session, every=4, interval=3600) as writer:
+        for number in range(3):
+            writer.add(Report(aip_id=aip.id, report=str(number)))
+        writer.done(aip.uuid)
+        _wait_for(lambda: len(_saved_reports(aip)) == 3)
+        # Committed objects don't stay in the writer's session.
+        _wait_for(lambda: not list(writer.session))
+        assert checkpoints.scanned_aips(session, scan_session) == {aip.uuid}
+        writer.add(Report(aip_id=aip.id, report="3"))
+
+    assert sorted(_saved_reports(aip)) == ["0", "1", "2", "3"]
+
+
+def test_writer_commits_each_checkpoint_once_caught_up(session, aip):
+    scan_session = checkpoints.start_session(session)
+
+    with ReportWriter(models.engine, scan_session, every=100, interval=3600) as writer:
+        writer.add(Report(aip_id=aip.id, report="scanned"))
+        writer.done(aip.uuid)
+
+        _wait_for(lambda: checkpoints.scanned_aips(session, scan_session) == {aip.uuid})
+        assert _saved_reports(aip) == ["scanned"]
+
+
+def test_writer_commits_after_the_interval(session, aip):
+    scan_session = checkpoints.start_session(session)
+
+    with ReportWriter(models.engine, scan_session, every=100, interval=0.05) as writer:
+        writer.add(Report(aip_id=aip.id, report="late"))
+
+        _wait_for(lambda: _saved_reports(aip) == ["late"])
+
+
+def test_writer_raises_errors_to_scans(session, aip):
+    scan_session = checkpoints.start_session(session)
+    writer = ReportWriter(models.engine, scan_session, every=1)
+
+    with pytest.raises(IntegrityError):
+        with writer:
+            # Duplicate AIPs break the unique index on their UUID.
+            writer.add(AIP(uuid=aip.uuid))
+            _wait_for(lambda: writer.error is not None)
+            writer.done(aip.uuid)
+
+    with pytest.raises(IntegrityError):
+        writer.add(Report(aip_id=aip.id))
+    assert checkpoints.scanned_aips(session, scan_session) == set()
+
+
+def test_writer_saves_the_items_before_a_failing_one(session, aip):
+    scan_session = checkpoints.start_session(session)
+    failed = json.dumps(
+        {"message": "", "failures": {"files": {"changed": [{"path": "data/a"}]}}}
+    )
+    writer = ReportWriter(models.engine, scan_session, every=100, interval=3600)
+
+    with pytest.raises(IntegrityError):
+        with writer:
+            writer.add(Report(aip_id=aip.id, report=failed))
+            writer.done(aip.uuid)
+            writer.add(AIP(uuid=aip.uuid))
+            writer.add(Report(aip_id=aip.id, report="after"))
+
+    assert _saved_reports(aip) == [failed]
+    assert checkpoints.scanned_aips(session, scan_session) == {aip.uuid}
+    assert session.scalars(
+        select(FileFailure.path).where(FileFailure.aip_id == aip.id)
+    ).all() == ["data/a"]
+
+
+def test_writer_raises_any_error_to_scans(session, aip, monkeypatch):
+    scan_session = checkpoints.start_session(session)
+    writer = ReportWriter(models.engine, scan_session, every=1, max_pending=1)
+
+    def broken_commit():
+        raise TypeError("broken")
+
+    monkeypatch.setattr(writer.session, "commit", broken_commit)
+    with pytest.raises(TypeError):
+        with writer:
+            writer.add(Report(aip_id=aip.id, report="lost"))
+            _wait_for(lambda: writer.error is not None)
+            writer.add(Report(aip_id=aip.id, report="refused"))
+
+    assert _saved_reports(aip) == []